@@ -0,0 +1,130 @@
+"""Compares storage size and latency of compressed and uncompressed message
+bodies.
+
+    python benchmarks/compression.py [--messages=N] [--threshold=N]
+                                     [--repeat=N]
+
+Runs against a throwaway test database created from DJANGO_SETTINGS_MODULE
+(talkalot.tests.settings by default).
+"""
+import os
+import random
+import sys
+import time
+
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'talkalot.tests.settings')
+
+# django.db reads the settings on import, so these come after the setup above
+import django  # noqa: E402
+
+from django.db import connection  # noqa: E402
+
+
+LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR')
+WORDS = ('request handled job queued retrying connection reset user session '
+         'cache miss timeout worker started finished').split()
+
+
+def log_body(lines):
+    return '\n'.join(
+        '2014-10-{0:02d} 12:{1:02d}:{2:02d} {3} {4}'.format(
+            random.randint(1, 30), random.randint(0, 59), i % 60,
+            random.choice(LEVELS),
+            ' '.join(random.choice(WORDS) for _ in range(8))
+        )
+        for i in range(lines)
+    )
+
+
+def setup_data(message_count):
+    from django.contrib.auth.models import User
+    from talkalot.models import Message
+
+    users = [User.objects.create_user('user{0}'.format(i),
+                                      'user{0}@example.com'.format(i),
+                                      'password')
+             for i in range(2)]
+    message = Message.send_to_users('first', users[0], users[1:])
+    conversation = message.conversation
+
+    messages = []
+    for i in range(message_count):
+        # mostly chat, with a pasted log every now and then
+        body = log_body(random.randint(20, 200)) if i % 5 == 0 else 'ok'
+        messages.append(Message(body=body,
+                                sender=users[i % len(users)],
+                                conversation=conversation))
+    start = time.time()
+    Message.objects.bulk_create(messages, batch_size=500)
+    return conversation, time.time() - start
+
+
+def stored_size():
+    from talkalot.models import Message
+    cursor = connection.cursor()
+    cursor.execute('SELECT SUM(LENGTH(body)) FROM {0}'.format(
+        Message._meta.db_table
+    ))
+    return cursor.fetchone()[0]
+
+
+def timeit(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        timings.append(time.time() - start)
+    return min(timings)
+
+
+def run(threshold, options):
+    from django.contrib.auth.models import User
+    from talkalot import settings
+    from talkalot.models import Conversation, Message
+
+    settings.MESSAGE_COMPRESSION_THRESHOLD = threshold
+    Conversation.objects.all().delete()
+    User.objects.all().delete()
+    random.seed(0)
+    conversation, write = setup_data(options.messages)
+    messages = Message.objects.filter(conversation=conversation)
+
+    def previews():
+        return [m.preview for m in messages.all()]
+
+    def bodies():
+        return [m.body for m in messages.all()]
+
+    return (stored_size(), write, timeit(previews, options.repeat),
+            timeit(bodies, options.repeat))
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--messages', type='int', default=5000)
+    parser.add_option('--threshold', type='int', default=512)
+    parser.add_option('--repeat', type='int', default=5)
+    options, args = parser.parse_args()
+
+    if hasattr(django, 'setup'):
+        django.setup()
+
+    connection.creation.create_test_db(verbosity=0)
+
+    print('{0:>12} {1:>12} {2:>10} {3:>12} {4:>12}'.format(
+        'mode', 'stored KB', 'write ms', 'previews ms', 'bodies ms'
+    ))
+    for name, threshold in (('plain', None),
+                            ('compressed', options.threshold)):
+        size, write, previews, bodies = run(threshold, options)
+        print('{0:>12} {1:12.0f} {2:10.2f} {3:12.2f} {4:12.2f}'.format(
+            name, size / 1024.0, write * 1000, previews * 1000,
+            bodies * 1000
+        ))
+
+
+if __name__ == '__main__':
+    main()
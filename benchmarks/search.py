@@ -0,0 +1,94 @@
+"""Compares full-text search against the `body__icontains` baseline.
+
+    python benchmarks/search.py [--messages=N] [--repeat=N]
+
+Runs against a throwaway test database created from DJANGO_SETTINGS_MODULE
+(talkalot.tests.settings by default).
+"""
+import os
+import random
+import sys
+import time
+
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'talkalot.tests.settings')
+
+# django.db reads the settings on import, so these come after the setup above
+import django  # noqa: E402
+
+from django.db import connection  # noqa: E402
+
+
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do '
+         'eiusmod tempor incididunt ut labore et dolore magna aliqua enim '
+         'minim veniam quis nostrud exercitation ullamco laboris nisi').split()
+
+
+def setup_data(message_count):
+    from django.contrib.auth.models import User
+    from talkalot.models import Message
+
+    users = [User.objects.create_user('user{0}'.format(i),
+                                      'user{0}@example.com'.format(i),
+                                      'password')
+             for i in range(10)]
+    message = Message.send_to_users('first', users[0], users[1:])
+    conversation = message.conversation
+
+    messages = []
+    for i in range(message_count):
+        body = ' '.join(random.choice(WORDS) for _ in range(30))
+        if i % 100 == 0:
+            body += ' needle'
+        messages.append(Message(body=body,
+                                sender=users[i % len(users)],
+                                conversation=conversation))
+    Message.objects.bulk_create(messages, batch_size=500)
+    return users[0]
+
+
+def timeit(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        result = func()
+        timings.append(time.time() - start)
+    return min(timings), result
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--messages', type='int', default=50000)
+    parser.add_option('--repeat', type='int', default=5)
+    options, args = parser.parse_args()
+
+    if hasattr(django, 'setup'):
+        django.setup()
+
+    from django.core.management import call_command
+    from talkalot.models import Message
+
+    connection.creation.create_test_db(verbosity=0)
+    user = setup_data(options.messages)
+    call_command('rebuild_search_index', verbosity=0)
+
+    def baseline():
+        return list(Message.objects.filter(
+            conversation__participations__user=user,
+            body__icontains='needle'
+        )[:20])
+
+    def search():
+        return Message.objects.search(user, 'needle', limit=20)
+
+    for name, func in (('icontains', baseline), ('search', search)):
+        best, result = timeit(func, options.repeat)
+        print('{0:>10}: {1:8.2f} ms ({2} results)'.format(
+            name, best * 1000, len(result)
+        ))
+
+
+if __name__ == '__main__':
+    main()
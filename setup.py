@@ -1,5 +1,5 @@
 import os
-from setuptools import setup
+from setuptools import find_packages, setup
 
 README = open(os.path.join(os.path.dirname(__file__), 'README.md')).read()
 
@@ -8,7 +8,7 @@ os.chdir(os.path.normpath(os.path.join(os.path.abspath(__file__), os.pardir)))
 setup(
     name='django-talkalot',
     version='0.1',
-    packages=['talkalot'],
+    packages=find_packages(exclude=['talkalot.tests']),
     include_package_data=True,
     install_requires=['django>=1.4'],
     license='BSD License',
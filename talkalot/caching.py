@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""Cache keys of talkalot and their invalidation."""
+from __future__ import unicode_literals
+
+import math
+import random
+import threading
+import time
+from uuid import uuid4
+
+from django.core.cache import cache
+
+from . import settings
+from .settings import (CACHE_LOCK_KEY_PATTERN,
+                       CACHE_VERSION_KEY_PATTERN,
+                       CONVERSATION_CACHE_KEY_PATTERN,
+                       CONVERSATION_CACHE_TIMEOUT,
+                       INBOX_CACHE_KEY_PATTERN,
+                       INBOX_CACHE_TIMEOUT,
+                       INBOX_GENERATION_CACHE_KEY_PATTERN,
+                       MEMBER_CACHE_KEY_PATTERN,
+                       MEMBER_COUNT_CACHE_KEY_PATTERN)
+
+
+STAT_NAMES = ('hits', 'misses', 'waits', 'stale', 'refreshes')
+
+_stats = dict.fromkeys(STAT_NAMES, 0)
+_stats_lock = threading.Lock()
+
+
+def _count(name):
+    with _stats_lock:
+        _stats[name] += 1
+
+
+def cache_stats():
+    """Return the number of cache hits, misses, waits for another process'
+    computation, stale values served and (early) refreshes of get_or_compute
+    in this process."""
+    with _stats_lock:
+        return dict(_stats)
+
+
+def reset_cache_stats():
+    with _stats_lock:
+        _stats.update(dict.fromkeys(STAT_NAMES, 0))
+
+
+def _should_refresh_early(remaining, delta):
+    # probabilistic early expiration (XFetch), the closer the value is to
+    # expiring and the longer it takes to compute, the more likely a reader
+    # refreshes it in advance
+    beta = settings.CACHE_EARLY_REFRESH_BETA
+    return delta * beta * -math.log(1.0 - random.random()) >= remaining
+
+
+def _version_key(key):
+    return CACHE_VERSION_KEY_PATTERN.format(key)
+
+
+def _get_entry(key):
+    """Return the current version of the key and the entry cached under it,
+    or None if there's no entry for that version, with a single cache round
+    trip."""
+    version_key = _version_key(key)
+    cached = cache.get_many([key, version_key])
+    version = cached.get(version_key)
+    if version is None:
+        # never invalidated, or the version was evicted, start a new one,
+        # unless someone else just did
+        version = uuid4().hex
+        if not cache.add(version_key, version):
+            version = cache.get(version_key)
+        return version, None
+
+    entry = cached.get(key)
+    if entry is not None and entry[3] == version:
+        return version, entry
+    return version, None
+
+
+def _compute_and_set(key, compute, timeout, cacheable, version):
+    """Compute and cache the value for the version, then release the lock of
+    the key."""
+    try:
+        started = time.time()
+        value = compute()
+        delta = time.time() - started
+        if cacheable is None or cacheable(value):
+            # keep the value around for a while after it expired, to be
+            # served while it's being refreshed
+            cache.set(key,
+                      (value, time.time() + timeout, delta, version),
+                      timeout + settings.CACHE_STALE_SECONDS)
+        else:
+            cache.delete(key)
+    finally:
+        cache.delete(CACHE_LOCK_KEY_PATTERN.format(key))
+    return value
+
+
+def get_or_compute(key, compute, timeout=CONVERSATION_CACHE_TIMEOUT,
+                   cacheable=None):
+    """Return the value cached under the key, or compute and cache it,
+    without letting concurrent readers stampede the database:
+
+    - a missing value is computed by a single process holding a cache lock,
+      while the others wait for the result
+    - values are refreshed early, with a probability growing as they get
+      closer to expiring
+    - expired values are served for another CACHE_STALE_SECONDS while one
+      process refreshes them
+
+    Values are invalidated with `invalidate`, which starts a new version of
+    the key. Values cached for an earlier version are never served, not even
+    stale, including the ones which were still being computed during the
+    invalidation.
+
+    :param key: The cache key
+    :param compute: A callable without arguments returning the value
+    :param timeout: Number of seconds the value is fresh for
+    :param cacheable: Optional, a callable which tells whether a computed
+                      value may be cached"""
+    lock_key = CACHE_LOCK_KEY_PATTERN.format(key)
+    version, entry = _get_entry(key)
+    if entry is not None:
+        value, expires_at, delta, version = entry
+        remaining = expires_at - time.time()
+        if remaining > 0 and not _should_refresh_early(remaining, delta):
+            _count('hits')
+            return value
+
+        if not cache.add(lock_key, True, settings.CACHE_LOCK_TIMEOUT):
+            # someone else is already refreshing it
+            _count('hits' if remaining > 0 else 'stale')
+            return value
+
+        _count('refreshes')
+        return _compute_and_set(key, compute, timeout, cacheable, version)
+
+    _count('misses')
+    deadline = time.time() + settings.CACHE_LOCK_WAIT
+    waited = False
+    while not cache.add(lock_key, True, settings.CACHE_LOCK_TIMEOUT):
+        if not waited:
+            _count('waits')
+            waited = True
+        if time.time() >= deadline:
+            # the process holding the lock is too slow or died
+            return compute()
+
+        time.sleep(settings.CACHE_LOCK_POLL_INTERVAL)
+        version, entry = _get_entry(key)
+        if entry is not None:
+            return entry[0]
+
+    if waited:
+        version, entry = _get_entry(key)
+        if entry is not None:
+            # it was computed while the lock was being acquired
+            cache.delete(lock_key)
+            return entry[0]
+    return _compute_and_set(key, compute, timeout, cacheable, version)
+
+
+def invalidate(keys):
+    """Invalidate the values cached under the keys by get_or_compute, with a
+    single round trip for the versions and another one for the values."""
+    keys = list(keys)
+    if keys:
+        version = uuid4().hex
+        cache.set_many(dict((_version_key(key), version) for key in keys))
+        cache.delete_many(keys)
+
+
+def clear_history_cache(conversation_ids):
+    """Invalidate the cached latest history pages of the conversations."""
+    invalidate(CONVERSATION_CACHE_KEY_PATTERN.format(cid)
+               for cid in conversation_ids)
+
+
+def clear_history_cache_of(conversation_id, message_id):
+    """Invalidate the cached latest history page of the conversation, unless
+    it's cached without the message."""
+    key = CONVERSATION_CACHE_KEY_PATTERN.format(conversation_id)
+    version, entry = _get_entry(key)
+    if entry is None or any(m.pk == message_id for m in entry[0]):
+        # a page being computed may hold the message
+        invalidate([key])
+
+
+def member_key(conversation_id, user_id):
+    return MEMBER_CACHE_KEY_PATTERN.format(conversation_id, user_id)
+
+
+def member_count_key(conversation_id):
+    return MEMBER_COUNT_CACHE_KEY_PATTERN.format(conversation_id)
+
+
+def clear_membership_cache(conversation_ids, user_ids):
+    """Invalidate the cached membership of the users and the member counts
+    of the conversations, after the users joined or left them."""
+    keys = [member_count_key(cid) for cid in conversation_ids]
+    keys.extend(member_key(cid, uid)
+                for cid in conversation_ids
+                for uid in user_ids)
+    invalidate(keys)
+
+
+def inbox_generation_key(user_id):
+    return INBOX_GENERATION_CACHE_KEY_PATTERN.format(user_id)
+
+
+def inbox_key(user_id, page, page_size):
+    return INBOX_CACHE_KEY_PATTERN.format(user_id, page, page_size)
+
+
+def bump_inbox_generations(user_ids):
+    """Start a new generation of the users' inboxes, which makes all of their
+    cached inbox pages stale, with a single cache round trip."""
+    generation = uuid4().hex
+    keys = set(inbox_generation_key(uid) for uid in user_ids)
+    if keys:
+        cache.set_many(dict((key, generation) for key in keys))
+
+
+def get_inbox_page(user_id, page, page_size):
+    """Return the current generation of the user's inbox and the cached page
+    of it, or None if the page wasn't cached for that generation. Both are
+    fetched with a single cache round trip."""
+    generation_key = inbox_generation_key(user_id)
+    key = inbox_key(user_id, page, page_size)
+    cached = cache.get_many([generation_key, key])
+    generation = cached.get(generation_key)
+    if generation is None:
+        # the inbox wasn't touched since the generation was evicted, start a
+        # new one, unless someone else just did
+        generation = uuid4().hex
+        if not cache.add(generation_key, generation):
+            generation = cache.get(generation_key)
+        return generation, None
+
+    entry = cached.get(key)
+    if entry is not None and entry[0] == generation:
+        return generation, entry[1]
+    return generation, None
+
+
+def set_inbox_page(user_id, page, page_size, generation, participations):
+    """Cache a page of the user's inbox computed for the generation."""
+    if generation is not None:
+        cache.set(inbox_key(user_id, page, page_size),
+                  (generation, participations),
+                  INBOX_CACHE_TIMEOUT)
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""Transparent compression of large message bodies.
+
+With MESSAGE_COMPRESSION_THRESHOLD set, bodies of at least that many
+characters are stored zlib compressed (and base64 encoded, so the column can
+stay a text column), behind a marker no sane text starts with. Stored values
+are decompressed lazily, when the body of a loaded message is first
+accessed, so listings that only show the uncompressed `preview` never pay
+for it. Bodies stored before compression was enabled stay readable, and the
+compress_messages management command compresses them in batches.
+
+A field can be limited to the databases where compressing it is safe, like
+message bodies, which are only compressed where the search backend indexes
+the decompressed text itself, see `talkalot.search`.
+"""
+from __future__ import unicode_literals
+
+import base64
+import binascii
+import re
+import zlib
+
+from django.db import models, router
+from django.utils.encoding import force_text
+from django.utils.text import Truncator
+
+from . import settings
+from .utils import atomic
+
+
+# a unicode noncharacter, reserved for internal use
+MARKER = '\ufdd0z'
+
+WHITESPACE_RE = re.compile(r'\s+', re.UNICODE)
+
+
+def is_compressed(value):
+    return value is not None and value.startswith(MARKER)
+
+
+def compress_text(value, level=None, compress=True):
+    """Return the stored form of the text, compressed if it's at least
+    MESSAGE_COMPRESSION_THRESHOLD long and compression saves space.
+
+    :param compress: If False, only text starting with the marker is
+                     compressed, so it isn't mistaken for a compressed value
+    """
+    threshold = settings.MESSAGE_COMPRESSION_THRESHOLD
+    if value is None:
+        return value
+    if not is_compressed(value) and (not compress or threshold is None or
+                                     len(value) < threshold):
+        return value
+
+    if level is None:
+        level = settings.MESSAGE_COMPRESSION_LEVEL
+    data = zlib.compress(value.encode('utf-8'), level)
+    compressed = MARKER + force_text(base64.b64encode(data))
+    # text starting with the marker is always compressed, so it can't be
+    # mistaken for a compressed value
+    if len(compressed) < len(value) or is_compressed(value):
+        return compressed
+    return value
+
+
+def decompress_text(value):
+    """Return the text of a stored value, which may or may not be
+    compressed."""
+    if not is_compressed(value):
+        return value
+    try:
+        data = base64.b64decode(value[len(MARKER):].encode('ascii'))
+        return zlib.decompress(data).decode('utf-8')
+    except (binascii.Error, TypeError, ValueError, zlib.error):
+        # not a compressed value after all
+        return value
+
+
+def make_preview(text, length=None):
+    """Return the first characters of the text, with runs of whitespace
+    collapsed, to be shown in listings."""
+    if length is None:
+        length = settings.MESSAGE_PREVIEW_LENGTH
+    text = WHITESPACE_RE.sub(' ', text or '').strip()
+    return Truncator(text).chars(length)
+
+
+class LazyDecompressor(object):
+    """Keeps the value as stored until it's first read."""
+
+    def __init__(self, field):
+        self.field = field
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        value = instance.__dict__.get(self.field.attname)
+        if is_compressed(value):
+            value = decompress_text(value)
+            instance.__dict__[self.field.attname] = value
+        return value
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.field.attname] = value
+
+
+class CompressedTextField(models.TextField):
+    """A text field whose large values are stored compressed. Exact lookups
+    work on compressed values as well, pattern lookups don't.
+
+    :param compressible: Optional, a function called with the model and the
+                         alias of a database, returning whether the values
+                         may be compressed in that database"""
+
+    def __init__(self, *args, **kwargs):
+        self.compressible = kwargs.pop('compressible', None)
+        super(CompressedTextField, self).__init__(*args, **kwargs)
+
+    def contribute_to_class(self, cls, name, *args, **kwargs):
+        super(CompressedTextField, self).contribute_to_class(cls, name,
+                                                             *args, **kwargs)
+        setattr(cls, self.name, LazyDecompressor(self))
+
+    def stored_value(self, value, using):
+        """Return the form the value is stored in the database."""
+        compress = (self.compressible is None or
+                    self.compressible(self.model, using))
+        return compress_text(value, compress=compress)
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        value = super(CompressedTextField, self).get_db_prep_value(
+            value,
+            connection,
+            prepared
+        )
+        return self.stored_value(value, connection.alias)
+
+
+class PreviewField(models.CharField):
+    """The uncompressed beginning of the text of another field, updated
+    whenever the row is saved or bulk created."""
+
+    def __init__(self, source, *args, **kwargs):
+        self.source = source
+        kwargs.setdefault('max_length', settings.MESSAGE_PREVIEW_LENGTH)
+        kwargs.setdefault('blank', True)
+        kwargs.setdefault('editable', False)
+        super(PreviewField, self).__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super(PreviewField, self).deconstruct()
+        kwargs['source'] = self.source
+        return name, path, args, kwargs
+
+    def pre_save(self, model_instance, add):
+        value = make_preview(getattr(model_instance, self.source),
+                             self.max_length)
+        setattr(model_instance, self.attname, value)
+        return value
+
+
+def compress_stored(model, batch_size, using=None):
+    """Rewrite the rows of the model whose body should be compressed (or
+    whose preview is missing) in batches of batch_size, each in it's own
+    transaction, reading the stored values without instantiating the models.
+    Yields the number of rows rewritten in each batch.
+
+    :param model: Message or ArchivedMessage
+    :param using: Optional, alias of the database of the rows"""
+    has_preview = any(f.name == 'preview' for f in model._meta.fields)
+    field = model._meta.get_field('body')
+    alias = using or router.db_for_write(model)
+    fields = ['pk', 'body'] + (['preview'] if has_preview else [])
+    rows = model.objects.using(using).order_by('pk')
+    last_pk = None
+    while True:
+        with atomic(using=using):
+            batch = rows
+            if last_pk is not None:
+                batch = batch.filter(pk__gt=last_pk)
+            batch = list(batch.values(*fields)[:batch_size])
+            count = 0
+            for row in batch:
+                stored = row['body']
+                text = decompress_text(stored)
+                changes = {}
+                if field.stored_value(text, alias) != stored:
+                    changes['body'] = text
+                if has_preview and not row['preview'] and text:
+                    changes['preview'] = make_preview(text)
+                if changes:
+                    model.objects.using(using).filter(
+                        pk=row['pk']
+                    ).update(**changes)
+                    count += 1
+
+        if not batch:
+            return
+        last_pk = batch[-1]['pk']
+        yield count
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""Digests of the unread conversations of every user, e.g. for daily emails.
+
+The unread participations are read in keyset paginated chunks ordered by
+user. The messages of each chunk's conversations are picked from narrow rows
+read with a single query, and only the ones making it into the digests are
+loaded with their bodies, so building the digests of all users takes a few
+large queries instead of a couple of queries per user. Ranges of user ids
+can be processed in parallel processes, see `user_ranges` and the
+send_unread_digests management command. With sharding, the digests of every
+shard are merged, so users get a single digest of all their conversations.
+"""
+from __future__ import unicode_literals
+
+import heapq
+
+from collections import namedtuple
+
+from django.db.models import Max, Min, Q
+
+from . import sharding
+from .models import Message, Participation
+from .settings import DIGEST_BATCH_SIZE, DIGEST_MESSAGES_PER_CONVERSATION
+from .signals import unread_digest
+
+try:
+    # Django 1.5+
+    from django.contrib.auth import get_user_model
+except ImportError:
+    # Django < 1.5
+    def get_user_model():
+        from django.contrib.auth.models import User
+        return User
+
+
+# conversations is a list of the unread conversations, messages maps their
+# ids to the latest unread messages, newest first
+Digest = namedtuple('Digest', 'user conversations messages')
+
+# messages loaded with their bodies in one query
+MESSAGE_LOAD_BATCH_SIZE = 500
+
+
+def unread_participations(since, first_user=None, last_user=None,
+                          using=None):
+    """Return a queryset of the active, not muted participations with
+    messages received since the cutoff which were not read yet, of the users
+    whose ids are in the [first_user, last_user) range."""
+    participations = Participation.objects.using(using).filter(
+        deleted_at__isnull=True,
+        muted=False,
+        unread_count__gt=0,
+        conversation__latest_message__sent_at__gte=since
+    )
+    if first_user is not None:
+        participations = participations.filter(user__gte=first_user)
+    if last_user is not None:
+        participations = participations.filter(user__lt=last_user)
+    return participations
+
+
+def user_ranges(since, count):
+    """Split the ids of the users with unread messages received since the
+    cutoff into at most count [first, last) ranges of equal width."""
+    firsts, lasts = [], []
+    for using in sharding.databases():
+        bounds = unread_participations(since, using=using).aggregate(
+            first=Min('user'),
+            last=Max('user')
+        )
+        if bounds['first'] is not None:
+            firsts.append(bounds['first'])
+            lasts.append(bounds['last'])
+    if not firsts:
+        return []
+
+    first, last = min(firsts), max(lasts) + 1
+    width = max((last - first + count - 1) // count, 1)
+    return [(start, min(start + width, last))
+            for start in range(first, last, width)]
+
+
+def iter_digests(since, first_user=None, last_user=None,
+                 batch_size=DIGEST_BATCH_SIZE,
+                 message_limit=DIGEST_MESSAGES_PER_CONVERSATION,
+                 using=None):
+    """Yield a Digest of every user who has unread messages received since
+    the cutoff in the conversations of one database, in the order of the
+    user ids, see `iter_all_digests` for all the shards.
+
+    :param since: Datetime, only messages received after it are considered
+    :param first_user: Optional, the lowest user id included
+    :param last_user: Optional, the user id after the highest included one
+    :param batch_size: Number of participations fetched in one query
+    :param message_limit: Maximum number of messages per conversation
+    :param using: Optional, the database alias of the conversations"""
+    participations = (unread_participations(since, first_user, last_user,
+                                            using)
+                      .select_related('conversation')
+                      .order_by('user', 'pk'))
+    last = None
+    pending = []
+    while True:
+        chunk = participations
+        if last is not None:
+            chunk = chunk.filter(Q(user__gt=last.user_id) |
+                                 Q(user=last.user_id, pk__gt=last.pk))
+        chunk = list(chunk[:batch_size])
+        rows = pending + chunk
+        if len(chunk) < batch_size:
+            for digest in build_digests(rows, since, message_limit, using):
+                yield digest
+            return
+
+        # the participations of the last user may continue in the next chunk
+        last = chunk[-1]
+        pending = [p for p in rows if p.user_id == last.user_id]
+        complete = [p for p in rows if p.user_id != last.user_id]
+        for digest in build_digests(complete, since, message_limit, using):
+            yield digest
+
+
+def build_digests(participations, since, message_limit, using=None):
+    """Build the digests of the participations, which are ordered by user,
+    with one query for the users, one for the candidate messages, and one
+    per MESSAGE_LOAD_BATCH_SIZE digested messages."""
+    if not participations:
+        return []
+
+    users = get_user_model().objects.in_bulk(
+        set(p.user_id for p in participations)
+    )
+    candidates = Message.objects.using(using).filter(
+        conversation__in=set(p.conversation_id for p in participations),
+        sent_at__gte=since,
+        deleted_at__isnull=True
+    )
+    watermarks = [p.read_watermark for p in participations]
+    if None not in watermarks and min(watermarks) >= since:
+        # everything older was read by all of them
+        candidates = candidates.filter(sent_at__gt=min(watermarks))
+    rows = {}
+    for pk, conversation_id, sender_id, sent_at in candidates.order_by(
+        'conversation', '-sent_at', '-id'
+    ).values_list('pk', 'conversation', 'sender', 'sent_at'):
+        rows.setdefault(conversation_id, []).append((pk, sender_id, sent_at))
+
+    unread = []
+    for participation in participations:
+        watermark = participation.read_watermark
+        pks = [pk for pk, sender_id, sent_at
+               in rows.get(participation.conversation_id, [])
+               if sender_id != participation.user_id and
+               (watermark is None or sent_at > watermark)]
+        unread.append(pks[:message_limit])
+
+    pks = sorted(set(pk for pks in unread for pk in pks))
+    messages = {}
+    for start in range(0, len(pks), MESSAGE_LOAD_BATCH_SIZE):
+        messages.update(Message.objects.using(using).in_bulk(
+            pks[start:start + MESSAGE_LOAD_BATCH_SIZE]
+        ))
+
+    digests = []
+    for participation, pks in zip(participations, unread):
+        if not digests or digests[-1].user.pk != participation.user_id:
+            digests.append(Digest(users[participation.user_id], [], {}))
+
+        digest = digests[-1]
+        digest.conversations.append(participation.conversation)
+        digest.messages[participation.conversation_id] = [messages[pk]
+                                                          for pk in pks]
+    return digests
+
+
+def _keyed_by_user(index, digests):
+    # the index of the shard breaks the ties, the digests aren't comparable
+    for digest in digests:
+        yield digest.user.pk, index, digest
+
+
+def iter_all_digests(since, first_user=None, last_user=None,
+                     batch_size=DIGEST_BATCH_SIZE,
+                     message_limit=DIGEST_MESSAGES_PER_CONVERSATION):
+    """Yield a Digest of every user who has unread messages received since
+    the cutoff, in the order of the user ids, with the conversations of
+    every shard, see iter_digests."""
+    streams = [_keyed_by_user(index, iter_digests(since, first_user,
+                                                  last_user, batch_size,
+                                                  message_limit, using))
+               for index, using in enumerate(sharding.databases())]
+    merged = None
+    for user_id, index, digest in heapq.merge(*streams):
+        if merged is not None and merged.user.pk == user_id:
+            merged.conversations.extend(digest.conversations)
+            merged.messages.update(digest.messages)
+            continue
+        if merged is not None:
+            yield merged
+        merged = digest
+    if merged is not None:
+        yield merged
+
+
+def send_digests(since, first_user=None, last_user=None,
+                 batch_size=DIGEST_BATCH_SIZE):
+    """Fire the unread_digest signal with each digest of the user range,
+    see iter_all_digests. Returns the number of digests sent."""
+    count = 0
+    for digest in iter_all_digests(since, first_user, last_user, batch_size):
+        unread_digest.send(sender=Participation,
+                           user=digest.user,
+                           conversations=digest.conversations,
+                           messages=digest.messages)
+        count += 1
+    return count
+
+
+def _send_digests(args):
+    # entry point of the worker processes
+    return send_digests(*args)
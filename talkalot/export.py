@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""Streaming export of everything a user sent and received, as JSON Lines.
+
+Every line is a JSON object with a `type` of either `participation`,
+`message` or `archived_message`. Only the messages the user could see are
+exported: the ones sent before the user left a conversation, and neither
+deleted nor expired. Rows are read in keyset paginated batches
+without instantiating models, so memory usage doesn't depend on the amount
+of data exported. With sharding, the rows of every shard are written one
+shard after the other.
+"""
+from __future__ import unicode_literals
+
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import F, Q
+from django.utils.encoding import force_text
+
+from . import sharding
+from .compression import decompress_text
+from .managers import unexpired
+from .models import ArchivedMessage, Message, Participation
+from .settings import EXPORT_BATCH_SIZE, PRIMARY_DATABASE
+from .utils import iterate_in_batches
+
+
+PARTICIPATION_FIELDS = ('pk', 'conversation', 'read_at', 'replied_at',
+                        'deleted_at')
+MESSAGE_FIELDS = ('pk', 'conversation', 'parent', 'sender',
+                  'sender__username', 'sent_at', 'body')
+
+
+def export_user_data(user, stream, batch_size=EXPORT_BATCH_SIZE):
+    """Write the user's participations and the messages of the conversations
+    the user ever participated in, up to when the user left them, to the
+    stream, one JSON object per line. Returns the number of rows written.
+
+    :param user: A User object
+    :param stream: A file-like object opened for writing text
+    :param batch_size: Number of rows fetched in one query"""
+    rows = 0
+    usernames = {}
+    for using in sharding.databases():
+        for type_name, queryset, fields in sources_of(user, using):
+            for row in iterate_in_batches(queryset.values(*fields),
+                                          batch_size):
+                row['type'] = type_name
+                if 'body' in row:
+                    # values() returns the body as stored
+                    row['body'] = decompress_text(row['body'])
+                if 'sender' in row and sharding.is_enabled():
+                    row['sender__username'] = sender_name(usernames,
+                                                          row['sender'])
+                line = json.dumps(row, cls=DjangoJSONEncoder)
+                stream.write(force_text(line) + '\n')
+                rows += 1
+    return rows
+
+
+def sources_of(user, using):
+    """Return a list of (type name, queryset, fields) of the rows of the user
+    on the database (shard)."""
+    using = using or PRIMARY_DATABASE
+    participations = Participation.objects.using(using).filter(user=user)
+    sources = [('participation', participations, PARTICIPATION_FIELDS)]
+    # the user table can't be joined on the shards
+    fields = (MESSAGE_FIELDS if not sharding.is_enabled() else
+              tuple(f for f in MESSAGE_FIELDS if f != 'sender__username'))
+    archived = visible_to(ArchivedMessage.objects.using(using),
+                          participations)
+    sources.append(('archived_message', archived, fields))
+    messages = visible_to(Message.objects.using(using), participations)
+    # tombstones and expired messages aren't shown to anyone
+    messages = unexpired(messages.filter(deleted_at__isnull=True))
+    sources.append(('message', messages, fields))
+    return sources
+
+
+def visible_to(messages, participations):
+    """Filter a queryset of messages (or archived messages) to those sent
+    into the conversations of the participations while they were active.
+
+    :param participations: A queryset of the participations of one user"""
+    # a single filter() call, so all conditions are on the same participation
+    return messages.filter(
+        Q(conversation__participations__deleted_at__isnull=True) |
+        Q(sent_at__lte=F('conversation__participations__deleted_at')),
+        conversation__participations__in=participations.values('pk')
+    )
+
+
+def sender_name(usernames, user_id):
+    if user_id not in usernames:
+        user = sharding.users_by_pk([user_id]).get(user_id)
+        usernames[user_id] = user.username if user is not None else None
+    return usernames[user_id]
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""High-throughput import of historic messages, e.g. when migrating from
+another messaging system.
+
+Instead of sending every message through `Message.send_to_users`, with it's
+permission checks, conversation lookups, signals and read state updates, the
+importer assigns primary keys itself and writes conversations, messages and
+participations with `bulk_create` in large batches, so no post_save handlers
+run. Meant to be run while nothing else writes to talkalot's tables, and
+only without sharding, as it allocates the conversation ids itself.
+"""
+from __future__ import unicode_literals
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.color import no_style
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.models import Count, Max
+try:
+    from django.db.transaction import atomic
+except ImportError:
+    from django.db.transaction import commit_on_success as atomic
+
+from . import sharding
+from .models import ArchivedMessage, Conversation, Message, Participation
+from .search import get_search_backend
+from .settings import IMPORT_BATCH_SIZE
+
+
+class ImportedConversation(object):
+
+    def __init__(self, pk, user_ids):
+        self.pk = pk
+        self.user_ids = user_ids
+        self.latest_message_id = None
+        self.latest_sent_at = None
+        # user id -> when the user sent his/her latest message
+        self.replied_at = {}
+
+
+class BulkImporter(object):
+    """Imports a stream of records, each being a (participants, sender,
+    sent_at, body) tuple, where participants is a list of users (or user
+    ids), and sender is one of them. Every distinct set of participants
+    becomes a new conversation, and the records of a conversation have to be
+    ordered by sent_at. Sets of participants who already have a conversation
+    are refused, as the history can't be merged into it.
+
+    All records are validated before anything is written, so an invalid
+    record leaves the database untouched. As the records are read twice,
+    they have to be a sequence, or an object iterating over them again on
+    each call of it's __iter__ (like the import_messages command's file),
+    not an iterator. A run interrupted while writing, e.g. by a database
+    error, leaves the batches written so far behind: delete the imported
+    conversations (primary keys from first_conversation_pk on) before
+    running the import again.
+
+    The messages are chained through `parent` as if they were sent one after
+    the other, `latest_message` points to the last one, and every
+    participant is considered as having read the whole imported history."""
+
+    def __init__(self, batch_size=IMPORT_BATCH_SIZE, using=DEFAULT_DB_ALIAS,
+                 reindex=True):
+        if sharding.is_enabled():
+            raise ImproperlyConfigured("The importer doesn't support "
+                                       "sharding.")
+        self.batch_size = batch_size
+        self.using = using
+        self.reindex = reindex
+        self.conversations = {}
+        self.pending_conversations = []
+        self.pending_messages = []
+
+    def next_pk(self, *models):
+        max_pks = [
+            model.objects.using(self.using).aggregate(max_pk=Max('pk'))
+            for model in models
+        ]
+        return max(result['max_pk'] or 0 for result in max_pks) + 1
+
+    def run(self, records):
+        """Import the records and return the number of imported messages.
+
+        :param records: Sequence of (participants, sender, sent_at, body)
+                        tuples, iterated twice
+        :raises: ValueError if a record can't be imported, before anything
+                 was written"""
+        if iter(records) is records:
+            raise TypeError("The records are read twice, they can't be an "
+                            "iterator.")
+        self.validate(records)
+
+        self.next_conversation_pk = self.first_conversation_pk = (
+            self.next_pk(Conversation)
+        )
+        # archived messages keep their primary keys
+        self.next_message_pk = self.next_pk(Message, ArchivedMessage)
+        count = 0
+
+        for participants, sender, sent_at, body in records:
+            self.add(participants, sender, sent_at, body)
+            count += 1
+            if len(self.pending_messages) >= self.batch_size:
+                self.flush()
+        self.flush()
+
+        self.finish()
+        return count
+
+    def validate(self, records):
+        """Check the records without writing anything.
+
+        :raises: ValueError for the first record which can't be imported"""
+        latest_sent_at = {}
+        for participants, sender, sent_at, body in records:
+            user_ids = self.user_ids(participants, sender)
+            if user_ids not in latest_sent_at:
+                if self.conversation_exists(user_ids):
+                    raise ValueError("A conversation between the users {0} "
+                                     "already exists.".format(
+                                         sorted(user_ids)
+                                     ))
+            elif sent_at < latest_sent_at[user_ids]:
+                raise ValueError("Records of a conversation have to be "
+                                 "ordered by sent_at.")
+            latest_sent_at[user_ids] = sent_at
+
+    def user_ids(self, participants, sender):
+        return frozenset([getattr(user, 'pk', user)
+                          for user in participants] +
+                         [getattr(sender, 'pk', sender)])
+
+    def add(self, participants, sender, sent_at, body):
+        """Queue a validated record for the next batch."""
+        sender_id = getattr(sender, 'pk', sender)
+        user_ids = self.user_ids(participants, sender)
+
+        conversation = self.conversations.get(user_ids)
+        if conversation is None:
+            conversation = ImportedConversation(self.next_conversation_pk,
+                                                user_ids)
+            self.next_conversation_pk += 1
+            self.conversations[user_ids] = conversation
+            self.pending_conversations.append(
+                Conversation(pk=conversation.pk, creator_id=sender_id)
+            )
+
+        message = Message(pk=self.next_message_pk,
+                          body=body,
+                          parent_id=conversation.latest_message_id,
+                          sender_id=sender_id,
+                          sent_at=sent_at,
+                          conversation_id=conversation.pk)
+        self.next_message_pk += 1
+        self.pending_messages.append(message)
+
+        conversation.latest_message_id = message.pk
+        conversation.latest_sent_at = sent_at
+        conversation.replied_at[sender_id] = sent_at
+
+    def conversation_exists(self, user_ids):
+        # same as Conversation.objects.for_participants, but with user ids
+        conversations = Conversation.objects.using(self.using).annotate(
+            participant_count=Count('participations')
+        )
+        for user_id in user_ids:
+            conversations = conversations.filter(participations__user=user_id)
+        return conversations.filter(participant_count=len(user_ids)).exists()
+
+    def flush(self):
+        # bulk_create lets auto_now_add overwrite sent_at, the imported
+        # values are written back afterwards
+        sent_at = [(message.sent_at, message.pk)
+                   for message in self.pending_messages]
+        with atomic(using=self.using):
+            if self.pending_conversations:
+                Conversation.objects.using(self.using).bulk_create(
+                    self.pending_conversations,
+                    batch_size=self.batch_size
+                )
+            if self.pending_messages:
+                Message.objects.using(self.using).bulk_create(
+                    self.pending_messages,
+                    batch_size=self.batch_size
+                )
+                self.set_sent_at(sent_at)
+        self.pending_conversations = []
+        self.pending_messages = []
+
+    def set_sent_at(self, sent_at):
+        connection = connections[self.using]
+        quote = connection.ops.quote_name
+        field = Message._meta.get_field('sent_at')
+        connection.cursor().executemany(
+            "UPDATE {0} SET {1} = %s WHERE {2} = %s".format(
+                quote(Message._meta.db_table),
+                quote(field.column),
+                quote(Message._meta.pk.column)
+            ),
+            [(field.get_db_prep_save(value, connection=connection), pk)
+             for value, pk in sent_at]
+        )
+
+    def participations(self):
+        for conversation in self.conversations.values():
+            for user_id in conversation.user_ids:
+                yield Participation(
+                    conversation_id=conversation.pk,
+                    user_id=user_id,
+                    read_at=conversation.latest_sent_at,
+                    read_watermark=conversation.latest_sent_at,
+                    replied_at=conversation.replied_at.get(user_id)
+                )
+
+    def finish(self):
+        participations = []
+        for participation in self.participations():
+            participations.append(participation)
+            if len(participations) >= self.batch_size:
+                self.create_participations(participations)
+                participations = []
+        self.create_participations(participations)
+
+        connection = connections[self.using]
+        cursor = connection.cursor()
+        with atomic(using=self.using):
+            # the imported messages got increasing primary keys in the order
+            # they were sent, so the latest one has the highest
+            cursor.execute(
+                "UPDATE {conversation} SET latest_message_id = ("
+                "SELECT MAX(id) FROM {message} "
+                "WHERE {message}.conversation_id = {conversation}.id) "
+                "WHERE id >= %s AND id < %s".format(
+                    conversation=Conversation._meta.db_table,
+                    message=Message._meta.db_table
+                ),
+                [self.first_conversation_pk, self.next_conversation_pk]
+            )
+            # make the sequences continue after the explicitly set keys
+            for sql in connection.ops.sequence_reset_sql(no_style(),
+                                                         [Conversation,
+                                                          Message]):
+                cursor.execute(sql)
+
+        imported = Conversation.objects.using(self.using).filter(
+            pk__gte=self.first_conversation_pk,
+            pk__lt=self.next_conversation_pk
+        )
+        for count in Conversation.rebuild_summaries(imported,
+                                                    self.batch_size):
+            pass
+
+        if self.reindex:
+            backend = get_search_backend(Message, self.using)
+            backend.rebuild(self.using)
+
+    def create_participations(self, participations):
+        if participations:
+            with atomic(using=self.using):
+                Participation.objects.using(self.using).bulk_create(
+                    participations
+                )
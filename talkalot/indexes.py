@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""Indexes of the participations, designed around the queries talkalot runs.
+
+Nearly every participation query is restricted to active participations
+(`deleted_at IS NULL`) of a user or of a conversation, so on databases
+supporting partial indexes (SQLite 3.8.0+ and PostgreSQL), the indexes only
+cover the active rows, and are smaller and cheaper to maintain than the left
+conversations would make them. On other databases, and older SQLite
+versions, composite indexes with deleted_at after the leading column serve
+the same queries.
+
+The members of a conversation are looked up through the index of the
+unique (conversation, user) constraint.
+
+The due scheduled messages are looked up through an index on (status,
+due_at), with equality on status first so the already sent messages aren't
+scanned. It's created the same way, as Django < 1.5 can't declare it with
+index_together.
+
+The indexes are created after the tables, by the post_migrate (post_syncdb)
+handler. The single-column indexes on read_at, replied_at and deleted_at,
+which no query could use well, aren't declared anymore, and the
+migrate_participation_indexes management command drops them from existing
+databases.
+"""
+from __future__ import unicode_literals
+
+import sqlite3
+
+from django.db import connections
+
+
+PARTIAL_INDEX_VENDORS = ('sqlite', 'postgresql')
+
+# partial indexes appeared in SQLite 3.8.0
+SQLITE_PARTIAL_INDEX_VERSION = (3, 8, 0)
+
+ACTIVE = 'deleted_at IS NULL'
+
+# (name, columns, condition): the inbox, pinned conversations first; the
+# unread queries and counters
+PARTICIPATION_INDEXES = (
+    ('talkalot_participation_active_inbox', ('user_id', 'pinned'), ACTIVE),
+    ('talkalot_participation_active_unread',
+     ('user_id', 'muted', 'unread_count'), ACTIVE),
+)
+
+# column lists of indexes declared by earlier releases
+LEGACY_INDEX_COLUMNS = (
+    ['read_at'],
+    ['replied_at'],
+    ['deleted_at'],
+)
+
+# (name, columns) of the index of the due scheduled messages
+SCHEDULED_MESSAGE_INDEX = ('talkalot_scheduledmessage_due',
+                           ('status', 'due_at'))
+
+POSTGRESQL_INDEXES_SQL = (
+    "SELECT c.relname, a.attname FROM ("
+    "SELECT indexrelid, indrelid, indkey, "
+    "generate_series(0, indnatts - 1) AS n FROM pg_index "
+    "WHERE NOT indisunique AND NOT indisprimary) i "
+    "JOIN pg_class c ON c.oid = i.indexrelid "
+    "JOIN pg_class t ON t.oid = i.indrelid "
+    "JOIN pg_attribute a ON a.attrelid = t.oid AND a.attnum = i.indkey[i.n] "
+    "WHERE t.relname = %s ORDER BY c.relname, i.n"
+)
+
+
+def get_table():
+    from .models import Participation
+    return Participation._meta.db_table
+
+
+def supports_partial_indexes(using):
+    vendor = connections[using].vendor
+    if vendor == 'sqlite':
+        return sqlite3.sqlite_version_info >= SQLITE_PARTIAL_INDEX_VERSION
+    return vendor in PARTIAL_INDEX_VENDORS
+
+
+def index_definitions(using):
+    """Return a list of (name, columns, condition) of the indexes for the
+    database, condition being None for plain composite indexes."""
+    if supports_partial_indexes(using):
+        return list(PARTICIPATION_INDEXES)
+
+    definitions = []
+    for name, columns, condition in PARTICIPATION_INDEXES:
+        columns = (columns[0], 'deleted_at') + tuple(columns[1:])
+        definitions.append((name, columns, None))
+    return definitions
+
+
+def existing_indexes(using, table=None):
+    """Return a dict mapping the names of the table's non-unique indexes to
+    their column lists.
+
+    :param table: Optional, the participation table by default"""
+    connection = connections[using]
+    cursor = connection.cursor()
+    table = table or get_table()
+    indexes = {}
+    if connection.vendor == 'sqlite':
+        cursor.execute("PRAGMA index_list({0})".format(
+            connection.ops.quote_name(table)
+        ))
+        for row in cursor.fetchall():
+            name, unique = row[1], row[2]
+            if not unique:
+                cursor.execute("PRAGMA index_info({0})".format(
+                    connection.ops.quote_name(name)
+                ))
+                indexes[name] = [info[2] for info in sorted(cursor.fetchall())]
+    elif connection.vendor == 'postgresql':
+        cursor.execute(POSTGRESQL_INDEXES_SQL, [table])
+        for name, column in cursor.fetchall():
+            indexes.setdefault(name, []).append(column)
+    elif connection.vendor == 'mysql':
+        cursor.execute("SHOW INDEX FROM {0}".format(
+            connection.ops.quote_name(table)
+        ))
+        # (table, non_unique, key_name, seq_in_index, column_name, ...)
+        for row in sorted(cursor.fetchall(), key=lambda row: row[3]):
+            if row[1]:
+                indexes.setdefault(row[2], []).append(row[4])
+    elif hasattr(connection.introspection, 'get_constraints'):
+        # Django 1.7+
+        constraints = connection.introspection.get_constraints(cursor, table)
+        indexes = dict((name, constraint['columns'])
+                       for name, constraint in constraints.items()
+                       if constraint['index'] and not constraint['unique'] and
+                       not constraint['primary_key'])
+    else:
+        raise NotImplementedError("Indexes of {0} databases can only be "
+                                  "introspected on Django 1.7+.".format(
+                                      connection.vendor
+                                  ))
+    return indexes
+
+
+def create_sql(using, name, columns, condition, table=None):
+    quote = connections[using].ops.quote_name
+    sql = "CREATE INDEX {0}{1} ON {2} ({3})".format(
+        'IF NOT EXISTS ' if supports_partial_indexes(using) else '',
+        quote(name),
+        quote(table or get_table()),
+        ', '.join(quote(column) for column in columns)
+    )
+    if condition is not None:
+        sql += " WHERE {0}".format(condition)
+    return sql
+
+
+def drop_sql(using, name):
+    quote = connections[using].ops.quote_name
+    if connections[using].vendor == 'mysql':
+        return "DROP INDEX {0} ON {1}".format(quote(name), quote(get_table()))
+    return "DROP INDEX {0}".format(quote(name))
+
+
+def migration_sql(using, drop_legacy=True):
+    """Return the list of statements creating the missing indexes, and
+    dropping the legacy ones if drop_legacy is True."""
+    existing = existing_indexes(using)
+    definitions = index_definitions(using)
+    statements = [create_sql(using, name, columns, condition)
+                  for name, columns, condition in definitions
+                  if name not in existing]
+    if drop_legacy:
+        wanted = [list(columns) for name, columns, condition in definitions]
+        for name, columns in sorted(existing.items()):
+            if columns in LEGACY_INDEX_COLUMNS and columns not in wanted:
+                statements.append(drop_sql(using, name))
+    return statements
+
+
+def setup_indexes(using):
+    """Create the missing indexes of the participations."""
+    cursor = connections[using].cursor()
+    for sql in migration_sql(using, drop_legacy=False):
+        cursor.execute(sql)
+
+
+def setup_scheduled_message_index(using):
+    """Create the index of the due scheduled messages if it's missing."""
+    from .models import ScheduledMessage
+    table = ScheduledMessage._meta.db_table
+    name, columns = SCHEDULED_MESSAGE_INDEX
+    if name not in existing_indexes(using, table):
+        connections[using].cursor().execute(
+            create_sql(using, name, columns, None, table)
+        )
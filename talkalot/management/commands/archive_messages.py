@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from datetime import timedelta
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.utils.timezone import now
+
+from ...models import ArchivedMessage
+from ...settings import MESSAGE_ARCHIVE_AFTER_DAYS, MESSAGE_ARCHIVE_BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = ("Moves messages older than the specified number of days from the "
+            "Message table into the archive, in batches.")
+    option_list = BaseCommand.option_list + (
+        make_option('--days',
+                    type='int',
+                    dest='days',
+                    default=MESSAGE_ARCHIVE_AFTER_DAYS,
+                    help='Archive messages older than this many days.'),
+        make_option('--batch-size',
+                    type='int',
+                    dest='batch_size',
+                    default=MESSAGE_ARCHIVE_BATCH_SIZE,
+                    help='Number of messages moved in one transaction.'),
+    )
+
+    def handle(self, *args, **options):
+        cutoff = now() - timedelta(days=options['days'])
+        verbosity = int(options.get('verbosity', 1))
+        total = 0
+
+        for count in ArchivedMessage.archive(cutoff, options['batch_size']):
+            total += count
+            if verbosity > 1:
+                self.stdout.write("Archived {0} messages.".format(total))
+
+        if verbosity:
+            self.stdout.write("Archived {0} messages sent before {1}.".format(
+                total,
+                cutoff
+            ))
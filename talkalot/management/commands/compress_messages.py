@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import time
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from ... import sharding
+from ...compression import compress_stored
+from ...models import ArchivedMessage, Message
+from ...settings import MESSAGE_COMPRESSION_BATCH_SIZE, PRIMARY_DATABASE
+
+
+class Command(BaseCommand):
+    help = ("Rewrites the stored message bodies according to the current "
+            "MESSAGE_COMPRESSION_THRESHOLD, in batches, and fills in the "
+            "missing previews. With compression disabled, it decompresses "
+            "the bodies.")
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size',
+                    type='int',
+                    dest='batch_size',
+                    default=MESSAGE_COMPRESSION_BATCH_SIZE,
+                    help='Number of messages read in one transaction.'),
+        make_option('--sleep',
+                    type='float',
+                    dest='sleep',
+                    default=0,
+                    help='Seconds to sleep between batches.'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        total = 0
+
+        for using in sharding.databases():
+            using = using or PRIMARY_DATABASE
+            for model in (Message, ArchivedMessage):
+                for count in compress_stored(model, options['batch_size'],
+                                             using):
+                    total += count
+                    if verbosity > 1:
+                        self.stdout.write(
+                            "Rewrote {0} messages.".format(total)
+                        )
+                    if options['sleep']:
+                        time.sleep(options['sleep'])
+
+        if verbosity:
+            self.stdout.write("Rewrote {0} messages.".format(total))
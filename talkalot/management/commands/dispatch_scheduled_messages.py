@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from ...models import ScheduledMessage
+from ...scheduling import run_dispatcher
+from ...settings import (SCHEDULED_DISPATCH_BATCH_SIZE,
+                         SCHEDULED_DISPATCH_INTERVAL)
+
+
+class Command(BaseCommand):
+    help = ("Sends the scheduled messages which are due, in batches. Keeps "
+            "running and sending them as they become due, unless --once is "
+            "given. Several dispatchers can run at the same time.")
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size',
+                    type='int',
+                    dest='batch_size',
+                    default=SCHEDULED_DISPATCH_BATCH_SIZE,
+                    help='Number of messages claimed at once.'),
+        make_option('--interval',
+                    type='float',
+                    dest='interval',
+                    default=SCHEDULED_DISPATCH_INTERVAL,
+                    help='Seconds to wait when no messages are due.'),
+        make_option('--once',
+                    action='store_true',
+                    dest='once',
+                    default=False,
+                    help='Exit after sending the currently due messages.'),
+    )
+
+    def handle(self, *args, **options):
+        self.verbosity = int(options.get('verbosity', 1))
+        self.total = 0
+
+        if options['once']:
+            for count in ScheduledMessage.dispatch_due(options['batch_size']):
+                self.report(count)
+        else:
+            try:
+                run_dispatcher(options['batch_size'],
+                               options['interval'],
+                               callback=self.report)
+            except KeyboardInterrupt:
+                pass
+
+        if self.verbosity:
+            self.stdout.write("Sent {0} scheduled messages.".format(
+                self.total
+            ))
+
+    def report(self, count):
+        self.total += count
+        if self.verbosity > 1:
+            self.stdout.write("Sent {0} scheduled messages.".format(
+                self.total
+            ))
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import io
+import time
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...export import export_user_data
+from ...settings import EXPORT_BATCH_SIZE
+
+try:
+    # Django 1.5+
+    from django.contrib.auth import get_user_model
+except ImportError:
+    # Django < 1.5
+    def get_user_model():
+        from django.contrib.auth.models import User
+        return User
+
+
+class Command(BaseCommand):
+    args = '<username>'
+    help = ("Exports every participation and message of the user as JSON "
+            "Lines, to the standard output or the specified file.")
+    option_list = BaseCommand.option_list + (
+        make_option('--output',
+                    dest='output',
+                    default=None,
+                    help='Path of the file the data is written to.'),
+        make_option('--batch-size',
+                    type='int',
+                    dest='batch_size',
+                    default=EXPORT_BATCH_SIZE,
+                    help='Number of rows fetched in one query.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Specify exactly one username.")
+
+        User = get_user_model()
+        username_field = getattr(User, 'USERNAME_FIELD', 'username')
+        try:
+            user = User.objects.get(**{username_field: args[0]})
+        except User.DoesNotExist:
+            raise CommandError("User {0} does not exist.".format(args[0]))
+
+        started = time.time()
+        if options['output']:
+            with io.open(options['output'], 'w', encoding='utf-8') as stream:
+                rows = export_user_data(user, stream, options['batch_size'])
+        else:
+            rows = export_user_data(user, self.stdout, options['batch_size'])
+        elapsed = time.time() - started
+
+        if int(options.get('verbosity', 1)):
+            # reported on stderr so it doesn't mix with the exported data
+            self.stderr.write("Exported {0} rows in {1:.2f}s ({2:.0f} rows/s)."
+                              .format(rows,
+                                      elapsed,
+                                      rows / elapsed if elapsed else 0))
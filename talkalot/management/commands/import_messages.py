@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import io
+import json
+import time
+
+from optparse import make_option
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+from django.utils.dateparse import parse_datetime
+
+from ...importer import BulkImporter
+from ...settings import IMPORT_BATCH_SIZE
+
+
+def read_records(stream):
+    for line in stream:
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        yield (record['participants'],
+               record['sender'],
+               parse_datetime(record['sent_at']),
+               record['body'])
+
+
+class RecordFile(object):
+    """The records of a JSON Lines file, read again on each iteration."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def __iter__(self):
+        with io.open(self.path, encoding='utf-8') as stream:
+            for record in read_records(stream):
+                yield record
+
+
+class Command(BaseCommand):
+    args = '<path>'
+    help = ("Bulk imports historic messages from a JSON Lines file. Each line "
+            "is an object with the participants (list of user ids), sender "
+            "(user id), sent_at (ISO 8601) and body keys, ordered by "
+            "sent_at.")
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size',
+                    type='int',
+                    dest='batch_size',
+                    default=IMPORT_BATCH_SIZE,
+                    help='Number of rows written in one transaction.'),
+        make_option('--database',
+                    dest='database',
+                    default=DEFAULT_DB_ALIAS,
+                    help='Database to import into.'),
+        make_option('--no-reindex',
+                    action='store_false',
+                    dest='reindex',
+                    default=True,
+                    help='Do not rebuild the search index afterwards.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Specify exactly one file to import.")
+
+        try:
+            importer = BulkImporter(batch_size=options['batch_size'],
+                                    using=options['database'],
+                                    reindex=options['reindex'])
+        except ImproperlyConfigured as exc:
+            raise CommandError(str(exc))
+        started = time.time()
+        try:
+            count = importer.run(RecordFile(args[0]))
+        except ValueError as exc:
+            raise CommandError("Nothing was imported: {0}".format(exc))
+        elapsed = time.time() - started
+
+        if int(options.get('verbosity', 1)):
+            self.stdout.write("Imported {0} messages in {1} conversations in "
+                              "{2:.2f}s ({3:.0f} rows/s).".format(
+                                  count,
+                                  len(importer.conversations),
+                                  elapsed,
+                                  count / elapsed if elapsed else 0
+                              ))
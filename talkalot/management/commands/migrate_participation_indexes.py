@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from ... import sharding
+from ...indexes import migration_sql
+from ...settings import PRIMARY_DATABASE
+
+
+class Command(BaseCommand):
+    help = ("Creates the missing indexes of the participations and drops "
+            "the single-column indexes declared by earlier releases, see "
+            "talkalot.indexes.")
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run',
+                    action='store_true',
+                    dest='dry_run',
+                    default=False,
+                    help='Only print the statements.'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        for using in sharding.databases():
+            using = using or PRIMARY_DATABASE
+            try:
+                statements = migration_sql(using)
+            except NotImplementedError as exc:
+                raise CommandError(str(exc))
+
+            cursor = connections[using].cursor()
+            for sql in statements:
+                if options['dry_run'] or verbosity > 1:
+                    self.stdout.write("{0}: {1};".format(using, sql))
+                if not options['dry_run']:
+                    cursor.execute(sql)
+
+            if verbosity and not options['dry_run']:
+                self.stdout.write("{0}: executed {1} statements.".format(
+                    using, len(statements)
+                ))
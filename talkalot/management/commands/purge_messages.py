@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import time
+
+from datetime import timedelta
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.timezone import now
+
+from ... import sharding
+from ...models import ArchivedMessage, Conversation, Message
+from ...settings import (MESSAGE_RETENTION_DAYS, PRIMARY_DATABASE,
+                         PURGE_BATCH_SIZE)
+
+
+class Command(BaseCommand):
+    help = ("Deletes messages older than the retention period and the "
+            "conversations abandoned by all of their participants, in "
+            "batches.")
+    option_list = BaseCommand.option_list + (
+        make_option('--days',
+                    type='int',
+                    dest='days',
+                    default=MESSAGE_RETENTION_DAYS,
+                    help='Delete messages older than this many days.'),
+        make_option('--batch-size',
+                    type='int',
+                    dest='batch_size',
+                    default=PURGE_BATCH_SIZE,
+                    help='Number of rows deleted in one transaction.'),
+        make_option('--sleep',
+                    type='float',
+                    dest='sleep',
+                    default=0,
+                    help='Seconds to sleep between batches.'),
+        make_option('--skip-conversations',
+                    action='store_false',
+                    dest='conversations',
+                    default=True,
+                    help='Do not delete abandoned conversations.'),
+    )
+
+    def handle(self, *args, **options):
+        if options['days'] is None:
+            raise CommandError("Specify the retention period with --days or "
+                               "the MESSAGE_RETENTION_DAYS setting.")
+
+        self.verbosity = int(options.get('verbosity', 1))
+        self.sleep = options['sleep']
+        batch_size = options['batch_size']
+        cutoff = now() - timedelta(days=options['days'])
+
+        for model in (ArchivedMessage, Message):
+            self.run(self.purge(model, cutoff, batch_size),
+                     "{0} objects sent before {1}".format(
+                         model._meta.object_name,
+                         cutoff
+                     ))
+
+        if options['conversations']:
+            self.run(Conversation.purge_abandoned(batch_size),
+                     "abandoned conversations")
+
+    def purge(self, model, cutoff, batch_size):
+        for using in sharding.databases():
+            using = using or PRIMARY_DATABASE
+            messages = model.objects.using(using).filter(sent_at__lt=cutoff)
+            for count in model.purge(messages, batch_size, using):
+                yield count
+
+    def run(self, batches, description):
+        total = 0
+        for count in batches:
+            total += count
+            if self.verbosity > 1:
+                self.stdout.write("Deleted {0} {1}.".format(total,
+                                                            description))
+            if self.sleep:
+                # give other transactions a chance to grab the locks
+                time.sleep(self.sleep)
+
+        if self.verbosity:
+            self.stdout.write("Deleted {0} {1}.".format(total, description))
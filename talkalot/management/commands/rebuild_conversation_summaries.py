@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from ... import sharding
+from ...models import Conversation
+from ...settings import CONVERSATION_SUMMARY_BATCH_SIZE, PRIMARY_DATABASE
+
+
+class Command(BaseCommand):
+    help = ("Recomputes the display summaries (participant names, member "
+            "count and latest message) of all conversations.")
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size',
+                    action='store',
+                    type='int',
+                    dest='batch_size',
+                    default=CONVERSATION_SUMMARY_BATCH_SIZE,
+                    help='Number of conversations updated per transaction.'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        for using in sharding.databases():
+            using = using or PRIMARY_DATABASE
+            conversations = Conversation.objects.using(using).all()
+            total = 0
+            for count in Conversation.rebuild_summaries(conversations,
+                                                        options['batch_size']):
+                total += count
+            if verbosity:
+                self.stdout.write("{0}: rebuilt {1} summaries.".format(
+                    using, total
+                ))
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+
+from ...models import Message
+from ...search import get_search_backend
+
+
+class Command(BaseCommand):
+    help = ("Re-indexes all messages for full-text search, e.g. after a bulk "
+            "import or purge.")
+    option_list = BaseCommand.option_list + (
+        make_option('--database',
+                    dest='database',
+                    default=DEFAULT_DB_ALIAS,
+                    help='Database whose index should be rebuilt.'),
+    )
+
+    def handle(self, *args, **options):
+        using = options['database']
+        backend = get_search_backend(Message, using)
+        backend.setup(using)
+        backend.rebuild(using)
+
+        if int(options.get('verbosity', 1)):
+            self.stdout.write("Rebuilt the search index with {0}.".format(
+                backend.__class__.__name__
+            ))
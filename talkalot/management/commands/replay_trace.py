@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ... import settings
+from ...tracing import TraceReplayer, read_trace
+
+
+class Command(BaseCommand):
+    args = '<trace file>'
+    help = ("Replays the API calls recorded into a trace file (see "
+            "talkalot.tracing) against the database, and reports the "
+            "throughput and latency percentiles of every operation.")
+    option_list = BaseCommand.option_list + (
+        make_option('--concurrency',
+                    type='int',
+                    dest='concurrency',
+                    default=1,
+                    help='Number of threads making the calls.'),
+        make_option('--speed',
+                    type='float',
+                    dest='speed',
+                    default=0,
+                    help='Follow the recorded pacing, sped up this many '
+                         'times. By default the calls are made as fast as '
+                         'possible.'),
+        make_option('--database',
+                    dest='database',
+                    default=None,
+                    help='The load test database the calls write to, it has '
+                         'to be listed in TRACE_REPLAY_DATABASES and be '
+                         'talkalot\'s PRIMARY_DATABASE.'),
+        make_option('--i-know',
+                    action='store_true',
+                    dest='i_know',
+                    default=False,
+                    help='Replay against whatever database talkalot writes '
+                         'to, without any check.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Specify the trace file to replay.")
+        if not options['i_know']:
+            self.check_database(options['database'])
+
+        try:
+            records = list(read_trace(args[0]))
+        except (IOError, ValueError) as exc:
+            raise CommandError("Can't read the trace: {0}".format(exc))
+
+        replayer = TraceReplayer(records,
+                                 concurrency=options['concurrency'],
+                                 speed=options['speed'] or None)
+        report = replayer.run()
+
+        self.stdout.write("Replayed {0} calls in {1:.2f}s ({2:.1f} "
+                          "calls/s).".format(len(records),
+                                             replayer.elapsed,
+                                             len(records) / max(
+                                                 replayer.elapsed, 1e-6
+                                             )))
+        self.stdout.write("{0:<22}{1:>8}{2:>8}{3:>10}{4:>10}{5:>10}{6:>10}"
+                          "{7:>10}".format('operation', 'calls', 'errors',
+                                           'calls/s', 'p50 ms', 'p90 ms',
+                                           'p99 ms', 'max ms'))
+        for operation in sorted(report):
+            stats = report[operation]
+            latencies = ''.join(
+                '{0:>10.2f}'.format(stats[name]) if stats[name] is not None
+                else '{0:>10}'.format('-')
+                for name in ('p50', 'p90', 'p99', 'max')
+            )
+            self.stdout.write("{0:<22}{1:>8}{2:>8}{3:>10.1f}{4}".format(
+                operation, stats['count'], stats['errors'],
+                stats['throughput'], latencies
+            ))
+
+    def check_database(self, database):
+        if database is None:
+            raise CommandError("The replay writes to the database, specify "
+                               "the load test database with --database.")
+        if database not in settings.TRACE_REPLAY_DATABASES:
+            raise CommandError("Refusing to replay against {0}, which isn't "
+                               "listed in TRACE_REPLAY_DATABASES.".format(
+                                   database
+                               ))
+        if database != settings.PRIMARY_DATABASE:
+            raise CommandError("The calls are written to {0}, talkalot's "
+                               "PRIMARY_DATABASE, not to {1}.".format(
+                                   settings.PRIMARY_DATABASE, database
+                               ))
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import multiprocessing
+import time
+
+from datetime import timedelta
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.utils.timezone import now
+
+from ...digest import _send_digests, send_digests, user_ranges
+from ...settings import DIGEST_BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = ("Sends the unread_digest signal for every user with unread "
+            "messages received in the last --hours, optionally splitting "
+            "the users among several worker processes.")
+    option_list = BaseCommand.option_list + (
+        make_option('--hours',
+                    type='float',
+                    dest='hours',
+                    default=24,
+                    help='Only messages received this many hours ago or '
+                         'later are digested.'),
+        make_option('--workers',
+                    type='int',
+                    dest='workers',
+                    default=1,
+                    help='Number of worker processes.'),
+        make_option('--batch-size',
+                    type='int',
+                    dest='batch_size',
+                    default=DIGEST_BATCH_SIZE,
+                    help='Number of participations fetched in one query.'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        since = now() - timedelta(hours=options['hours'])
+        workers = options['workers']
+        started = time.time()
+
+        if workers > 1:
+            # several ranges per worker, so a dense range doesn't hold up
+            # the others
+            ranges = [(since, first, last, options['batch_size'])
+                      for first, last in user_ranges(since, workers * 4)]
+            # the workers must not share the connections of this process
+            for connection in connections.all():
+                connection.close()
+            pool = multiprocessing.Pool(workers)
+            try:
+                total = 0
+                for count in pool.imap_unordered(_send_digests, ranges):
+                    total += count
+                    if verbosity > 1:
+                        self.stdout.write("Digested {0} users.".format(total))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            total = send_digests(since, batch_size=options['batch_size'])
+
+        if verbosity:
+            elapsed = time.time() - started
+            self.stdout.write(
+                "Digested {0} users in {1:.1f}s ({2:.1f} users/s).".format(
+                    total, elapsed, total / elapsed if elapsed else total
+                )
+            )
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import time
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from ...models import Message
+from ...settings import PURGE_BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = "Deletes the expired ephemeral messages, in batches."
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size',
+                    type='int',
+                    dest='batch_size',
+                    default=PURGE_BATCH_SIZE,
+                    help='Number of messages deleted in one transaction.'),
+        make_option('--sleep',
+                    type='float',
+                    dest='sleep',
+                    default=0,
+                    help='Seconds to sleep between batches.'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        total = 0
+
+        for count in Message.sweep_expired(options['batch_size']):
+            total += count
+            if verbosity > 1:
+                self.stdout.write("Deleted {0} expired messages.".format(
+                    total
+                ))
+            if options['sleep']:
+                # give other transactions a chance to grab the locks
+                time.sleep(options['sleep'])
+
+        if verbosity:
+            self.stdout.write("Deleted {0} expired messages.".format(total))
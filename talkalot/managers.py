@@ -1,56 +1,373 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-from django.core.cache import cache
+import operator
+
+from functools import reduce
+
 from django.db import models
 from django.db.models import Count, F, Q
+from django.utils.timezone import now
+
+from . import readmarkers, sharding
+from .caching import (bump_inbox_generations, clear_membership_cache,
+                      get_inbox_page, get_or_compute, set_inbox_page)
+from .routers import read_database_for, stick_to_primary, use_primary
+from .search import get_search_backend
+from .settings import (INBOX_CACHED_PAGES,
+                       INBOX_PAGE_SIZE,
+                       MESSAGE_SEARCH_PAGE_SIZE,
+                       PARTICIPANTS_CACHE_KEY_PATTERN,
+                       PRIVATE_CONVERSATION_MEMBER_COUNT)
+from .signals import conversations_left, conversations_read
+from .tracing import (describe_inbox_page, describe_leave, describe_user,
+                      traced)
+
+
+PARTICIPANTS_PREFETCH = 'participations__user'
+
 
-from .settings import PARTICIPANTS_CACHE_KEY_PATTERN
+def unexpired(messages):
+    """Filter a queryset of messages to those which haven't expired yet."""
+    return messages.filter(Q(expires_at__isnull=True) |
+                           Q(expires_at__gt=now()))
+
+
+def reading(manager, user=None, using=None):
+    """Return a queryset of the manager for a read-only query on behalf of
+    the user, on the explicitly requested database or the one appropriate
+    for the user."""
+    if user is not None:
+        using = read_database_for(user, using)
+    if using is None:
+        return manager.all()
+    return manager.using(using)
 
 
 class ConversationManager(models.Manager):
 
-    def for_participants(self, participants):
+    def with_participants(self):
+        """Query conversations along with all of their participations and the
+        participating users, prefetched in a fixed number of queries, so
+        participants, participant_names, has_participant, is_read_by and
+        is_private don't hit the database for each conversation."""
+        return self.prefetch_related(PARTICIPANTS_PREFETCH)
+
+    def for_participants(self, participants, using=None):
         """Query a specific conversation for a specified list of participants.
         If possible, retrieve it from cache (no invalidation required) as a
         unique set of participants can have only one conversation."""
+        if sharding.is_enabled():
+            # the directory is already a cheap lookup by participant set
+            user_ids = [user.pk for user in participants]
+            return sharding.conversations_for_participants(self, user_ids)
+
         user_ids = sorted(user.pk for user in participants)
         str_ids = '_'.join(str(uid) for uid in user_ids)
         key = PARTICIPANTS_CACHE_KEY_PATTERN.format(str_ids)
-        conversations = cache.get(key)
 
-        if conversations:
-            # retrieved from cache
-            return conversations
+        def query():
+            annotation = dict(participant_count=Count('participations'))
+            conversations = reading(self, using=using).annotate(**annotation)
 
-        # not found in cache, do the query
-        annotation = dict(participant_count=Count('participations'))
-        conversations = self.all().annotate(**annotation)
+            for user in participants:
+                condition = dict(participations__user=user)
+                conversations = conversations.filter(**condition)
 
-        for user in participants:
-            condition = dict(participations__user=user)
-            conversations = conversations.filter(**condition)
+            return conversations.filter(participant_count=len(participants))
 
-        qs = conversations.filter(participant_count=len(participants))
-        cache.set(key, qs)
-        return qs
+        # the conversation may not exist yet, so only found ones are cached
+        return get_or_compute(key, query, cacheable=bool)
 
-    def containing_participant(self, participant):
+    def containing_participant(self, participant, using=None):
         """Query conversations containing the specified participant."""
-        return self.all().filter(participations__user=participant)
+        conversations = reading(self, participant, using)
+        return conversations.filter(participations__user=participant)
 
 
 class ParticipationManager(models.Manager):
 
-    def inbox_for(self, user):
+    def inbox_for(self, user, using=None, with_participants=False):
         """Return a QuerySet of participations for a specific user, which
-        essentially represents that user's inbox."""
-        return self.filter(deleted_at__isnull=True, user=user)
+        essentially represents that user's inbox.
 
-    def unread_for(self, user):
+        :param with_participants: Optional, if True the conversations are
+                                  fetched along with their participants, like
+                                  with Conversation.objects.with_participants
+        """
+        participations = reading(self, user, using).filter(
+            deleted_at__isnull=True,
+            user=user
+        )
+        if with_participants:
+            participations = participations.select_related(
+                'conversation'
+            ).prefetch_related('conversation__' + PARTICIPANTS_PREFETCH)
+        return participations
+
+    @traced('inbox_page', describe_inbox_page)
+    def inbox_page(self, user, page=0, page_size=INBOX_PAGE_SIZE,
+                   using=None):
+        """Return a page of the user's inbox as a list of participations
+        along with their conversations and latest messages, the most recently
+        active conversations first, after the pinned ones. The first
+        INBOX_CACHED_PAGES pages are cached for the current generation of
+        the user's inbox, so until something changes in it they're served
+        with a single cache round trip.
+
+        :param user: A User object (request.user probably)
+        :param page: Zero based index of the page
+        :param page_size: Number of participations on a page"""
+        if page >= INBOX_CACHED_PAGES:
+            return self._inbox_page(user, page, page_size, using)
+
+        generation, participations = get_inbox_page(user.pk, page, page_size)
+        if participations is None:
+            participations = self._inbox_page(user, page, page_size, using)
+            set_inbox_page(user.pk, page, page_size, generation,
+                           participations)
+        return participations
+
+    def _inbox_page(self, user, page, page_size, using):
+        offset = page * page_size
+        if sharding.is_enabled():
+            inbox = sharding.inbox_for(user, limit=offset + page_size)
+            return inbox[offset:]
+
+        # the summaries of the conversations have all it takes to render them
+        participations = self.inbox_for(user, using).select_related(
+            'conversation'
+        ).order_by('-pinned', '-conversation__last_activity', '-conversation')
+        return list(participations[offset:offset + page_size])
+
+    def unread_for(self, user, using=None, with_participants=False,
+                   include_muted=False):
         """Return a users inbox, but filtered only for those conversations that
-        have not been read either completely or partially."""
-        return self.inbox_for(user).filter(
+        have not been read either completely or partially. Muted
+        conversations are left out, unless include_muted is True. With
+        sharding enabled and no explicit using, a list of the participations
+        from all shards is returned instead of a QuerySet."""
+        if sharding.is_enabled() and using is None:
+            return [p for participations in sharding.query_shards(
+                lambda shard: list(self.unread_for(user, shard,
+                                                   with_participants,
+                                                   include_muted))
+            ) for p in participations]
+
+        inbox = self.inbox_for(user, using, with_participants)
+        if not include_muted:
+            inbox = inbox.filter(muted=False)
+        unread = inbox.filter(
             Q(read_at__isnull=True) |
             Q(read_at__lt=F('conversation__latest_message__sent_at'))
         )
+        markers = readmarkers.pending_markers(user.pk)
+        if markers:
+            # conversations read since, according to the read markers which
+            # are not yet written to the database
+            read = [Q(conversation=conversation_id,
+                      conversation__latest_message__sent_at__lte=read_at)
+                    for conversation_id, read_at in markers.items()]
+            unread = unread.exclude(reduce(operator.or_, read))
+        return unread
+
+    @traced('unread_counts_for', describe_user)
+    def unread_counts_for(self, user, using=None):
+        """Return a dict mapping conversation ids to the number of messages
+        the user hasn't read yet in them. Only active, not muted conversations
+        with unread messages are included, and the whole inbox is served by a
+        single query (per shard) from the maintained counters."""
+        if not sharding.is_enabled() or using is not None:
+            return self.__unread_counts_for(user, using)
+
+        counts = {}
+        for shard_counts in sharding.query_shards(
+            lambda shard: self.__unread_counts_for(user, shard)
+        ):
+            counts.update(shard_counts)
+        return counts
+
+    def __unread_counts_for(self, user, using):
+        participations = self.inbox_for(user, using).filter(
+            muted=False,
+            unread_count__gt=0
+        ).order_by()
+        markers = readmarkers.pending_markers(user.pk)
+        if not markers:
+            return dict(participations.values_list('conversation',
+                                                   'unread_count'))
+
+        counts = {}
+        for conversation_id, count, sent_at in participations.values_list(
+            'conversation',
+            'unread_count',
+            'conversation__latest_message__sent_at'
+        ):
+            read_at = markers.get(conversation_id)
+            if read_at is None or sent_at is None or read_at < sent_at:
+                counts[conversation_id] = count
+        return counts
+
+    def mark_read(self, user, conversations=None):
+        """Mark multiple conversations as read by the user with a single
+        UPDATE (per shard), touching only the conversations which were
+        unread. Fires one conversations_read signal for the whole batch.
+
+        :param user: A User object (request.user probably)
+        :param conversations: Optional, a QuerySet or list of conversations.
+                              If omitted, the whole inbox is marked as read.
+        :returns: A list of the affected conversation ids."""
+        if conversations is None:
+            shards = [(using, None) for using in sharding.databases()]
+        else:
+            shards = sharding.group_by_shard(conversations)
+
+        conversation_ids = []
+        for using, shard_conversations in shards:
+            conversation_ids.extend(
+                self.__mark_read(user, shard_conversations, using)
+            )
+        if conversation_ids:
+            bump_inbox_generations([user.pk])
+            stick_to_primary(user)
+            conversations_read.send(sender=self.model,
+                                    user=user,
+                                    conversations=conversation_ids)
+        return conversation_ids
+
+    def __mark_read(self, user, conversations, using):
+        with use_primary():
+            participations = self.unread_for(user, using, include_muted=True)
+            if conversations is not None:
+                participations = participations.filter(
+                    conversation__in=conversations
+                )
+
+            conversation_ids = list(participations.order_by()
+                                                  .values_list('conversation',
+                                                               flat=True))
+        if conversation_ids:
+            read_at = now()
+            self.using(using).filter(
+                user=user,
+                conversation__in=conversation_ids
+            ).update(
+                read_at=read_at,
+                read_watermark=read_at,
+                unread_count=0
+            )
+        return conversation_ids
+
+    @traced('leave', describe_leave)
+    def leave(self, user, conversations):
+        """Revoke the user's participations in multiple conversations with a
+        single UPDATE (per shard). Private conversations can't be left, so
+        those are skipped, just like with Participation.revoke. Fires one
+        conversations_left signal for the whole batch.
+
+        :param user: A User object (request.user probably)
+        :param conversations: A QuerySet or list of conversations to leave.
+        :returns: A list of the affected conversation ids."""
+        conversation_ids = []
+        for using, shard_conversations in sharding.group_by_shard(
+            conversations
+        ):
+            conversation_ids.extend(
+                self.__leave(user, shard_conversations, using)
+            )
+        if conversation_ids:
+            Conversation, MembershipEvent = self.__related_models()
+            MembershipEvent.log(MembershipEvent.LEFT, conversation_ids,
+                                [user.pk])
+            Conversation.update_member_summaries(conversation_ids)
+            clear_membership_cache(conversation_ids, [user.pk])
+            bump_inbox_generations([user.pk])
+            stick_to_primary(user)
+            conversations_left.send(sender=self.model,
+                                    user=user,
+                                    conversations=conversation_ids)
+        return conversation_ids
+
+    def __related_models(self):
+        # models.py imports this module, so the Conversation and
+        # MembershipEvent models are reached through the relations instead
+        conversation = self.model._meta.get_field('conversation').rel.to
+        events = conversation._meta.get_field_by_name('membership_events')[0]
+        return conversation, events.model
+
+    def __leave(self, user, conversations, using):
+        with use_primary():
+            active = (self.inbox_for(user, using)
+                          .filter(conversation__in=conversations)
+                          .order_by()
+                          .values('conversation'))
+            member_counts = (reading(self, using=using)
+                             .filter(conversation__in=active)
+                             .order_by()
+                             .values('conversation')
+                             .annotate(member_count=Count('pk')))
+            # can't leave one-on-one conversations
+            conversation_ids = [
+                c['conversation'] for c in member_counts
+                if c['member_count'] != PRIVATE_CONVERSATION_MEMBER_COUNT
+            ]
+        if conversation_ids:
+            self.using(using).filter(
+                user=user,
+                deleted_at__isnull=True,
+                conversation__in=conversation_ids
+            ).update(deleted_at=now())
+        return conversation_ids
+
+
+class MessageManager(models.Manager):
+
+    def search(self, user, query, limit=MESSAGE_SEARCH_PAGE_SIZE, after=None,
+               using=None):
+        """Full-text search in the messages of conversations the user is
+        participating in, best matches first. Each returned message has a
+        `rank` attribute, the higher the better. With sharding enabled and
+        no explicit using, every shard is searched.
+
+        :param user: A User object (request.user probably)
+        :param query: The words to look for
+        :param limit: Maximum number of messages returned
+        :param after: Optional, the last message of the previous page, only
+                      worse matches will be returned
+        :param using: Optional, alias of the database to search in"""
+        if sharding.is_enabled() and using is None:
+            return self.__search_shards(user, query, limit, after)
+
+        cursor = (after.rank, after.pk) if after is not None else None
+        return self.__search(user, query, limit, cursor, using)
+
+    def __search(self, user, query, limit, cursor, using):
+        messages = unexpired(reading(self, user, using)).filter(
+            conversation__participations__user=user,
+            conversation__participations__deleted_at__isnull=True
+        )
+        backend = get_search_backend(self.model, messages.db)
+        return list(backend.search(messages, query, cursor)[:limit])
+
+    def __search_shards(self, user, query, limit, after):
+        # message ids are only unique per shard, so equally ranked messages
+        # with the same id are ordered by the position of their shard
+        shards = sharding.databases()
+
+        def position(message):
+            return (message.rank, message.pk, shards.index(message._state.db))
+
+        def search_shard(shard):
+            cursor = None
+            if after is not None:
+                rank, pk, after_shard = position(after)
+                if shards.index(shard) < after_shard:
+                    # the cursor's own rank and id come after it here
+                    pk += 1
+                cursor = (rank, pk)
+            return self.__search(user, query, limit, cursor, shard)
+
+        messages = [message for found in sharding.query_shards(search_shard)
+                    for message in found]
+        messages.sort(key=position, reverse=True)
+        return messages[:limit]
@@ -1,28 +1,82 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import logging
+
+from datetime import timedelta
+from functools import partial
+from uuid import uuid4
+
 from django.conf import settings
-from django.core.cache import cache
-from django.db import models
+from django.db import DEFAULT_DB_ALIAS, connections, models
+from django.db.models import F, Q
 from django.db.models.signals import post_save
+try:
+    from django.db.models.signals import post_migrate
+except ImportError:
+    # Django < 1.7
+    from django.db.models.signals import post_syncdb as post_migrate
 try:
     from django.db.transaction import atomic
 except ImportError:
     from django.db.transaction import commit_on_success as atomic
 
-from django.utils.encoding import python_2_unicode_compatible
+from django.utils.encoding import force_text, python_2_unicode_compatible
 from django.utils.timezone import now
 
 from .exceptions import MessagingPermissionDenied
-from .managers import ConversationManager, ParticipationManager
+from .managers import (ConversationManager, MessageManager,
+                       ParticipationManager, unexpired)
+from . import readmarkers, sharding
+from .caching import (bump_inbox_generations, clear_history_cache,
+                      clear_history_cache_of, clear_membership_cache,
+                      get_or_compute, member_count_key, member_key)
+from .compression import (CompressedTextField, PreviewField,
+                          decompress_text, make_preview)
+from .indexes import setup_indexes, setup_scheduled_message_index
+from .routers import stick_to_primary, use_primary
+from .search import allows_compression, get_search_backend
 from .settings import (PRIVATE_CONVERSATION_MEMBER_COUNT,
-                       CONVERSATION_CACHE_KEY_PATTERN)
+                       CONVERSATION_CACHE_KEY_PATTERN,
+                       CONVERSATION_HISTORY_PAGE_SIZE,
+                       CONVERSATION_SUMMARY_BATCH_SIZE,
+                       CONVERSATION_SUMMARY_NAMES,
+                       MEMBER_PAGE_SIZE,
+                       MEMBERSHIP_EVENT_BATCH_SIZE,
+                       MEMBERSHIP_EVENT_SETTLE_SECONDS,
+                       MESSAGE_ARCHIVE_BATCH_SIZE,
+                       MESSAGE_PREVIEW_LENGTH,
+                       PRIMARY_DATABASE,
+                       PURGE_BATCH_SIZE,
+                       SCHEDULED_CLAIM_TIMEOUT,
+                       SCHEDULED_DISPATCH_BATCH_SIZE)
 from .signals import message_sent
-from .utils import is_date_greater
+from .tracing import (describe_participants, describe_participation,
+                      describe_send_to_conversation, describe_send_to_users,
+                      traced)
+from .utils import delete_in_batches, delete_queryset, is_date_greater
 
 
 AUTH_USER_MODEL = getattr(settings, 'AUTH_USER_MODEL', 'auth.User')
 
+logger = logging.getLogger(__name__)
+
+
+def sent_before(messages, message):
+    """Filter a queryset of messages (or archived messages) to those which
+    come after the specified message in the newest first ordering, so it can
+    be used as a cursor for paging through the history."""
+    return messages.filter(Q(sent_at__lt=message.sent_at) |
+                           Q(sent_at=message.sent_at, pk__lt=message.pk))
+
+
+def sent_after(messages, message):
+    """The opposite of sent_before, filter a queryset of messages (or
+    archived messages) to those which come before the specified message in
+    the newest first ordering."""
+    return messages.filter(Q(sent_at__gt=message.sent_at) |
+                           Q(sent_at=message.sent_at, pk__gt=message.pk))
+
 
 @python_2_unicode_compatible
 class Participation(models.Model):
@@ -30,16 +84,27 @@ class Participation(models.Model):
                                      related_name='participations')
     user = models.ForeignKey(AUTH_USER_MODEL, related_name='participations')
     # messages in conversation seen at
-    read_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    read_at = models.DateTimeField(null=True, blank=True)
     # replied to conversation at
-    replied_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    replied_at = models.DateTimeField(null=True, blank=True)
     # deleted conversation at
-    deleted_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    deleted_at = models.DateTimeField(null=True, blank=True)
+    # number of messages received since the conversation was last read
+    unread_count = models.PositiveIntegerField(default=0)
+    # messages sent up to this time were read by the participant, unlike
+    # read_at it's not cleared when new messages are received
+    read_watermark = models.DateTimeField(null=True, blank=True)
+    # muted conversations don't count as unread
+    muted = models.BooleanField(default=False)
+    # pinned conversations come first in the inbox
+    pinned = models.BooleanField(default=False)
 
     objects = ParticipationManager()
 
     class Meta:
         ordering = ['conversation']
+        # the indexes of the queries on active participations are created
+        # by talkalot.indexes
         unique_together = ('conversation', 'user')
 
     def __str__(self):
@@ -51,28 +116,86 @@ class Participation(models.Model):
 
     @property
     def is_read(self):
-        return self.read_at is not None
+        if self.read_at is not None:
+            return True
+        # it may have been read, but not yet written to the database
+        read_at = readmarkers.pending_markers(self.user_id).get(
+            self.conversation_id
+        )
+        return (read_at is not None and
+                readmarkers.is_caught_up(self.conversation, read_at))
 
     def read_conversation(self):
-        """Mark the conversation as read by the participant who requested."""
+        """Mark the conversation as read by the participant who requested.
+        With READ_MARKER_WRITE_BEHIND enabled, it's written to the database
+        later, see talkalot.readmarkers."""
         self.read_at = now()
-        self.save()
-
+        self.read_watermark = self.read_at
+        self.unread_count = 0
+        if readmarkers.is_enabled():
+            readmarkers.record(self)
+        else:
+            self.save()
+        bump_inbox_generations([self.user_id])
+
+    def mute(self, muted=True):
+        """Mutes (or unmutes) the conversation for the participant, so it's
+        left out of unread_for and the unread counters."""
+        self.__update_flags(muted=muted)
+
+    def pin(self, pinned=True):
+        """Pins (or unpins) the conversation to the top of the participant's
+        inbox."""
+        self.__update_flags(pinned=pinned)
+
+    def __update_flags(self, **flags):
+        # a save would overwrite the concurrently bumped unread counter
+        for name, value in flags.items():
+            setattr(self, name, value)
+        self.__participations().update(**flags)
+        bump_inbox_generations([self.user_id])
+
+    def __participations(self):
+        using = sharding.database_for(self.conversation_id)
+        return Participation.objects.using(using).filter(pk=self.pk)
+
+    @traced('revoke', describe_participation)
     def revoke(self):
         """Sets the deleted_at field of the participation to the time when the
         member in question left the conversation or was kicked out of it."""
-        if self.conversation.is_private:
-            # can't leave one-on-one conversations
-            return
+        # the membership must not be decided by a lagging replica
+        with use_primary():
+            if self.conversation.is_private:
+                # can't leave one-on-one conversations
+                return
 
         self.deleted_at = now()
-        self.save()
-
+        # a save would overwrite the concurrently updated counters and flags,
+        # and only an actual change of the membership is logged
+        was_active = self.__participations().filter(
+            deleted_at__isnull=True
+        ).update(deleted_at=self.deleted_at)
+        if was_active:
+            MembershipEvent.log(MembershipEvent.LEFT, [self.conversation_id],
+                                [self.user_id])
+            Conversation.update_member_summaries([self.conversation_id])
+        clear_membership_cache([self.conversation_id], [self.user_id])
+        bump_inbox_generations([self.user_id])
+
+    @traced('reinstate', describe_participation)
     def reinstate(self):
         """Clears the deleted_at field of the participation, meaning the user
         re-joined the conversation."""
         self.deleted_at = None
-        self.save()
+        was_deleted = self.__participations().filter(
+            deleted_at__isnull=False
+        ).update(deleted_at=None)
+        if was_deleted:
+            MembershipEvent.log(MembershipEvent.REJOINED,
+                                [self.conversation_id], [self.user_id])
+            Conversation.update_member_summaries([self.conversation_id])
+        clear_membership_cache([self.conversation_id], [self.user_id])
+        bump_inbox_generations([self.user_id])
 
 
 @python_2_unicode_compatible
@@ -83,6 +206,20 @@ class Conversation(models.Model):
                                        blank=True)
     creator = models.ForeignKey(AUTH_USER_MODEL,
                                 related_name='created_conversation')
+    # messages sent into the conversation expire after this many seconds,
+    # unless a ttl is given when sending them
+    message_ttl = models.PositiveIntegerField(null=True, blank=True)
+    # summary for listings, maintained by the send and membership paths, so
+    # rendering an inbox doesn't touch the messages and the users: the
+    # names of the first few participants (newline separated), the number
+    # of active participants, and the preview, sender name and time of the
+    # latest message
+    summary_names = models.CharField(max_length=255, blank=True)
+    summary_member_count = models.PositiveIntegerField(default=0)
+    summary_preview = models.CharField(max_length=MESSAGE_PREVIEW_LENGTH,
+                                       blank=True)
+    summary_sender = models.CharField(max_length=255, blank=True)
+    last_activity = models.DateTimeField(null=True, blank=True)
 
     objects = ConversationManager()
 
@@ -98,57 +235,396 @@ class Conversation(models.Model):
         participations(when a user leaves a conversation) won't be included."""
         return self.participations.filter(deleted_at__isnull=True)
 
+    @property
+    def summary_participant_names(self):
+        """Returns the names of the first CONVERSATION_SUMMARY_NAMES
+        participants, in the order they joined, from the stored summary."""
+        return self.summary_names.split('\n') if self.summary_names else []
+
+    @staticmethod
+    def latest_summary(message):
+        """Returns the summary fields describing the message as the latest
+        one of it's conversation. The time of the last activity is kept when
+        the conversation is left without messages."""
+        if message is None:
+            return dict(summary_preview='', summary_sender='')
+        return dict(summary_preview=message.preview,
+                    summary_sender=message.sender.username,
+                    last_activity=message.sent_at)
+
+    @classmethod
+    def member_summary(cls, conversation_id, using):
+        """Returns the summary fields describing the active participants of
+        the conversation, and the list of their user ids."""
+        user_ids = list(Participation.objects.using(using).filter(
+            conversation=conversation_id,
+            deleted_at__isnull=True
+        ).order_by('pk').values_list('user', flat=True))
+        # the user table can't be joined on the shards
+        first = user_ids[:CONVERSATION_SUMMARY_NAMES]
+        users = sharding.users_by_pk(first)
+        names = [users[pk].username for pk in first if pk in users]
+        summary = dict(summary_names='\n'.join(names)[:255],
+                       summary_member_count=len(user_ids))
+        return summary, user_ids
+
+    @classmethod
+    def update_member_summaries(cls, conversation_ids):
+        """Updates the participant names and member counts in the summaries
+        of the conversations, after members joined or left them, and makes
+        the cached inboxes of their members, which show the summaries,
+        stale. Returns a dict mapping the conversation ids to the updated
+        fields."""
+        summaries = {}
+        members = set()
+        for conversation_id in conversation_ids:
+            using = sharding.database_for(conversation_id)
+            summary, user_ids = cls.member_summary(conversation_id, using)
+            cls.objects.using(using).filter(pk=conversation_id).update(
+                **summary
+            )
+            summaries[conversation_id] = summary
+            members.update(user_ids)
+        bump_inbox_generations(members)
+        return summaries
+
+    @classmethod
+    def rebuild_summaries(cls, conversations,
+                          batch_size=CONVERSATION_SUMMARY_BATCH_SIZE):
+        """Recomputes the whole summary of the conversations in batches of
+        batch_size, e.g. after an import. Yields the number of conversations
+        updated in each batch.
+
+        :param conversations: A QuerySet of conversations"""
+        using = conversations.db
+        conversations = conversations.select_related(
+            'latest_message'
+        ).order_by('pk')
+        last_pk = None
+        while True:
+            batch = conversations
+            if last_pk is not None:
+                batch = batch.filter(pk__gt=last_pk)
+            batch = list(batch[:batch_size])
+            if not batch:
+                return
+
+            # the senders are read separately, as the user table can't be
+            # joined on the shards
+            latest_messages = [c.latest_message for c in batch
+                               if c.latest_message is not None]
+            senders = sharding.users_by_pk(m.sender_id
+                                           for m in latest_messages)
+            for message in latest_messages:
+                message.sender = senders[message.sender_id]
+
+            members = set()
+            with atomic(using=using):
+                for conversation in batch:
+                    summary = cls.latest_summary(conversation.latest_message)
+                    member_summary, user_ids = cls.member_summary(
+                        conversation.pk,
+                        using
+                    )
+                    summary.update(member_summary)
+                    cls.objects.using(using).filter(pk=conversation.pk).update(
+                        **summary
+                    )
+                    members.update(user_ids)
+            bump_inbox_generations(members)
+            last_pk = batch[-1].pk
+            yield len(batch)
+
+    @traced('add_participants', describe_participants)
     def add_participants(self, participants):
         """Adds participants to an existing conversation.
 
         :param participants: A QuerySet or list of user objects, who will be
                              added to the conversation as participants."""
-        for user in participants:
-            participation, created = Participation.objects.get_or_create(
-                conversation=self,
-                user=user
-            )
-            if not created and participation.is_deleted:
-                # participation already exists and it was marked as deleted, so
-                # the user most likely left the conversation, but someone
-                # re-added him/her
-                participation.reinstate()
-
+        self.clear_prefetched_participations()
+        added = []
+        reinstated = []
+        # the memberships must not be decided by a lagging replica, and
+        # before Django 1.7 the related manager writes where it reads
+        with use_primary():
+            for user in participants:
+                participation, created = self.participations.get_or_create(
+                    user=user
+                )
+                if created:
+                    added.append(user.pk)
+                elif participation.is_deleted:
+                    # participation already exists and it was marked as
+                    # deleted, so the user most likely left the conversation,
+                    # but someone re-added him/her
+                    reinstated.append(user.pk)
+
+            if reinstated:
+                # same as Participation.reinstate, for all of them at once
+                self.participations.filter(user__in=reinstated).update(
+                    deleted_at=None
+                )
+
+        MembershipEvent.log(MembershipEvent.JOINED, [self.pk], added)
+        MembershipEvent.log(MembershipEvent.REJOINED, [self.pk], reinstated)
+        joined = added + reinstated
+        if joined:
+            # bumps the inboxes of all the members, the joined ones included
+            self.__update_member_summary()
+            clear_membership_cache([self.pk], joined)
+        if added and sharding.is_enabled():
+            sharding.register_participants(self)
+
+    @traced('remove_participants', describe_participants)
     def remove_participants(self, participants):
         """Removes participants from an existing conversation.
 
         :param participants: A QuerySet or list of user objects, whose
                              participations will be revoked."""
-        for user in participants:
-            participation = self.participations.get(user=user)
-            participation.revoke()
+        self.clear_prefetched_participations()
+        # the memberships must not be decided by a lagging replica, and
+        # before Django 1.7 the related manager writes where it reads
+        with use_primary():
+            if self.is_private:
+                # same as Participation.revoke, for all of them at once
+                return
+
+            user_ids = [user.pk for user in participants]
+            active = self.active_participations.filter(user__in=user_ids)
+            revoked = list(active.values_list('user', flat=True))
+            if revoked:
+                self.participations.filter(user__in=revoked).update(
+                    deleted_at=now()
+                )
+        if revoked:
+            MembershipEvent.log(MembershipEvent.LEFT, [self.pk], revoked)
+            self.__update_member_summary()
+            clear_membership_cache([self.pk], revoked)
+            bump_inbox_generations(revoked)
+
+    def __update_member_summary(self):
+        summary = Conversation.update_member_summaries([self.pk])[self.pk]
+        for name, value in summary.items():
+            setattr(self, name, value)
+
+    @property
+    def prefetched_participations(self):
+        """Returns the list of all participations (including the revoked ones)
+        if they were prefetched, e.g. by
+        Conversation.objects.with_participants, otherwise None."""
+        cache = getattr(self, '_prefetched_objects_cache', {})
+        if 'participations' not in cache:
+            return None
+        return list(self.participations.all())
+
+    def clear_prefetched_participations(self):
+        """Makes the participant related methods query the database again,
+        after the prefetched participations became stale."""
+        getattr(self, '_prefetched_objects_cache', {}).pop('participations',
+                                                           None)
+
+    def get_participation(self, participant):
+        """Returns the participation of the user, served from the prefetched
+        participations if available."""
+        participations = self.prefetched_participations
+        if participations is None:
+            return self.participations.get(user=participant)
+
+        for participation in participations:
+            if participation.user_id == participant.pk:
+                return participation
+        raise Participation.DoesNotExist()
 
     def is_read_by(self, participant):
-        participation = self.participations.get(user=participant)
+        participation = self.get_participation(participant)
         return participation.is_read
 
     @property
     def participants(self):
         """Returns a list of user objects participating in this conversation"""
+        participations = self.prefetched_participations
+        if participations is not None:
+            return [p.user for p in participations if not p.is_deleted]
         return [p.user for p in self.active_participations.all()]
 
     @property
     def participant_names(self):
         """Returns a list of usernames who participate in this conversation."""
+        if self.prefetched_participations is not None:
+            return [user.username for user in self.participants]
+        if sharding.is_enabled():
+            # the user table can't be joined on the shards
+            user_ids = list(self.active_participations.order_by('pk')
+                                                      .values_list('user',
+                                                                   flat=True))
+            users = sharding.users_by_pk(user_ids)
+            return [users[pk].username for pk in user_ids if pk in users]
         return list(self.active_participations.values_list('user__username',
                                                            flat=True))
 
-    def has_participant(self, user):
-        """Returns whether this user participates in this conversation.
+    def history(self, before=None, limit=CONVERSATION_HISTORY_PAGE_SIZE):
+        """Returns a list of messages of this conversation, newest first. The
+        messages which were moved to the archive are transparently merged
+        with the ones still in the Message table.
+
+        :param before: Optional, the last message of the previous page, only
+                       messages sent before it will be returned
+        :param limit: Maximum number of messages returned"""
+        if before is None and limit == CONVERSATION_HISTORY_PAGE_SIZE:
+            # the latest page is cached until a message is sent into the
+            # conversation, see clear_conversation_cache
+            key = CONVERSATION_CACHE_KEY_PATTERN.format(self.pk)
+            page = get_or_compute(key, lambda: self._history(before, limit))
+            # some of the messages may have expired since it was cached
+            return [m for m in page if not m.is_expired]
+        return self._history(before, limit)
+
+    def _history(self, before, limit):
+        messages = unexpired(self.messages.all())
+        archived = self.archived_messages.all()
+        if before is not None:
+            messages = sent_before(messages, before)
+            archived = sent_before(archived, before)
+
+        page = list(messages[:limit])
+        if len(page) == limit:
+            # only archived messages newer than the oldest one of the page
+            # can still make it onto the page
+            archived = sent_after(archived, page[-1])
+        # the archive mostly holds older messages, but e.g. imported ones can
+        # interleave with the Message table, so both are merged
+        page.extend(archived[:limit])
+        page.sort(key=lambda message: (message.sent_at, message.pk),
+                  reverse=True)
+        return page[:limit]
+
+    def seen_counts(self, limit=CONVERSATION_HISTORY_PAGE_SIZE):
+        """Returns a list of (message id, seen count) tuples of the latest
+        messages of this conversation, newest first, where the seen count is
+        the number of active participants other than the sender who read
+        the message. Computed from the read watermarks of the participants
+        in a single query.
+
+        :param limit: Number of the latest messages returned"""
+        using = self._state.db or DEFAULT_DB_ALIAS
+        cursor = connections[using].cursor()
+        cursor.execute(
+            "SELECT m.id, COUNT(p.id) FROM ("
+            "SELECT id, sent_at, sender_id FROM {message} "
+            "WHERE conversation_id = %s "
+            "ORDER BY sent_at DESC, id DESC LIMIT %s) m "
+            "LEFT JOIN {participation} p ON p.conversation_id = %s "
+            "AND p.deleted_at IS NULL "
+            "AND p.user_id <> m.sender_id "
+            "AND p.read_watermark >= m.sent_at "
+            "GROUP BY m.id, m.sent_at "
+            "ORDER BY m.sent_at DESC, m.id DESC".format(
+                message=Message._meta.db_table,
+                participation=Participation._meta.db_table
+            ),
+            [self.pk, limit, self.pk]
+        )
+        return [tuple(row) for row in cursor.fetchall()]
+
+    def members(self, order_by='joined', after=None, limit=MEMBER_PAGE_SIZE):
+        """Returns a page of the active participations of this conversation,
+        along with their users, without loading all the members at once.
+
+        :param order_by: Either 'joined' (join time) or 'username'
+        :param after: Optional, the last participation of the previous page
+        :param limit: Maximum number of participations returned"""
+        if sharding.is_enabled():
+            return self.__sharded_members(order_by, after, limit)
+
+        participations = self.active_participations.select_related('user')
+        if order_by == 'joined':
+            participations = participations.order_by('pk')
+            if after is not None:
+                participations = participations.filter(pk__gt=after.pk)
+        elif order_by == 'username':
+            participations = participations.order_by('user__username', 'pk')
+            if after is not None:
+                username = after.user.username
+                participations = participations.filter(
+                    Q(user__username__gt=username) |
+                    Q(user__username=username, pk__gt=after.pk)
+                )
+        else:
+            raise ValueError("Unknown ordering: {0}".format(order_by))
+
+        return list(participations[:limit])
+
+    def __sharded_members(self, order_by, after, limit):
+        # the users are read from the directory, so ordering by username
+        # has to look at the names of all the members
+        participations = self.active_participations
+        if order_by == 'joined':
+            participations = participations.order_by('pk')
+            if after is not None:
+                participations = participations.filter(pk__gt=after.pk)
+            return sharding.attach_users(list(participations[:limit]))
+        elif order_by != 'username':
+            raise ValueError("Unknown ordering: {0}".format(order_by))
+
+        members = list(participations.values_list('pk', 'user'))
+        users = sharding.users_by_pk(user_id for pk, user_id in members)
+        keys = sorted((users[user_id].username, pk)
+                      for pk, user_id in members if user_id in users)
+        if after is not None:
+            keys = [key for key in keys if key > (after.user.username,
+                                                  after.pk)]
+        page = dict((p.pk, p) for p in participations.filter(
+            pk__in=[pk for username, pk in keys[:limit]]
+        ))
+        return sharding.attach_users([page[pk] for username, pk in
+                                      keys[:limit] if pk in page])
+
+    def iter_members(self, order_by='joined', batch_size=MEMBER_PAGE_SIZE):
+        """Iterates over the users participating in this conversation,
+        fetching them page by page, see members."""
+        after = None
+        while True:
+            page = self.members(order_by, after, batch_size)
+            for participation in page:
+                yield participation.user
+
+            if len(page) < batch_size:
+                return
+            after = page[-1]
 
-        :param user: A User object (request.user probably)"""
-        return self.active_participations.filter(user=user).exists()
+    @property
+    def member_count(self):
+        """Returns the number of active participants, cached until someone
+        joins or leaves the conversation."""
+        return get_or_compute(member_count_key(self.pk),
+                              self.active_participations.count)
+
+    def has_participant(self, user, cached=True):
+        """Returns whether this user participates in this conversation. The
+        answer is cached per user until he/she joins or leaves it.
+
+        :param user: A User object (request.user probably)
+        :param cached: Whether a cached answer is acceptable"""
+        participations = self.prefetched_participations
+        if participations is not None:
+            return any(p.user_id == user.pk and not p.is_deleted
+                       for p in participations)
+
+        if not cached:
+            return self.active_participations.filter(user=user).exists()
+
+        participations = self.active_participations.filter(user=user)
+        return get_or_compute(member_key(self.pk, user.pk),
+                              participations.exists)
 
     @property
     def is_private(self):
         """Returns whether the conversation is private or not.
         If there are more than PRIVATE_CONVERSATION_MEMBER_COUNT (2)
         participants in the conversation, it is not private."""
+        participations = self.prefetched_participations
+        if participations is not None:
+            return len(participations) == PRIVATE_CONVERSATION_MEMBER_COUNT
         return (self.participations.count() ==
                 PRIVATE_CONVERSATION_MEMBER_COUNT)
 
@@ -159,21 +635,91 @@ class Conversation(models.Model):
         :param creator: A User object (request.user probably)
         :param participants: A QuerySet or list of user objects, who will be
                              added to the conversation as participants."""
-        conversation = cls.objects.create(creator=creator)
-        conversation.add_participants(participants)
+        conversation = cls(creator=creator)
+        if sharding.is_enabled():
+            conversation.pk = sharding.allocate_conversation_id()
+
+        with sharding.atomic_on_shard(conversation):
+            conversation.save(force_insert=True)
+            conversation.add_participants(participants)
         return conversation
 
+    @classmethod
+    def purge_abandoned(cls, batch_size=PURGE_BATCH_SIZE):
+        """Permanently deletes the conversations which were left by all of
+        their participants, along with their messages and participations.
+        Nobody can re-join such a conversation, so it would live forever.
+        Messages are deleted in batches of batch_size, just like the
+        conversations themselves, on every shard. Yields the number of
+        conversations deleted in each batch."""
+        for using in sharding.databases():
+            for count in cls.__purge_abandoned(using or PRIMARY_DATABASE,
+                                               batch_size):
+                yield count
+
+    @classmethod
+    def __purge_abandoned(cls, using, batch_size):
+        abandoned = (cls.objects
+                        .using(using)
+                        .exclude(participations__deleted_at__isnull=True)
+                        .order_by('pk'))
+        while True:
+            pks = list(abandoned.values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                return
+
+            for model in (Message, ArchivedMessage):
+                messages = model.objects.using(using).filter(
+                    conversation__in=pks
+                )
+                for count in model.purge(messages, batch_size, using):
+                    pass
+
+            with atomic(using=using):
+                for model in (Participation, ScheduledMessage,
+                              MembershipEvent):
+                    delete_queryset(model.objects.using(using).filter(
+                        conversation__in=pks
+                    ))
+                delete_queryset(cls.objects.using(using).filter(pk__in=pks))
+
+            yield len(pks)
+
+
+class ParticipantSet(models.Model):
+    """Shard independent directory of conversations, only used when sharding
+    is enabled. It's primary keys are allocated as conversation ids, and the
+    key identifies the set of users who ever participated in the
+    conversation."""
+    key = models.CharField(max_length=40, db_index=True)
+
 
 @python_2_unicode_compatible
 class Message(models.Model):
-    body = models.TextField()
+    body = CompressedTextField(compressible=allows_compression)
+    # uncompressed, for listings
+    preview = PreviewField(source='body')
     parent = models.ForeignKey('self',
                                related_name='next_messages',
                                blank=True,
                                null=True)
+    # set instead of parent when the parent message was archived
+    archived_parent = models.ForeignKey('ArchivedMessage',
+                                        related_name='next_hot_messages',
+                                        blank=True,
+                                        null=True)
     sender = models.ForeignKey(AUTH_USER_MODEL, related_name='messages')
     sent_at = models.DateTimeField(auto_now_add=True, db_index=True)
     conversation = models.ForeignKey('Conversation', related_name='messages')
+    # ephemeral messages are hidden after this time, and deleted by the
+    # sweep_expired_messages management command
+    expires_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    # deleted messages are kept as tombstones without a body, so the chain
+    # of the conversation isn't broken
+    deleted_at = models.DateTimeField(null=True, blank=True)
+    edited_at = models.DateTimeField(null=True, blank=True)
+
+    objects = MessageManager()
 
     class Meta:
         ordering = ['-sent_at', '-id']
@@ -181,18 +727,204 @@ class Message(models.Model):
     def __str__(self):
         return "{0} - {1}".format(self.sender.username, self.sent_at)
 
+    @property
+    def is_expired(self):
+        return self.expires_at is not None and self.expires_at <= now()
+
+    @property
+    def is_deleted(self):
+        return self.deleted_at is not None
+
+    def edit(self, user, body):
+        """Replaces the body of the message in place, see soft_delete.
+
+        :param user: A User object (request.user probably), only the sender
+                     of the message can edit it
+        :param body: The new body of the message"""
+        if self.is_deleted:
+            raise MessagingPermissionDenied("Deleted messages can't be "
+                                            "edited.")
+        self.__rewrite(user, body, edited_at=now())
+
+    def soft_delete(self, user):
+        """Turns the message into a tombstone, clearing it's body. It stays
+        in the conversation, so neither the replies to it nor the latest
+        message of the conversation have to be relinked. Just like edit, it
+        takes the same few queries however long the conversation is, and
+        only invalidates the cached history page and the inboxes if they
+        show the message.
+
+        :param user: A User object (request.user probably), only the sender
+                     of the message can delete it"""
+        if not self.is_deleted:
+            self.__rewrite(user, '', deleted_at=now())
+
+    def __rewrite(self, user, body, **fields):
+        if user.pk != self.sender_id:
+            msg = "{0} is not the sender".format(user.username)
+            raise MessagingPermissionDenied(msg)
+
+        using = sharding.database_for(self.conversation_id)
+        messages = Message.objects.using(using).filter(pk=self.pk)
+        fields.update(body=body, preview=make_preview(body))
+        with atomic(using=using):
+            # the search index needs the body it indexed, not the one this
+            # instance was loaded with
+            old_body = decompress_text(messages.values_list('body',
+                                                            flat=True)[0])
+            messages.update(**fields)
+            for name, value in fields.items():
+                setattr(self, name, value)
+            get_search_backend(Message, using).reindex(self, old_body, using)
+
+        clear_history_cache_of(self.conversation_id, self.pk)
+        is_latest = Conversation.objects.using(using).filter(
+            pk=self.conversation_id,
+            latest_message=self.pk
+        ).update(summary_preview=self.preview)
+        if is_latest:
+            # the inboxes show the latest messages
+            users = Participation.objects.using(using).filter(
+                conversation=self.conversation_id,
+                deleted_at__isnull=True
+            ).values_list('user', flat=True)
+            bump_inbox_generations(set(users))
+
+    def readers(self):
+        """Returns a list of the active participants, other than the sender,
+        who read the conversation up to this message, according to their
+        read watermarks."""
+        participations = Participation.objects.using(self._state.db).filter(
+            conversation=self.conversation_id,
+            deleted_at__isnull=True,
+            read_watermark__gte=self.sent_at
+        ).exclude(user=self.sender_id)
+        return [p.user for p in participations.select_related('user')]
+
+    @classmethod
+    def purge(cls, messages, batch_size=PURGE_BATCH_SIZE, using=None):
+        """Permanently deletes the specified messages, oldest first, in
+        batches of batch_size, without firing any per-message signals. Newer
+        messages left in place start their parent chain from scratch, and
+        conversations whose latest message is deleted end up without one.
+        Yields the number of messages deleted in each batch.
+
+        :param messages: A QuerySet of messages
+        :param using: Optional, alias of the database (shard) of the messages
+        """
+        def clear_references(pks):
+            search_using = using or PRIMARY_DATABASE
+            get_search_backend(cls, search_using).unindex(pks, search_using)
+            (cls.objects.using(using)
+                        .filter(parent__in=pks)
+                        .exclude(pk__in=pks)
+                        .update(parent=None))
+            conversations = Conversation.objects.using(using).filter(
+                latest_message__in=pks
+            )
+            conversation_ids = list(conversations.values_list('pk',
+                                                              flat=True))
+            conversations.update(latest_message=None,
+                                 **Conversation.latest_summary(None))
+            clear_history_cache(set(cls.objects.using(using)
+                                               .filter(pk__in=pks)
+                                               .values_list('conversation',
+                                                            flat=True)))
+            if conversation_ids:
+                # the inbox shows the latest messages
+                users = Participation.objects.using(using).filter(
+                    conversation__in=conversation_ids,
+                    deleted_at__isnull=True
+                ).values_list('user', flat=True)
+                bump_inbox_generations(set(users))
+
+        messages = messages.order_by('sent_at', 'pk')
+        return delete_in_batches(messages, batch_size, clear_references,
+                                 using)
+
+    @classmethod
+    def sweep_expired(cls, batch_size=PURGE_BATCH_SIZE):
+        """Permanently deletes the expired messages in batches of batch_size,
+        found through the expires_at index, on every shard. Messages replying
+        to a deleted one are linked to it's closest surviving ancestor, and
+        conversations whose latest message is deleted get their newest
+        remaining message as the latest one. Yields the number of messages
+        deleted in each batch."""
+        for using in sharding.databases():
+            # the batches must not be selected from a lagging replica
+            using = using or PRIMARY_DATABASE
+            expired = (cls.objects.using(using)
+                                  .filter(expires_at__lte=now())
+                                  .order_by('expires_at', 'pk'))
+            clear_references = partial(cls.__clear_expired_references, using)
+            for count in delete_in_batches(expired, batch_size,
+                                           clear_references, using):
+                yield count
+
+    @classmethod
+    def __clear_expired_references(cls, using, pks):
+        get_search_backend(cls, using).unindex(pks, using)
+        messages = cls.objects.using(using)
+        expired = dict(
+            (m['pk'], m)
+            for m in messages.filter(pk__in=pks).values('pk',
+                                                        'parent',
+                                                        'archived_parent',
+                                                        'conversation')
+        )
+
+        def closest_survivor(message):
+            while message['parent'] in expired:
+                message = expired[message['parent']]
+            return message['parent'], message['archived_parent']
+
+        # relink the replies of the deleted messages, grouped by their new
+        # parent, so it takes as few UPDATEs as possible
+        replied = {}
+        for pk, message in expired.items():
+            replied.setdefault(closest_survivor(message), []).append(pk)
+        for (parent, archived_parent), group in replied.items():
+            (messages.filter(parent__in=group)
+                     .exclude(pk__in=pks)
+                     .update(parent=parent, archived_parent=archived_parent))
+
+        conversations = Conversation.objects.using(using)
+        conversation_ids = list(conversations.filter(latest_message__in=pks)
+                                             .values_list('pk', flat=True))
+        for conversation_id in conversation_ids:
+            latest = list(messages.filter(conversation=conversation_id)
+                                  .exclude(pk__in=pks)[:1])
+            latest = latest[0] if latest else None
+            conversations.filter(pk=conversation_id).update(
+                latest_message=latest,
+                **Conversation.latest_summary(latest)
+            )
+
+        clear_history_cache(set(m['conversation'] for m in expired.values()))
+        if conversation_ids:
+            # the inbox shows the latest messages
+            participations = Participation.objects.using(using).filter(
+                conversation__in=conversation_ids,
+                deleted_at__isnull=True
+            )
+            users = participations.values_list('user', flat=True)
+            bump_inbox_generations(set(users))
+
     @classmethod
     def __send_to_conversation(cls, body, sender, conversation,
-                               new_participants=None):
+                               new_participants=None, ttl=None):
         """Internally used by both send_to_conversation and __send_to_users
         methods. Refactored as a separate method to avoid nesting the atomic
         decorator when __send_to_users needs to call __send_to_conversation."""
         new_participants = list(new_participants) if new_participants else []
+        # the checks below must not be decided on prefetched, possibly stale
+        # participations
+        conversation.clear_prefetched_participations()
 
         # check whether the sender is participating in the conversation or not
         # without this, arbitary users could send messages into conversations
         # which they're not even part of
-        if not conversation.has_participant(sender):
+        if not conversation.has_participant(sender, cached=False):
             msg = "{0} not participating".format(sender.username)
             raise MessagingPermissionDenied(msg)
 
@@ -202,24 +934,45 @@ class Message(models.Model):
             # will include all the participants, but not the history of the
             # private conversation
             recipients = conversation.participants + new_participants
-            return cls.__send_to_users(body, sender, recipients)
+            return cls.__send_to_users(body, sender, recipients, ttl)
 
         # this was already a group conversation, so just add the new
         # participants to it
         conversation.add_participants(new_participants)
 
-        message = cls.objects.create(body=body,
-                                     parent=conversation.latest_message,
-                                     sender=sender,
-                                     conversation=conversation)
-        # update latest message of conversation
-        conversation.latest_message = message
-        conversation.save()
-
-        p_sender = sender.participations.get(conversation=conversation)
+        if ttl is None:
+            ttl = conversation.message_ttl
+        if ttl is not None:
+            expires_at = now() + timedelta(seconds=ttl)
+        else:
+            expires_at = None
+
+        message = conversation.messages.create(
+            body=body,
+            parent=conversation.latest_message,
+            sender=sender,
+            expires_at=expires_at
+        )
+        # update latest message of conversation, along with it's summary,
+        # but not the rest of the possibly stale instance
+        fields = dict(latest_message=message,
+                      **Conversation.latest_summary(message))
+        conversations = Conversation.objects.using(
+            sharding.database_for(conversation.pk)
+        )
+        conversations.filter(pk=conversation.pk).update(**fields)
+        for name, value in fields.items():
+            setattr(conversation, name, value)
+
+        p_sender = conversation.participations.get(user=sender)
+        # the sender's read marker must be written before it's overtaken by
+        # the sender's own message
+        readmarkers.write_pending(p_sender)
         p_recipients = conversation.active_participations.exclude(user=sender)
         # mark conversation as not read for all participants except the sender
-        p_recipients.update(read_at=None)
+        # and bump their unread message counters in the same statement
+        p_recipients.update(read_at=None, unread_count=F('unread_count') + 1)
+        p_recipients = list(p_recipients)
 
         if not any(is_date_greater(pr.replied_at, p_sender.read_at)
                    for pr in p_recipients):
@@ -228,7 +981,8 @@ class Message(models.Model):
             # all the messages the other's sent, so update the sender's read_at
             # value again, to reflect that the sender read it's own (just now
             # sent) message.
-            fields = dict(replied_at=now(), read_at=now())
+            fields = dict(replied_at=now(), read_at=now(), unread_count=0,
+                          read_watermark=now())
         else:
             # if the sender's read_at time is less than any of the other
             # participants replied_at time, it means the sender didn't yet
@@ -240,11 +994,13 @@ class Message(models.Model):
             fields = dict(replied_at=now())
 
         conversation.participations.filter(user=sender).update(**fields)
+        bump_inbox_generations([sender.pk] +
+                               [pr.user_id for pr in p_recipients])
 
         return message
 
     @classmethod
-    def __send_to_users(cls, body, sender, recipients):
+    def __send_to_users(cls, body, sender, recipients, ttl=None):
         """Internally used by both send_to_users and __send_to_conversation
         methods. Refactored as a separate method to avoid nesting the atomic
         decorator when __send_to_conversation needs to call __send_to_users."""
@@ -270,12 +1026,15 @@ class Message(models.Model):
             # the message to that conversation
             (conversation,) = conversations
 
-        return cls.__send_to_conversation(body, sender, conversation)
+        with sharding.atomic_on_shard(conversation):
+            return cls.__send_to_conversation(body, sender, conversation,
+                                              ttl=ttl)
 
     @classmethod
+    @traced('send_to_conversation', describe_send_to_conversation)
     @atomic
     def send_to_conversation(cls, body, sender, conversation,
-                             new_participants=None):
+                             new_participants=None, ttl=None):
         """Sends a message to a specific conversation.
 
         The transaction is atomic, so if anything fails during message sending,
@@ -287,15 +1046,24 @@ class Message(models.Model):
         :param new_participants: Optional, if specified it should be a Queryset
                                  or list of user objects, who will be added to
                                  the existing conversation as new participants.
+        :param ttl: Optional, number of seconds after which the message
+                    expires, defaults to the message_ttl of the conversation
         """
-        return cls.__send_to_conversation(body,
-                                          sender,
-                                          conversation,
-                                          new_participants)
+        # the permission checks must not be fooled by a lagging replica
+        with use_primary():
+            with sharding.atomic_on_shard(conversation):
+                message = cls.__send_to_conversation(body,
+                                                     sender,
+                                                     conversation,
+                                                     new_participants,
+                                                     ttl)
+        stick_to_primary(sender)
+        return message
 
     @classmethod
+    @traced('send_to_users', describe_send_to_users)
     @atomic
-    def send_to_users(cls, body, sender, recipients):
+    def send_to_users(cls, body, sender, recipients, ttl=None):
         """Sends a message to a list of users.
 
         The transaction is atomic, so if anything fails during message sending,
@@ -304,15 +1072,376 @@ class Message(models.Model):
         :param body: Body of the new message
         :param sender: A User object (request.user probably)
         :param recipients: Queryset or list of user objects who will receive
-                           the message."""
-        return cls.__send_to_users(body, sender, recipients)
+                           the message.
+        :param ttl: Optional, number of seconds after which the message
+                    expires, defaults to the message_ttl of the conversation"""
+        # the permission checks must not be fooled by a lagging replica
+        with use_primary():
+            message = cls.__send_to_users(body, sender, recipients, ttl)
+        stick_to_primary(sender)
+        return message
+
+
+@python_2_unicode_compatible
+class ArchivedMessage(models.Model):
+    """Cold storage for old messages, moved out of the Message table by the
+    archive_messages management command. Primary keys are preserved, so the
+    parent chain stays valid between the archived messages."""
+    id = models.IntegerField(primary_key=True)
+    body = CompressedTextField()
+    parent = models.ForeignKey('self',
+                               related_name='next_messages',
+                               blank=True,
+                               null=True)
+    sender = models.ForeignKey(AUTH_USER_MODEL,
+                               related_name='archived_messages')
+    sent_at = models.DateTimeField(db_index=True)
+    conversation = models.ForeignKey('Conversation',
+                                     related_name='archived_messages')
+
+    class Meta:
+        ordering = ['-sent_at', '-id']
+
+    def __str__(self):
+        return "{0} - {1}".format(self.sender.username, self.sent_at)
+
+    @property
+    def is_expired(self):
+        # ephemeral messages are never archived
+        return False
+
+    @classmethod
+    def archive(cls, cutoff, batch_size=MESSAGE_ARCHIVE_BATCH_SIZE):
+        """Moves messages sent before cutoff into the archive, oldest first,
+        in batches of batch_size, each in it's own transaction, on every
+        shard. The latest message of a conversation is never archived, so
+        latest_message always points into the Message table. Yields the size
+        of each moved batch.
+
+        :param cutoff: Datetime, messages sent before it will be archived
+        :param batch_size: Number of messages moved in one transaction"""
+        for using in sharding.databases():
+            for count in cls.__archive(using or PRIMARY_DATABASE, cutoff,
+                                       batch_size):
+                yield count
+
+    @classmethod
+    def __archive(cls, using, cutoff, batch_size):
+        latest_messages = (Conversation.objects
+                                       .using(using)
+                                       .filter(latest_message__isnull=False)
+                                       .values('latest_message'))
+        # ephemeral messages are left to sweep_expired
+        candidates = (Message.objects.using(using)
+                                     .filter(sent_at__lt=cutoff,
+                                             expires_at__isnull=True)
+                                     .exclude(pk__in=latest_messages)
+                                     .order_by('sent_at', 'pk'))
+        while True:
+            with atomic(using=using):
+                batch = list(candidates[:batch_size])
+                if batch:
+                    cls.__archive_batch(using, batch)
+
+            if not batch:
+                return
+            yield len(batch)
+
+    @classmethod
+    def __archive_batch(cls, using, messages):
+        ids = [m.pk for m in messages]
+        hot_messages = Message.objects.using(using)
+        # the parent is either in this batch, in a previous one or it was
+        # already archived when this message was still in the Message table
+        cls.objects.using(using).bulk_create([
+            cls(id=m.pk,
+                body=m.body,
+                parent_id=m.parent_id or m.archived_parent_id,
+                sender_id=m.sender_id,
+                sent_at=m.sent_at,
+                conversation_id=m.conversation_id)
+            for m in messages
+        ])
+        # messages staying in the Message table whose parent is being moved
+        # now will point to the parent's archived copy instead
+        (hot_messages.filter(parent__in=ids)
+                     .exclude(pk__in=ids)
+                     .update(archived_parent=F('parent'), parent=None))
+        # only the Message table is searched
+        get_search_backend(Message, using).unindex(ids, using)
+        hot_messages.filter(pk__in=ids).delete()
+
+    @classmethod
+    def purge(cls, messages, batch_size=PURGE_BATCH_SIZE, using=None):
+        """Permanently deletes the specified archived messages, oldest first,
+        in batches of batch_size. Yields the number of messages deleted in
+        each batch.
+
+        :param messages: A QuerySet of archived messages
+        :param using: Optional, alias of the database (shard) of the messages
+        """
+        def clear_references(pks):
+            (cls.objects.using(using)
+                        .filter(parent__in=pks)
+                        .exclude(pk__in=pks)
+                        .update(parent=None))
+            (Message.objects.using(using)
+                            .filter(archived_parent__in=pks)
+                            .update(archived_parent=None))
+            clear_history_cache(set(cls.objects.using(using)
+                                               .filter(pk__in=pks)
+                                               .values_list('conversation',
+                                                            flat=True)))
+
+        messages = messages.order_by('sent_at', 'pk')
+        return delete_in_batches(messages, batch_size, clear_references,
+                                 using)
+
+
+@python_2_unicode_compatible
+class ScheduledMessage(models.Model):
+    """A message to be sent into a conversation later, at due_at, by the
+    dispatch_scheduled_messages management command or
+    talkalot.scheduling.run_dispatcher."""
+    PENDING = 'pending'
+    CLAIMED = 'claimed'
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (CLAIMED, 'Claimed'),
+        (SENT, 'Sent'),
+        (FAILED, 'Failed'),
+    )
+
+    body = models.TextField()
+    sender = models.ForeignKey(AUTH_USER_MODEL,
+                               related_name='scheduled_messages')
+    conversation = models.ForeignKey('Conversation',
+                                     related_name='scheduled_messages')
+    due_at = models.DateTimeField()
+    status = models.CharField(max_length=10,
+                              choices=STATUS_CHOICES,
+                              default=PENDING)
+    # identifies the batch of the dispatcher which claimed the message
+    claim_token = models.CharField(max_length=32, blank=True)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+    # why the message couldn't be sent
+    error = models.TextField(blank=True)
+
+    class Meta:
+        # the due messages are looked up through an index created by the
+        # post_migrate handler, see talkalot.indexes
+        ordering = ['due_at']
+
+    def __str__(self):
+        return "{0} - {1} ({2})".format(self.sender.username,
+                                        self.due_at,
+                                        self.status)
+
+    @classmethod
+    def schedule(cls, body, sender, conversation, due_at):
+        """Schedules a message to be sent to a specific conversation.
+
+        :param body: Body of the message
+        :param sender: A User object (request.user probably)
+        :param conversation: Conversation instance
+        :param due_at: The time the message is to be sent at"""
+        # the permission check must not be fooled by a lagging replica
+        with use_primary():
+            if not conversation.has_participant(sender, cached=False):
+                msg = "{0} not participating".format(sender.username)
+                raise MessagingPermissionDenied(msg)
+
+        return conversation.scheduled_messages.create(body=body,
+                                                      sender=sender,
+                                                      due_at=due_at)
+
+    @classmethod
+    def claim_due(cls, batch_size=SCHEDULED_DISPATCH_BATCH_SIZE, using=None):
+        """Claims at most batch_size due messages for delivery, the longest
+        overdue first, and returns them. Any number of dispatchers can claim
+        concurrently, as a message is claimed only by the one whose
+        conditional UPDATE changed it's status. Claims older than
+        SCHEDULED_CLAIM_TIMEOUT seconds, left behind by crashed dispatchers,
+        are released first.
+
+        :param using: Optional, database alias of the messages"""
+        scheduled = cls.objects.using(using) if using else cls.objects.all()
+        claimed_at = now()
+        expired = claimed_at - timedelta(seconds=SCHEDULED_CLAIM_TIMEOUT)
+        scheduled.filter(status=cls.CLAIMED, claimed_at__lt=expired).update(
+            status=cls.PENDING,
+            claim_token=''
+        )
+
+        due = scheduled.filter(status=cls.PENDING, due_at__lte=claimed_at)
+        due = due.order_by('due_at').values_list('pk', flat=True)
+        pks = list(due[:batch_size])
+        if not pks:
+            return []
+
+        token = uuid4().hex
+        scheduled.filter(pk__in=pks, status=cls.PENDING).update(
+            status=cls.CLAIMED,
+            claim_token=token,
+            claimed_at=claimed_at
+        )
+        claimed = scheduled.filter(pk__in=pks, claim_token=token)
+        return list(claimed.select_related('conversation'))
+
+    def deliver(self):
+        """Sends a claimed message through Message.send_to_conversation. It
+        is marked as sent in the same transaction, and only if the claim
+        still holds, so a message is never delivered twice. Returns the sent
+        message, or None if it wasn't sent."""
+        scheduled = type(self).objects.using(self._state.db).filter(
+            pk=self.pk,
+            status=self.CLAIMED,
+            claim_token=self.claim_token
+        )
+        try:
+            with atomic(using=self._state.db):
+                if not scheduled.update(status=self.SENT, sent_at=now()):
+                    # the claim expired and someone else took it over
+                    return None
+                message = Message.send_to_conversation(self.body,
+                                                       self.sender,
+                                                       self.conversation)
+        except MessagingPermissionDenied as exc:
+            # the sender left the conversation in the meantime
+            self.__fail(force_text(exc))
+            return None
+        except Exception as exc:
+            # one broken message must not stop the dispatcher
+            logger.exception("Delivering scheduled message %s failed",
+                             self.pk)
+            self.__fail("{0}: {1}".format(type(exc).__name__,
+                                          force_text(exc)))
+            return None
+
+        self.status = self.SENT
+        return message
+
+    def __fail(self, error):
+        # the claim is matched by it's token only, as the status update of
+        # deliver isn't rolled back if an outer transaction is managed by the
+        # caller
+        claimed = type(self).objects.using(self._state.db).filter(
+            pk=self.pk,
+            claim_token=self.claim_token
+        )
+        claimed.update(status=self.FAILED, error=error)
+        self.status = self.FAILED
+
+    @classmethod
+    def dispatch_due(cls, batch_size=SCHEDULED_DISPATCH_BATCH_SIZE):
+        """Delivers all the due messages in batches of batch_size, on every
+        shard if sharding is enabled. Yields the number of messages
+        delivered in each batch."""
+        for using in sharding.databases():
+            while True:
+                # claims must not be looked up on a lagging replica
+                with use_primary():
+                    claimed = cls.claim_due(batch_size, using)
+                    delivered = [s for s in claimed if s.deliver()]
+                if not claimed:
+                    break
+                yield len(delivered)
+
+
+@python_2_unicode_compatible
+class MembershipEvent(models.Model):
+    """Append-only log of the changes of conversation memberships, so
+    consumers (indexers, analytics) can process only what changed since they
+    last looked, see `read`. Events are only ever inserted."""
+    JOINED = 'joined'
+    LEFT = 'left'
+    REJOINED = 'rejoined'
+    KIND_CHOICES = (
+        (JOINED, 'Joined'),
+        (LEFT, 'Left'),
+        (REJOINED, 'Rejoined'),
+    )
+
+    conversation = models.ForeignKey('Conversation',
+                                     related_name='membership_events')
+    user = models.ForeignKey(AUTH_USER_MODEL,
+                             related_name='membership_events')
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    created_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        ordering = ['pk']
+
+    def __str__(self):
+        return "{0} {1} {2}".format(self.user_id, self.kind,
+                                    self.conversation_id)
+
+    @classmethod
+    def log(cls, kind, conversation_ids, user_ids):
+        """Log the same change of every user in every conversation with a
+        single INSERT (per shard).
+
+        :param kind: One of JOINED, LEFT or REJOINED"""
+        created_at = now()
+        events = {}
+        for conversation_id in conversation_ids:
+            using = (sharding.shard_for(conversation_id)
+                     if sharding.is_enabled() else None)
+            events.setdefault(using, []).extend(
+                cls(conversation_id=conversation_id,
+                    user_id=user_id,
+                    kind=kind,
+                    created_at=created_at)
+                for user_id in user_ids
+            )
+        for using, shard_events in events.items():
+            if shard_events:
+                events_manager = (cls.objects.using(using) if using
+                                  else cls.objects)
+                events_manager.bulk_create(shard_events)
+
+    @classmethod
+    def read(cls, after=None, limit=MEMBERSHIP_EVENT_BATCH_SIZE, using=None,
+             settle_seconds=MEMBERSHIP_EVENT_SETTLE_SECONDS):
+        """Return a list of at most limit events logged after the cursor,
+        oldest first. The primary key of the last one is the cursor of the
+        next call. Events younger than settle_seconds are held back, as a
+        transaction which started earlier could still commit an event with a
+        lower primary key. With sharding, every shard has it's own log and
+        cursor.
+
+        :param after: Optional, primary key of the last processed event
+        :param limit: Maximum number of events returned
+        :param using: Optional, database alias of the log"""
+        events = cls.objects.using(using) if using else cls.objects.all()
+        events = events.filter(
+            created_at__lte=now() - timedelta(seconds=settle_seconds)
+        )
+        if after is not None:
+            events = events.filter(pk__gt=after)
+        return list(events.order_by('pk')[:limit])
+
+    @classmethod
+    def iter_batches(cls, after=None, batch_size=MEMBERSHIP_EVENT_BATCH_SIZE,
+                     using=None,
+                     settle_seconds=MEMBERSHIP_EVENT_SETTLE_SECONDS):
+        """Yield the events logged after the cursor in lists of at most
+        batch_size, until the log is exhausted, see `read`."""
+        while True:
+            events = cls.read(after, batch_size, using, settle_seconds)
+            if not events:
+                return
+            yield events
+            after = events[-1].pk
 
 
 def clear_conversation_cache(sender, instance, **kwargs):
     """When a message is sent, the cached conversation (all of it's messages)
     shall be invalidated."""
-    key = CONVERSATION_CACHE_KEY_PATTERN.format(instance.conversation.pk)
-    cache.delete(key)
+    clear_history_cache([instance.conversation_id])
 
 
 def fire_message_sent_signal(sender, instance, created, **kwargs):
@@ -320,6 +1449,49 @@ def fire_message_sent_signal(sender, instance, created, **kwargs):
         message_sent.send(sender=sender, instance=instance)
 
 
+def index_message(sender, instance, created, raw=False, using=None,
+                  **kwargs):
+    """Adds freshly sent messages to the full-text search index."""
+    if created and not raw:
+        using = using or DEFAULT_DB_ALIAS
+        get_search_backend(sender, using).index(instance, using)
+
+
+def setup_search_index(sender, **kwargs):
+    """Creates the full-text search index structures once the tables of
+    talkalot exist in the database."""
+    using = kwargs.get('using', kwargs.get('db', DEFAULT_DB_ALIAS))
+    table_names = connections[using].introspection.table_names()
+    if Message._meta.db_table in table_names:
+        get_search_backend(Message, using).setup(using)
+
+
+def setup_participation_indexes(sender, **kwargs):
+    """Creates the indexes of the participations once their table exists in
+    the database, see talkalot.indexes."""
+    using = kwargs.get('using', kwargs.get('db', DEFAULT_DB_ALIAS))
+    table_names = connections[using].introspection.table_names()
+    if Participation._meta.db_table in table_names:
+        try:
+            setup_indexes(using)
+        except NotImplementedError:
+            # left to the database administrator
+            pass
+
+
+def setup_scheduled_message_indexes(sender, **kwargs):
+    """Creates the index of the scheduled messages once their table exists
+    in the database, see talkalot.indexes."""
+    using = kwargs.get('using', kwargs.get('db', DEFAULT_DB_ALIAS))
+    table_names = connections[using].introspection.table_names()
+    if ScheduledMessage._meta.db_table in table_names:
+        try:
+            setup_scheduled_message_index(using)
+        except NotImplementedError:
+            # left to the database administrator
+            pass
+
+
 post_save.connect(clear_conversation_cache,
                   sender=Message,
                   dispatch_uid="clear_conversation_cache")
@@ -328,3 +1500,20 @@ post_save.connect(clear_conversation_cache,
 post_save.connect(fire_message_sent_signal,
                   sender=Message,
                   dispatch_uid="fire_message_sent_signal")
+
+
+post_save.connect(index_message,
+                  sender=Message,
+                  dispatch_uid="index_message")
+
+
+post_migrate.connect(setup_search_index,
+                     dispatch_uid="setup_search_index")
+
+
+post_migrate.connect(setup_participation_indexes,
+                     dispatch_uid="setup_participation_indexes")
+
+
+post_migrate.connect(setup_scheduled_message_indexes,
+                     dispatch_uid="setup_scheduled_message_indexes")
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""Write-behind of read markers.
+
+With READ_MARKER_WRITE_BEHIND enabled, `Participation.read_conversation`
+doesn't save the participation. The read marker is recorded in the cache
+instead, where `Participation.is_read`, `unread_for` and `unread_counts_for`
+pick it up at once, and it's buffered in the process to be written to the
+database later, along with the other markers, in a single transaction (per
+database). The markers are always written to the database the conversation
+is written to, whichever database the participation was loaded from, and
+the inboxes of the participants are refreshed once they're written.
+
+The buffer is flushed when it's oldest marker is READ_MARKER_MAX_LAG seconds
+old or it holds READ_MARKER_MAX_PENDING markers, when the process exits, or
+by `flush`. Processes that may stop recording reads for long should run
+`start_flusher`, to keep the lag bounded. A flush only ever moves `read_at`
+forward. When the participant sends a message into the conversation, the
+pending marker is written right away, see `write_pending`.
+"""
+from __future__ import unicode_literals
+
+import atexit
+import logging
+import threading
+import time
+
+from django.core.cache import cache
+from django.db import connections
+from django.db.models import Q
+
+from . import settings, sharding
+from .caching import bump_inbox_generations
+from .utils import atomic
+
+
+logger = logging.getLogger(__name__)
+
+
+def is_enabled():
+    return bool(settings.READ_MARKER_WRITE_BEHIND)
+
+
+def markers_key(user_id):
+    return settings.READ_MARKER_CACHE_KEY_PATTERN.format(user_id)
+
+
+def pending_markers(user_id):
+    """Return a dict mapping conversation ids to the time the user read them,
+    for the reads which may not be in the database yet."""
+    if not is_enabled():
+        return {}
+    return cache.get(markers_key(user_id)) or {}
+
+
+def is_caught_up(conversation, read_at):
+    """Return whether nothing was sent into the conversation after read_at."""
+    latest_message = conversation.latest_message
+    return latest_message is None or latest_message.sent_at <= read_at
+
+
+class ReadMarkerBuffer(object):
+    """Read markers of a process waiting to be written to the database."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.since = None
+
+    def record(self, participation):
+        """Record that the participant read the conversation at it's
+        read_at."""
+        read_at = participation.read_at
+        conversation_id = participation.conversation_id
+        key = markers_key(participation.user_id)
+        markers = cache.get(key) or {}
+        if markers.get(conversation_id, read_at) <= read_at:
+            markers[conversation_id] = read_at
+            # kept until it's surely flushed
+            cache.set(key, markers, settings.READ_MARKER_MAX_LAG * 2 + 60)
+
+        with self.lock:
+            pending_key = (sharding.database_for(conversation_id),
+                           participation.pk)
+            marker = self.pending.get(pending_key)
+            if marker is None or marker[-1] < read_at:
+                self.pending[pending_key] = (conversation_id,
+                                             participation.user_id,
+                                             read_at)
+            if self.since is None:
+                self.since = time.time()
+            due = (len(self.pending) >= settings.READ_MARKER_MAX_PENDING or
+                   time.time() - self.since >= settings.READ_MARKER_MAX_LAG)
+
+        if due:
+            self.flush()
+
+    def discard(self, using, pk):
+        with self.lock:
+            self.pending.pop((using, pk), None)
+
+    def flush(self):
+        """Write the buffered read markers to the database, one transaction
+        per database, then refresh the inboxes of their participants. Returns
+        the number of markers written."""
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+            self.since = None
+
+        databases = {}
+        user_ids = set()
+        for (using, pk), marker in pending.items():
+            conversation_id, user_id, read_at = marker
+            databases.setdefault(using, []).append((pk,
+                                                    conversation_id,
+                                                    read_at))
+            user_ids.add(user_id)
+        try:
+            for using, markers in databases.items():
+                with atomic(using=using):
+                    for marker in markers:
+                        self.write(using, *marker)
+        except Exception:
+            # keep them for the next attempt
+            with self.lock:
+                for pending_key, marker in pending.items():
+                    current = self.pending.get(pending_key)
+                    if current is None or current[-1] < marker[-1]:
+                        self.pending[pending_key] = marker
+                if self.since is None:
+                    self.since = time.time()
+            raise
+
+        # the inbox pages cached since the reads still show them unread
+        bump_inbox_generations(user_ids)
+        return len(pending)
+
+    def write(self, using, pk, conversation_id, read_at):
+        from .models import Message, Participation
+        participations = Participation.objects.using(using).filter(
+            Q(read_at__isnull=True) | Q(read_at__lt=read_at),
+            pk=pk
+        )
+        caught_up = participations.filter(
+            Q(conversation__latest_message__isnull=True) |
+            Q(conversation__latest_message__sent_at__lte=read_at)
+        )
+        if not caught_up.update(read_at=read_at, unread_count=0):
+            # messages were received since it was read, those are unread,
+            # except the ones the participant sent
+            unread = Message.objects.using(using).filter(
+                conversation=conversation_id,
+                sent_at__gt=read_at
+            ).exclude(
+                sender__in=Participation.objects.using(using).filter(
+                    pk=pk
+                ).values('user')
+            ).count()
+            participations.update(read_at=read_at, unread_count=unread)
+        Participation.objects.using(using).filter(
+            Q(read_watermark__isnull=True) | Q(read_watermark__lt=read_at),
+            pk=pk
+        ).update(read_watermark=read_at)
+
+
+_buffer = ReadMarkerBuffer()
+record = _buffer.record
+flush = _buffer.flush
+atexit.register(flush)
+
+
+def write_pending(participation):
+    """Write the pending read marker of the participant in the conversation
+    at once, if there is one, moving read_at of the instance forward too.
+    Called before the participant sends a message into the conversation, as
+    a later flush couldn't tell whether the message was sent after reading
+    the conversation, and the conversation would be left unread."""
+    read_at = pending_markers(participation.user_id).get(
+        participation.conversation_id
+    )
+    if read_at is None:
+        return
+
+    using = sharding.database_for(participation.conversation_id)
+    _buffer.discard(using, participation.pk)
+    _buffer.write(using, participation.pk, participation.conversation_id,
+                  read_at)
+    if participation.read_at is None or participation.read_at < read_at:
+        participation.read_at = read_at
+
+
+def start_flusher(interval=None):
+    """Start a daemon thread flushing the read markers of this process every
+    interval seconds, READ_MARKER_MAX_LAG by default. Returns a
+    threading.Event, which stops the thread when set."""
+    interval = interval or settings.READ_MARKER_MAX_LAG
+    stop = threading.Event()
+
+    def run():
+        while not stop.is_set():
+            stop.wait(interval)
+            try:
+                flush()
+            except Exception:
+                # the markers stay buffered, and are retried next time
+                logger.exception("Flushing read markers failed")
+            finally:
+                # the thread got it's own connections
+                for connection in connections.all():
+                    connection.close()
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return stop
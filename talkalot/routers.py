@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""Read replica and sharding support.
+
+Add `talkalot.routers.ReplicaRouter` to DATABASE_ROUTERS and list the replica
+aliases in READ_REPLICA_DATABASES to serve talkalot's listing queries from
+the replicas. Message sending and the bulk operations always read from the
+primary, and the user who wrote something reads from the primary for
+READ_REPLICA_STICKY_SECONDS afterwards, so they see their own writes.
+
+ShardRouter is described in talkalot.sharding.
+"""
+from __future__ import unicode_literals
+
+import random
+import threading
+
+from contextlib import contextmanager
+
+from django.core.cache import cache
+
+from . import settings
+from .sharding import is_enabled as sharding_enabled, shard_for
+
+
+_local = threading.local()
+
+
+@contextmanager
+def use_primary():
+    """All reads of talkalot models inside the block go to the primary."""
+    _local.depth = getattr(_local, 'depth', 0) + 1
+    try:
+        yield
+    finally:
+        _local.depth -= 1
+
+
+def is_pinned():
+    return getattr(_local, 'depth', 0) > 0
+
+
+def stick_to_primary(user):
+    """Serve the reads of the user from the primary for a while, until the
+    replicas catch up with what the user just wrote."""
+    key = settings.READ_REPLICA_STICKY_CACHE_KEY_PATTERN.format(user.pk)
+    cache.set(key, True, settings.READ_REPLICA_STICKY_SECONDS)
+
+
+def is_sticky(user):
+    key = settings.READ_REPLICA_STICKY_CACHE_KEY_PATTERN.format(user.pk)
+    return bool(cache.get(key))
+
+
+def read_database_for(user, using=None):
+    """Return the database alias a read-only query on behalf of the user has
+    to use, or None to leave it to the routers.
+
+    :param using: Optional, explicitly requested database alias"""
+    if using is not None:
+        return using
+    if settings.READ_REPLICA_DATABASES and is_sticky(user):
+        return settings.PRIMARY_DATABASE
+    return None
+
+
+class ReplicaRouter(object):
+    """Routes reads of talkalot's models to a random replica, unless they are
+    pinned to the primary, and all writes to the primary."""
+
+    def is_talkalot_model(self, model):
+        return model._meta.app_label == 'talkalot'
+
+    def db_for_read(self, model, **hints):
+        if not self.is_talkalot_model(model):
+            return None
+        if not settings.READ_REPLICA_DATABASES:
+            return None
+        if is_pinned():
+            return settings.PRIMARY_DATABASE
+        return random.choice(settings.READ_REPLICA_DATABASES)
+
+    def db_for_write(self, model, **hints):
+        if not self.is_talkalot_model(model):
+            return None
+        return settings.PRIMARY_DATABASE
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = ((settings.PRIMARY_DATABASE,) +
+                     tuple(settings.READ_REPLICA_DATABASES))
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+
+class ShardRouter(object):
+    """Routes queries of talkalot's models to the shard of the conversation
+    they belong to, as described in talkalot.sharding. The conversation is
+    taken from the instance the query starts from, queries without one are
+    left to the other routers or need an explicit database. Reads of other
+    models (the users) through talkalot objects go to the directory
+    database."""
+
+    sharded_models = ('Conversation', 'Participation', 'Message',
+                      'ArchivedMessage', 'ScheduledMessage',
+                      'MembershipEvent')
+
+    def is_talkalot_object(self, obj):
+        return obj is not None and obj._meta.app_label == 'talkalot'
+
+    def shard_of(self, instance):
+        name = instance._meta.object_name
+        if name == 'Conversation':
+            conversation_id = instance.pk
+        elif name in self.sharded_models:
+            conversation_id = instance.conversation_id
+        else:
+            return None
+
+        if conversation_id is None:
+            return None
+        return shard_for(conversation_id)
+
+    def route(self, model, hints):
+        if not sharding_enabled():
+            return None
+
+        instance = hints.get('instance')
+        if model._meta.app_label != 'talkalot':
+            if self.is_talkalot_object(instance):
+                return settings.SHARD_DIRECTORY_DATABASE
+            return None
+
+        if model._meta.object_name not in self.sharded_models:
+            return settings.SHARD_DIRECTORY_DATABASE
+        if self.is_talkalot_object(instance):
+            return self.shard_of(instance)
+        return None
+
+    def db_for_read(self, model, **hints):
+        return self.route(model, hints)
+
+    def db_for_write(self, model, **hints):
+        return self.route(model, hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if not sharding_enabled():
+            return None
+        if self.is_talkalot_object(obj1) or self.is_talkalot_object(obj2):
+            return True
+        return None
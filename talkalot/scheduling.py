@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""Dispatcher of scheduled messages, see ScheduledMessage."""
+from __future__ import unicode_literals
+
+import logging
+import threading
+
+from .settings import (SCHEDULED_DISPATCH_BATCH_SIZE,
+                       SCHEDULED_DISPATCH_INTERVAL)
+
+
+logger = logging.getLogger(__name__)
+
+
+def run_dispatcher(batch_size=SCHEDULED_DISPATCH_BATCH_SIZE,
+                   interval=SCHEDULED_DISPATCH_INTERVAL, stop=None,
+                   callback=None):
+    """Deliver the scheduled messages as they become due, until stop is set.
+    When nothing is due, it checks again every interval seconds. Any number
+    of dispatchers can run at the same time, in threads or processes.
+    Messages which can't be delivered are marked as failed, and errors of
+    the dispatching itself (e.g. a lost database connection) are logged and
+    retried after interval seconds. Returns the number of messages
+    delivered.
+
+    :param stop: Optional, a threading.Event telling the dispatcher to stop
+    :param callback: Optional, called with the number of messages delivered
+                     after each batch"""
+    from .models import ScheduledMessage
+    stop = stop or threading.Event()
+    total = 0
+    while not stop.is_set():
+        delivered = 0
+        try:
+            for count in ScheduledMessage.dispatch_due(batch_size):
+                delivered += count
+                if callback is not None:
+                    callback(count)
+                if stop.is_set():
+                    break
+        except Exception:
+            logger.exception("Dispatching scheduled messages failed")
+
+        total += delivered
+        if not delivered:
+            stop.wait(interval)
+    return total
@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+"""Full-text search backends for message bodies.
+
+The backend is picked by the vendor of the database the messages live in,
+unless the MESSAGE_SEARCH_BACKEND setting points to a backend class. Where
+the vendor's backend isn't available, e.g. SQLite built without FTS5, the
+unindexed fallback is used. Every backend annotates the matching messages
+with a `rank` attribute (higher is better), which along with the primary key
+serves as the pagination cursor.
+
+Message bodies are only stored compressed (see talkalot.compression) in
+databases whose backend feeds it's index the decompressed text, as the
+others match the stored column. PostgreSQL compresses large values on it's
+own anyway.
+"""
+from __future__ import unicode_literals
+
+import re
+
+try:
+    from importlib import import_module
+except ImportError:
+    # Python 2.6
+    from django.utils.importlib import import_module
+
+from django.db import connections
+
+from .compression import decompress_text
+from .settings import MESSAGE_SEARCH_BACKEND, MESSAGE_SEARCH_CONFIG
+from .utils import iterate_in_batches
+
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+# messages re-indexed per query by the backends feeding their own index
+REBUILD_BATCH_SIZE = 1000
+
+
+class BaseSearchBackend(object):
+    """Subclasses must implement `rank_sql` and `match`, and can hook into
+    message sending and schema creation to maintain their index. Backends
+    which feed their index the decompressed bodies themselves clear
+    `reads_stored_bodies`, so the bodies can be compressed."""
+    reads_stored_bodies = True
+
+    def __init__(self, model):
+        self.model = model
+        self.table = model._meta.db_table
+
+    @classmethod
+    def is_available(cls, using):
+        """Return whether the backend can be used with the database."""
+        return True
+
+    def setup(self, using):
+        """Create the index structures in the specified database."""
+
+    def index(self, message, using):
+        """Add a freshly sent message to the index."""
+
+    def reindex(self, message, old_body, using):
+        """Update the index after the body of a message was changed."""
+
+    def unindex(self, pks, using):
+        """Remove the messages from the index, before they're deleted."""
+
+    def rebuild(self, using):
+        """Re-index all messages, e.g. after a bulk import or a purge."""
+
+    def rank_sql(self, query):
+        """Return the SQL expression used as rank and it's parameters."""
+        raise NotImplementedError
+
+    def match(self, messages, query):
+        """Filter the queryset of messages to those matching the query."""
+        raise NotImplementedError
+
+    def search(self, messages, query, cursor=None):
+        """Filter and order the queryset of messages by relevance to the
+        query, best matches first.
+
+        :param cursor: Optional, a (rank, pk) tuple of the last message on
+                       the previous page"""
+        rank, params = self.rank_sql(query)
+        messages = self.match(messages, query).extra(
+            select={'rank': rank},
+            select_params=params,
+            order_by=['-rank', '-{0}.id'.format(self.table)]
+        )
+        if cursor is not None:
+            last_rank, last_pk = cursor
+            where = "({0} < %s OR ({0} = %s AND {1}.id < %s))".format(
+                rank,
+                self.table
+            )
+            messages = messages.extra(
+                where=[where],
+                params=params + [last_rank] + params + [last_rank, last_pk]
+            )
+        return messages
+
+
+class SimpleSearchBackend(BaseSearchBackend):
+    """Unindexed fallback for databases without full-text support, every
+    message containing all the words of the query is an equal match."""
+
+    def rank_sql(self, query):
+        return '0', []
+
+    def match(self, messages, query):
+        for word in WORD_RE.findall(query):
+            messages = messages.filter(body__icontains=word)
+        return messages
+
+
+class SQLiteSearchBackend(BaseSearchBackend):
+    """Uses an FTS5 index over the Message table, which is updated as new
+    messages are sent, ranked by bm25."""
+
+    # the index is fed from Python
+    reads_stored_bodies = False
+    # whether the SQLite library of the databases was built with FTS5
+    _fts5 = {}
+
+    def __init__(self, model):
+        super(SQLiteSearchBackend, self).__init__(model)
+        self.fts_table = '{0}_fts'.format(self.table)
+
+    @classmethod
+    def is_available(cls, using):
+        if using not in cls._fts5:
+            cursor = connections[using].cursor()
+            cursor.execute("PRAGMA compile_options")
+            cls._fts5[using] = any(row[0] == 'ENABLE_FTS5'
+                                   for row in cursor.fetchall())
+        return cls._fts5[using]
+
+    def execute(self, using, sql, params=None):
+        connections[using].cursor().execute(sql, params or [])
+
+    def setup(self, using):
+        self.execute(
+            using,
+            "CREATE VIRTUAL TABLE IF NOT EXISTS {0} USING fts5(body, "
+            "content='{1}', content_rowid='id')".format(self.fts_table,
+                                                        self.table)
+        )
+
+    def insert(self, using, pk, body):
+        if not body:
+            # never indexed, so the empty bodies don't have to be removed
+            return
+        self.execute(using,
+                     "INSERT INTO {0} (rowid, body) VALUES (%s, %s)".format(
+                         self.fts_table
+                     ),
+                     [pk, body])
+
+    def index(self, message, using):
+        self.insert(using, message.pk, message.body)
+
+    def remove(self, using, pk, body):
+        # an external content index has to be told the indexed value
+        self.execute(using,
+                     "INSERT INTO {0} ({0}, rowid, body) "
+                     "VALUES ('delete', %s, %s)".format(self.fts_table),
+                     [pk, body])
+
+    def reindex(self, message, old_body, using):
+        if old_body:
+            self.remove(using, message.pk, old_body)
+        self.index(message, using)
+
+    def unindex(self, pks, using):
+        # rowids of deleted messages are reused by new ones, so their text
+        # must not be left in the index
+        messages = self.model.objects.using(using).filter(pk__in=pks)
+        for pk, body in messages.values_list('pk', 'body'):
+            body = decompress_text(body)
+            if body:
+                self.remove(using, pk, body)
+
+    def rebuild(self, using):
+        # the 'rebuild' command would index the stored, possibly compressed
+        # bodies
+        self.execute(using,
+                     "INSERT INTO {0} ({0}) VALUES ('delete-all')".format(
+                         self.fts_table
+                     ))
+        messages = self.model.objects.using(using).values('pk', 'body')
+        for row in iterate_in_batches(messages, REBUILD_BATCH_SIZE):
+            self.insert(using, row['pk'], decompress_text(row['body']))
+
+    def to_fts_query(self, query):
+        # every word is quoted, so the user can't inject FTS5 syntax
+        words = WORD_RE.findall(query)
+        return ' '.join('"{0}"'.format(word) for word in words)
+
+    def rank_sql(self, query):
+        return '-bm25({0})'.format(self.fts_table), []
+
+    def match(self, messages, query):
+        return messages.extra(
+            tables=[self.fts_table],
+            where=["{0}.rowid = {1}.id".format(self.fts_table, self.table),
+                   "{0} MATCH %s".format(self.fts_table)],
+            params=[self.to_fts_query(query)]
+        )
+
+
+class PostgresSearchBackend(BaseSearchBackend):
+    """Uses a GIN expression index over the tsvector of message bodies, which
+    is maintained by PostgreSQL itself, ranked by ts_rank."""
+
+    def vector_sql(self):
+        return "to_tsvector('{0}', {1}.body)".format(MESSAGE_SEARCH_CONFIG,
+                                                     self.table)
+
+    def setup(self, using):
+        connections[using].cursor().execute(
+            "CREATE INDEX IF NOT EXISTS {0}_body_tsv ON {0} "
+            "USING gin(({1}))".format(self.table, self.vector_sql())
+        )
+
+    def rank_sql(self, query):
+        rank = "ts_rank({0}, plainto_tsquery('{1}', %s))::float8".format(
+            self.vector_sql(),
+            MESSAGE_SEARCH_CONFIG
+        )
+        return rank, [query]
+
+    def match(self, messages, query):
+        where = "{0} @@ plainto_tsquery('{1}', %s)".format(
+            self.vector_sql(),
+            MESSAGE_SEARCH_CONFIG
+        )
+        return messages.extra(where=[where], params=[query])
+
+
+VENDOR_BACKENDS = {
+    'sqlite': SQLiteSearchBackend,
+    'postgresql': PostgresSearchBackend,
+}
+
+_backends = {}
+
+
+def allows_compression(model, using):
+    """Return whether the bodies of the model may be stored compressed in
+    the database, see `CompressedTextField`."""
+    return not get_search_backend(model, using).reads_stored_bodies
+
+
+def get_search_backend(model, using):
+    """Return the search backend instance for the specified database."""
+    if MESSAGE_SEARCH_BACKEND:
+        module_name, class_name = MESSAGE_SEARCH_BACKEND.rsplit('.', 1)
+        backend_class = getattr(import_module(module_name), class_name)
+    else:
+        vendor = connections[using].vendor
+        backend_class = VENDOR_BACKENDS.get(vendor, SimpleSearchBackend)
+        if not backend_class.is_available(using):
+            backend_class = SimpleSearchBackend
+
+    key = (backend_class, model)
+    if key not in _backends:
+        _backends[key] = backend_class(model)
+    return _backends[key]
@@ -12,3 +12,127 @@ CONVERSATION_CACHE_KEY_PATTERN = getattr(settings,
 PARTICIPANTS_CACHE_KEY_PATTERN = getattr(settings,
                                          'PARTICIPANTS_CACHE_KEY_PATTERN',
                                          'participants_{0}')
+CONVERSATION_HISTORY_PAGE_SIZE = getattr(settings,
+                                         'CONVERSATION_HISTORY_PAGE_SIZE',
+                                         20)
+MESSAGE_ARCHIVE_AFTER_DAYS = getattr(settings,
+                                     'MESSAGE_ARCHIVE_AFTER_DAYS',
+                                     365)
+MESSAGE_ARCHIVE_BATCH_SIZE = getattr(settings,
+                                     'MESSAGE_ARCHIVE_BATCH_SIZE',
+                                     1000)
+MESSAGE_RETENTION_DAYS = getattr(settings, 'MESSAGE_RETENTION_DAYS', None)
+PURGE_BATCH_SIZE = getattr(settings, 'PURGE_BATCH_SIZE', 1000)
+# dotted path of the search backend class, picked by database vendor if unset
+MESSAGE_SEARCH_BACKEND = getattr(settings, 'MESSAGE_SEARCH_BACKEND', None)
+# text search configuration used by the PostgreSQL backend
+MESSAGE_SEARCH_CONFIG = getattr(settings, 'MESSAGE_SEARCH_CONFIG', 'english')
+MESSAGE_SEARCH_PAGE_SIZE = getattr(settings, 'MESSAGE_SEARCH_PAGE_SIZE', 20)
+# aliases of the databases talkalot's read-only queries can be routed to
+READ_REPLICA_DATABASES = getattr(settings, 'READ_REPLICA_DATABASES', ())
+PRIMARY_DATABASE = getattr(settings, 'PRIMARY_DATABASE', 'default')
+# reads of a user are served by the primary for this long after a write
+READ_REPLICA_STICKY_SECONDS = getattr(settings,
+                                      'READ_REPLICA_STICKY_SECONDS',
+                                      10)
+READ_REPLICA_STICKY_CACHE_KEY_PATTERN = getattr(
+    settings,
+    'READ_REPLICA_STICKY_CACHE_KEY_PATTERN',
+    'replica_sticky_{0}'
+)
+# aliases of the databases conversations are spread across, by their ids
+CONVERSATION_SHARDS = getattr(settings, 'CONVERSATION_SHARDS', ())
+# database of the participant set directory and the user table when sharding
+SHARD_DIRECTORY_DATABASE = getattr(settings,
+                                   'SHARD_DIRECTORY_DATABASE',
+                                   'default')
+EXPORT_BATCH_SIZE = getattr(settings, 'EXPORT_BATCH_SIZE', 1000)
+IMPORT_BATCH_SIZE = getattr(settings, 'IMPORT_BATCH_SIZE', 5000)
+MEMBER_CACHE_KEY_PATTERN = getattr(settings,
+                                   'MEMBER_CACHE_KEY_PATTERN',
+                                   'member_{0}_{1}')
+MEMBER_COUNT_CACHE_KEY_PATTERN = getattr(settings,
+                                         'MEMBER_COUNT_CACHE_KEY_PATTERN',
+                                         'member_count_{0}')
+MEMBER_PAGE_SIZE = getattr(settings, 'MEMBER_PAGE_SIZE', 100)
+INBOX_PAGE_SIZE = getattr(settings, 'INBOX_PAGE_SIZE', 20)
+# number of leading inbox pages served from the cache
+INBOX_CACHED_PAGES = getattr(settings, 'INBOX_CACHED_PAGES', 2)
+INBOX_CACHE_TIMEOUT = getattr(settings, 'INBOX_CACHE_TIMEOUT', 300)
+INBOX_CACHE_KEY_PATTERN = getattr(settings,
+                                  'INBOX_CACHE_KEY_PATTERN',
+                                  'inbox_{0}_{1}_{2}')
+INBOX_GENERATION_CACHE_KEY_PATTERN = getattr(
+    settings,
+    'INBOX_GENERATION_CACHE_KEY_PATTERN',
+    'inbox_generation_{0}'
+)
+CONVERSATION_CACHE_TIMEOUT = getattr(settings,
+                                     'CONVERSATION_CACHE_TIMEOUT',
+                                     300)
+# cached lookups are recomputed by a single process at a time, the others
+# wait for at most CACHE_LOCK_WAIT seconds before computing it themselves
+CACHE_LOCK_KEY_PATTERN = getattr(settings, 'CACHE_LOCK_KEY_PATTERN',
+                                 'lock_{0}')
+CACHE_LOCK_TIMEOUT = getattr(settings, 'CACHE_LOCK_TIMEOUT', 10)
+CACHE_LOCK_WAIT = getattr(settings, 'CACHE_LOCK_WAIT', 2)
+CACHE_LOCK_POLL_INTERVAL = getattr(settings, 'CACHE_LOCK_POLL_INTERVAL', 0.05)
+# invalidating a cached lookup starts a new version of it, so a value still
+# being computed for the previous version is never served
+CACHE_VERSION_KEY_PATTERN = getattr(settings, 'CACHE_VERSION_KEY_PATTERN',
+                                    'version_{0}')
+# the higher, the earlier values are refreshed before they expire
+CACHE_EARLY_REFRESH_BETA = getattr(settings, 'CACHE_EARLY_REFRESH_BETA', 1.0)
+# expired values are served for this long while they're being refreshed
+CACHE_STALE_SECONDS = getattr(settings, 'CACHE_STALE_SECONDS', 60)
+SCHEDULED_DISPATCH_BATCH_SIZE = getattr(settings,
+                                        'SCHEDULED_DISPATCH_BATCH_SIZE',
+                                        100)
+# seconds the dispatcher sleeps when no scheduled messages are due
+SCHEDULED_DISPATCH_INTERVAL = getattr(settings,
+                                      'SCHEDULED_DISPATCH_INTERVAL',
+                                      5)
+# claims of scheduled messages older than this many seconds are considered
+# abandoned by a crashed dispatcher, and get released
+SCHEDULED_CLAIM_TIMEOUT = getattr(settings, 'SCHEDULED_CLAIM_TIMEOUT', 300)
+# record read markers in the cache and write them to the database in batches
+READ_MARKER_WRITE_BEHIND = getattr(settings, 'READ_MARKER_WRITE_BEHIND', False)
+# read markers are written to the database at most this many seconds late
+READ_MARKER_MAX_LAG = getattr(settings, 'READ_MARKER_MAX_LAG', 5)
+READ_MARKER_MAX_PENDING = getattr(settings, 'READ_MARKER_MAX_PENDING', 1000)
+READ_MARKER_CACHE_KEY_PATTERN = getattr(settings,
+                                        'READ_MARKER_CACHE_KEY_PATTERN',
+                                        'read_markers_{0}')
+DIGEST_BATCH_SIZE = getattr(settings, 'DIGEST_BATCH_SIZE', 1000)
+# number of the latest unread messages included per conversation
+DIGEST_MESSAGES_PER_CONVERSATION = getattr(settings,
+                                           'DIGEST_MESSAGES_PER_CONVERSATION',
+                                           3)
+# bodies at least this long are stored compressed, None disables compression
+MESSAGE_COMPRESSION_THRESHOLD = getattr(settings,
+                                        'MESSAGE_COMPRESSION_THRESHOLD',
+                                        None)
+MESSAGE_COMPRESSION_LEVEL = getattr(settings, 'MESSAGE_COMPRESSION_LEVEL', 6)
+MESSAGE_PREVIEW_LENGTH = getattr(settings, 'MESSAGE_PREVIEW_LENGTH', 100)
+MESSAGE_COMPRESSION_BATCH_SIZE = getattr(settings,
+                                         'MESSAGE_COMPRESSION_BATCH_SIZE',
+                                         1000)
+MEMBERSHIP_EVENT_BATCH_SIZE = getattr(settings,
+                                      'MEMBERSHIP_EVENT_BATCH_SIZE',
+                                      1000)
+# events are only handed out this many seconds after they were logged, so
+# the ones whose transaction commits later than a newer event's isn't skipped
+MEMBERSHIP_EVENT_SETTLE_SECONDS = getattr(settings,
+                                          'MEMBERSHIP_EVENT_SETTLE_SECONDS',
+                                          5)
+# path of the file the API calls are recorded into, see talkalot.tracing
+TRACE_FILE = getattr(settings, 'TRACE_FILE', None)
+# database aliases the replay_trace command may write to, the load test
+# databases, never production
+TRACE_REPLAY_DATABASES = getattr(settings, 'TRACE_REPLAY_DATABASES', ())
+# number of participant names stored in the summary of a conversation
+CONVERSATION_SUMMARY_NAMES = getattr(settings, 'CONVERSATION_SUMMARY_NAMES', 3)
+# conversations updated per transaction when the summaries are rebuilt
+CONVERSATION_SUMMARY_BATCH_SIZE = getattr(settings,
+                                          'CONVERSATION_SUMMARY_BATCH_SIZE',
+                                          500)
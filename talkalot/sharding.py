@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""Horizontal sharding of conversations.
+
+List the database aliases in CONVERSATION_SHARDS and put
+`talkalot.routers.ShardRouter` first in DATABASE_ROUTERS. Every conversation,
+along with it's participations and messages, is stored on the shard picked
+by it's id. Conversation ids are allocated by the ParticipantSet directory
+on SHARD_DIRECTORY_DATABASE, which also maps participant sets to
+conversations for `Conversation.objects.for_participants`. The user table is
+expected to live on SHARD_DIRECTORY_DATABASE, and as queries on the shards
+can't join it, the users are read from there separately (`users_by_pk`).
+
+The bulk operations (archiving, purging, sweeping, exporting) go through
+every shard, but the `BulkImporter` doesn't support sharding.
+
+Queries on the shards have to start from a conversation instance (so the
+router can pick the shard from it) or use an explicit `using`, while the
+inbox of a user, which is spread across all shards, is served by
+`inbox_for`. The other per-user calls of the managers (unread_for,
+unread_counts_for, mark_read, leave and search) go through every shard
+themselves. Sharding can't be combined with read replicas.
+"""
+from __future__ import unicode_literals
+
+import hashlib
+import threading
+
+from contextlib import contextmanager
+
+from django.db import connections
+try:
+    from django.db.transaction import atomic
+except ImportError:
+    from django.db.transaction import commit_on_success as atomic
+
+from . import settings
+
+
+# users looked up in the directory at once, below SQLite's limit of query
+# parameters
+USER_LOOKUP_CHUNK_SIZE = 500
+
+
+def is_enabled():
+    return bool(settings.CONVERSATION_SHARDS)
+
+
+def databases():
+    """Return the aliases of the shards, or just None (the database picked
+    by the routers) if sharding is disabled."""
+    if not is_enabled():
+        return [None]
+    return list(settings.CONVERSATION_SHARDS)
+
+
+def shard_for(conversation_id):
+    """Return the alias of the database holding the conversation."""
+    shards = settings.CONVERSATION_SHARDS
+    return shards[conversation_id % len(shards)]
+
+
+def database_for(conversation_id):
+    """Return the alias of the database the conversation is written to,
+    it's shard or the primary database."""
+    if not is_enabled():
+        return settings.PRIMARY_DATABASE
+    return shard_for(conversation_id)
+
+
+def atomic_on_shard(conversation):
+    """Transaction on the shard of the conversation. Without sharding, the
+    transaction the caller started on the default database covers it."""
+    if not is_enabled():
+        return _no_transaction()
+    return atomic(using=shard_for(conversation.pk))
+
+
+@contextmanager
+def _no_transaction():
+    yield
+
+
+def get_user_model():
+    try:
+        # Django 1.5+
+        from django.contrib.auth import get_user_model
+    except ImportError:
+        # Django < 1.5
+        from django.contrib.auth.models import User
+        return User
+    return get_user_model()
+
+
+def users_by_pk(user_ids):
+    """Return a dict mapping the user ids to the users, read from
+    SHARD_DIRECTORY_DATABASE if sharding is enabled, as queries on the shards
+    can't join the user table."""
+    users = get_user_model().objects.all()
+    if is_enabled():
+        users = users.using(settings.SHARD_DIRECTORY_DATABASE)
+    user_ids = sorted(set(user_ids))
+    found = {}
+    for start in range(0, len(user_ids), USER_LOOKUP_CHUNK_SIZE):
+        chunk = user_ids[start:start + USER_LOOKUP_CHUNK_SIZE]
+        found.update((user.pk, user) for user in users.filter(pk__in=chunk))
+    return found
+
+
+def attach_users(participations):
+    """Set the users of the participations from the directory with a single
+    query (per chunk), instead of one query per participation."""
+    users = users_by_pk(p.user_id for p in participations)
+    for participation in participations:
+        participation.user = users[participation.user_id]
+    return participations
+
+
+def participants_key(user_ids):
+    """Return the directory key of a set of participants."""
+    str_ids = '_'.join(str(uid) for uid in sorted(set(user_ids)))
+    return hashlib.sha1(str_ids.encode('ascii')).hexdigest()
+
+
+def allocate_conversation_id():
+    """Reserve a new conversation id in the directory."""
+    from .models import ParticipantSet
+    directory = ParticipantSet.objects.using(settings.SHARD_DIRECTORY_DATABASE)
+    return directory.create(key='').pk
+
+
+def register_participants(conversation):
+    """Update the directory entry of the conversation after it's set of
+    participants changed."""
+    from .models import ParticipantSet
+    user_ids = conversation.participations.values_list('user', flat=True)
+    directory = ParticipantSet.objects.using(settings.SHARD_DIRECTORY_DATABASE)
+    directory.filter(pk=conversation.pk).update(
+        key=participants_key(user_ids)
+    )
+
+
+def conversations_for_participants(manager, user_ids):
+    """Return a queryset of the conversations of the specified participant
+    set, looked up in the directory."""
+    from .models import ParticipantSet
+    directory = ParticipantSet.objects.using(settings.SHARD_DIRECTORY_DATABASE)
+    ids = list(directory.filter(key=participants_key(user_ids))
+                        .values_list('pk', flat=True))
+    if not ids:
+        return manager.none()
+
+    shard = shard_for(ids[0])
+    ids = [pk for pk in ids if shard_for(pk) == shard]
+    return manager.using(shard).filter(pk__in=ids)
+
+
+def last_activity(participation):
+    last_activity = participation.conversation.last_activity
+    if last_activity is None:
+        return (participation.pinned, 0, None)
+    return (participation.pinned, 1, last_activity)
+
+
+def group_by_shard(conversations):
+    """Return a list of (alias, conversation ids) pairs of the shards holding
+    the conversations, in the order of CONVERSATION_SHARDS. If sharding is
+    disabled, there's a single pair of None (the database picked by the
+    routers) and the conversations as they were passed.
+
+    :param conversations: A QuerySet or list of conversations or their ids"""
+    if not is_enabled():
+        return [(None, conversations)]
+
+    grouped = {}
+    for conversation in conversations:
+        conversation_id = getattr(conversation, 'pk', conversation)
+        grouped.setdefault(shard_for(conversation_id), []).append(
+            conversation_id
+        )
+    return [(shard, grouped[shard]) for shard in settings.CONVERSATION_SHARDS
+            if shard in grouped]
+
+
+def query_shards(query, parallel=True):
+    """Call query with the alias of every shard, and return the list of the
+    results, in the order of CONVERSATION_SHARDS.
+
+    :param parallel: Whether the shards should be queried in parallel
+                     threads"""
+    shards = settings.CONVERSATION_SHARDS
+    if not parallel:
+        return [query(shard) for shard in shards]
+
+    results = {}
+    errors = []
+
+    def query_in_thread(shard):
+        try:
+            results[shard] = query(shard)
+        except Exception as exc:
+            errors.append(exc)
+        finally:
+            # threads get their own connections, which won't be reused
+            connections[shard].close()
+
+    threads = [threading.Thread(target=query_in_thread, args=(shard,))
+               for shard in shards]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return [results[shard] for shard in shards]
+
+
+def inbox_for(user, limit=None, parallel=True):
+    """Return a list of the user's active participations from all shards,
+    the most recently active conversations first, after the pinned ones.
+
+    :param user: A User object (request.user probably)
+    :param limit: Optional, maximum number of participations returned
+    :param parallel: Whether the shards should be queried in parallel
+                     threads"""
+    from .models import Participation
+
+    def query(shard):
+        participations = (Participation.objects
+                                       .inbox_for(user, using=shard)
+                                       .select_related('conversation')
+                                       .order_by('-pinned',
+                                                 '-conversation__'
+                                                 'last_activity'))
+        if limit is not None:
+            participations = participations[:limit]
+        return list(participations)
+
+    inbox = [p for participations in query_shards(query, parallel)
+             for p in participations]
+    inbox.sort(key=last_activity, reverse=True)
+    return inbox[:limit] if limit is not None else inbox
@@ -3,3 +3,6 @@ from django.dispatch import Signal
 
 
 message_sent = Signal(providing_args=['instance'])
+conversations_read = Signal(providing_args=['user', 'conversations'])
+conversations_left = Signal(providing_args=['user', 'conversations'])
+unread_digest = Signal(providing_args=['user', 'conversations', 'messages'])
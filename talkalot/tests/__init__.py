@@ -1,2 +1,12 @@
 # -*- coding: utf-8 -*-
 from .test_models import *
+from .test_commands import *
+from .test_routers import *
+from .test_sharding import *
+from .test_export import *
+from .test_importer import *
+from .test_caching import *
+from .test_digest import *
+from .test_compression import *
+from .test_tracing import *
+from .test_indexes import *
@@ -1,12 +1,37 @@
+import os
+import tempfile
+
+
 SECRET_KEY = 'secret'
 
+
+def shard(name):
+    # file based, so the shards can be queried from multiple threads
+    path = os.path.join(tempfile.gettempdir(), 'talkalot_{0}.db'.format(name))
+    return {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': path,
+        'TEST_NAME': path,
+        'TEST': {'NAME': path},
+    }
+
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': ':memory:'
-    }
+    },
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:'
+    },
+    'shard0': shard('shard0'),
+    'shard1': shard('shard1'),
 }
 
+DATABASE_ROUTERS = ['talkalot.routers.ShardRouter',
+                    'talkalot.routers.ReplicaRouter']
+
 INSTALLED_APPS = (
     'django.contrib.auth',
     'django.contrib.contenttypes',
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+from django.core.cache import cache
+from django.test import TestCase
+
+from .. import settings
+from ..caching import (cache_stats, get_or_compute, invalidate,
+                       reset_cache_stats)
+from ..models import Message
+from .test_models import BaseMessagingTestCase, setup_users
+
+
+class GetOrComputeTestCase(TestCase):
+
+    def setUp(self):
+        self._lock_wait = settings.CACHE_LOCK_WAIT
+        self._beta = settings.CACHE_EARLY_REFRESH_BETA
+        self.computed = []
+        reset_cache_stats()
+
+    def tearDown(self):
+        settings.CACHE_LOCK_WAIT = self._lock_wait
+        settings.CACHE_EARLY_REFRESH_BETA = self._beta
+        cache.clear()
+
+    def compute(self):
+        self.computed.append(True)
+        return len(self.computed)
+
+    def set_entry(self, value, expires_at, delta):
+        # as cached by get_or_compute for the current version of the key
+        cache.add('version_key', 'version')
+        cache.set('key', (value, expires_at, delta, cache.get('version_key')))
+
+    def test_miss_and_hit(self):
+        self.assertEqual(get_or_compute('key', self.compute), 1)
+        self.assertEqual(get_or_compute('key', self.compute), 1)
+        self.assertEqual(len(self.computed), 1)
+        stats = cache_stats()
+        self.assertEqual((stats['misses'], stats['hits']), (1, 1))
+
+        invalidate(['key'])
+        self.assertEqual(get_or_compute('key', self.compute), 2)
+        self.assertEqual(get_or_compute('key', self.compute), 2)
+
+    def test_invalidated_while_computing(self):
+        def compute():
+            # e.g. a message is sent after the history was loaded
+            invalidate(['key'])
+            return 'outdated'
+
+        self.assertEqual(get_or_compute('key', compute), 'outdated')
+        # it's not served, not even stale
+        self.assertEqual(get_or_compute('key', self.compute), 1)
+        self.assertEqual(get_or_compute('key', self.compute), 1)
+
+    def test_not_cacheable(self):
+        self.assertEqual(get_or_compute('key', list, cacheable=bool), [])
+        self.assertEqual(cache.get('key'), None)
+
+    def test_single_flight(self):
+        # another process is computing the value
+        cache.add('lock_key', True)
+
+        def finish():
+            time.sleep(0.2)
+            self.set_entry('computed elsewhere', time.time() + 60, 0.2)
+            cache.delete('lock_key')
+
+        thread = threading.Thread(target=finish)
+        thread.start()
+        value = get_or_compute('key', self.compute)
+        thread.join()
+
+        self.assertEqual(value, 'computed elsewhere')
+        self.assertEqual(self.computed, [])
+        self.assertEqual(cache_stats()['waits'], 1)
+
+    def test_waiting_gives_up(self):
+        settings.CACHE_LOCK_WAIT = 0
+        cache.add('lock_key', True)
+        self.assertEqual(get_or_compute('key', self.compute), 1)
+        # the lock of the other process is left alone
+        self.assertTrue(cache.get('lock_key'))
+
+    def test_stale_while_refreshing(self):
+        self.set_entry('stale', time.time() - 1, 0.1)
+        cache.add('lock_key', True)
+        self.assertEqual(get_or_compute('key', self.compute), 'stale')
+        self.assertEqual(cache_stats()['stale'], 1)
+
+        # once nobody else is refreshing it, it's recomputed
+        cache.delete('lock_key')
+        self.assertEqual(get_or_compute('key', self.compute), 1)
+        self.assertEqual(get_or_compute('key', self.compute), 1)
+        self.assertEqual(cache_stats()['refreshes'], 1)
+
+    def test_early_refresh(self):
+        # about to expire, and slow to compute
+        self.set_entry('old', time.time() + 1, 10 ** 9)
+        self.assertEqual(get_or_compute('key', self.compute), 1)
+        self.assertEqual(cache_stats()['refreshes'], 1)
+
+        settings.CACHE_EARLY_REFRESH_BETA = 0
+        self.set_entry('old', time.time() + 1, 10 ** 9)
+        self.assertEqual(get_or_compute('key', self.compute), 'old')
+
+
+class HistoryCacheTestCase(BaseMessagingTestCase):
+
+    @setup_users
+    def test_history_cache(self):
+        message = Message.send_to_users('first',
+                                        self.users['friend0'],
+                                        [self.users['friend1']])
+        conversation = message.conversation
+        self.assertEqual(conversation.history(), [message])
+        with self.assertNumQueries(0):
+            self.assertEqual(conversation.history(), [message])
+
+        # sending invalidates it
+        reply = Message.send_to_conversation('reply',
+                                             self.users['friend1'],
+                                             conversation)
+        self.assertEqual(conversation.history(), [reply, message])
+
+        # and so does purging
+        list(Message.purge(Message.objects.filter(pk=reply.pk)))
+        self.assertEqual(conversation.history(), [message])
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+from datetime import timedelta
+
+from django.core.management import CommandError, call_command
+from django.utils.six import StringIO
+from django.utils.timezone import now
+
+from ..models import (ArchivedMessage, Conversation, Message, Participation,
+                      ScheduledMessage)
+from .test_models import (BaseMessagingTestCase,
+                          BaseMessagingTransactionTestCase, setup_users)
+
+
+class CommandTestMixin(object):
+
+    def call_command(self, name, **options):
+        out = StringIO()
+        call_command(name, stdout=out, **options)
+        return out.getvalue()
+
+
+class CommandTestCase(CommandTestMixin, BaseMessagingTestCase):
+
+    def send_old_messages(self, count, days_ago):
+        message = Message.send_to_users('old message',
+                                        self.users['friend0'],
+                                        [self.users['friend1']])
+        for i in range(count):
+            Message.send_to_conversation('old message',
+                                         self.users['friend1'],
+                                         message.conversation)
+        sent_at = now() - timedelta(days=days_ago)
+        message.conversation.messages.update(sent_at=sent_at)
+        return message.conversation
+
+    @setup_users
+    def test_archive_messages(self):
+        conversation = self.send_old_messages(4, days_ago=30)
+
+        output = self.call_command('archive_messages', days=10, batch_size=3)
+
+        self.assertIn("Archived 4 messages", output)
+        self.assertEqual(ArchivedMessage.objects.count(), 4)
+        self.assertEqual(list(conversation.messages.all()),
+                         [conversation.latest_message])
+
+    @setup_users
+    def test_purge_messages(self):
+        expired = self.send_old_messages(3, days_ago=30)
+        abandoned = Message.send_to_users('new message',
+                                          self.users['friend2'],
+                                          [self.users['friend3'],
+                                           self.users['friend4']])
+        list(ArchivedMessage.archive(now() - timedelta(days=20)))
+        for username in ('friend2', 'friend3', 'friend4'):
+            Participation.objects.leave(self.users[username],
+                                        [abandoned.conversation])
+
+        output = self.call_command('purge_messages', days=10, batch_size=2)
+
+        self.assertIn("Deleted 3 ArchivedMessage objects", output)
+        self.assertIn("Deleted 1 Message objects", output)
+        self.assertIn("Deleted 1 abandoned conversations", output)
+        self.assertEqual(list(Conversation.objects.all()), [expired])
+        self.assertEqual(expired.messages.count(), 0)
+
+    def test_purge_messages_requires_retention_period(self):
+        # Django < 1.5 turns the CommandError into a SystemExit
+        with self.assertRaises((CommandError, SystemExit)):
+            self.call_command('purge_messages')
+
+    @setup_users
+    def test_dispatch_scheduled_messages(self):
+        conversation = self.send_old_messages(0, days_ago=1)
+        for i in range(3):
+            ScheduledMessage.schedule('scheduled', self.users['friend1'],
+                                      conversation, now())
+
+        output = self.call_command('dispatch_scheduled_messages',
+                                   once=True,
+                                   batch_size=2)
+
+        self.assertIn("Sent 3 scheduled messages", output)
+        self.assertEqual(conversation.messages.filter(
+            body='scheduled'
+        ).count(), 3)
+
+    @setup_users
+    def test_sweep_expired_messages(self):
+        conversation = self.send_old_messages(3, days_ago=1)
+        conversation.messages.exclude(
+            pk=conversation.latest_message_id
+        ).update(expires_at=now())
+
+        output = self.call_command('sweep_expired_messages', batch_size=2)
+
+        self.assertIn("Deleted 3 expired messages", output)
+        self.assertEqual(list(conversation.messages.all()),
+                         [conversation.latest_message])
+
+    @setup_users
+    def test_rebuild_conversation_summaries(self):
+        conversation = self.send_old_messages(2, days_ago=1)
+        Conversation.objects.update(summary_names='', summary_member_count=0,
+                                    summary_preview='', last_activity=None)
+
+        output = self.call_command('rebuild_conversation_summaries',
+                                   batch_size=1)
+
+        self.assertIn("rebuilt 1 summaries", output)
+        rebuilt = Conversation.objects.get(pk=conversation.pk)
+        self.assertEqual(rebuilt.summary_participant_names,
+                         ['friend1', 'friend0'])
+        self.assertEqual(rebuilt.summary_member_count, 2)
+        self.assertEqual(rebuilt.summary_preview, 'old message')
+        self.assertEqual(rebuilt.summary_sender, 'friend1')
+        self.assertEqual(rebuilt.last_activity,
+                         rebuilt.latest_message.sent_at)
+
+
+class SearchCommandTestCase(CommandTestMixin,
+                            BaseMessagingTransactionTestCase):
+    # setting up the search index is DDL, which pysqlite commits implicitly
+    # on Django < 1.6, so it can't run inside a test transaction
+
+    @setup_users
+    def test_rebuild_search_index(self):
+        Message.send_to_users('needle in a haystack',
+                              self.users['friend0'],
+                              [self.users['friend1']])
+
+        output = self.call_command('rebuild_search_index')
+
+        self.assertIn("Rebuilt the search index", output)
+        results = Message.objects.search(self.users['friend1'], 'needle')
+        self.assertEqual([m.body for m in results], ['needle in a haystack'])
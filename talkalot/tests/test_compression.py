@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.core.management import call_command
+from django.utils.six import StringIO
+
+from .. import settings
+from ..compression import MARKER, compress_text, decompress_text
+from ..models import ArchivedMessage, Message
+from ..search import SQLiteSearchBackend, get_search_backend
+from .test_models import BaseMessagingTestCase, setup_users
+
+
+LOG = '\n'.join('2014-10-01 12:00:{0:02d} INFO worker: job done'.format(i)
+                for i in range(60))
+
+
+class CompressionTestCase(BaseMessagingTestCase):
+
+    def setUp(self):
+        self._threshold = settings.MESSAGE_COMPRESSION_THRESHOLD
+        settings.MESSAGE_COMPRESSION_THRESHOLD = 200
+
+    def tearDown(self):
+        settings.MESSAGE_COMPRESSION_THRESHOLD = self._threshold
+        super(CompressionTestCase, self).tearDown()
+
+    def stored_body(self, message, model=Message):
+        return model.objects.filter(pk=message.pk).values_list(
+            'body', flat=True
+        )[0]
+
+    def send(self, body):
+        return Message.send_to_users(body,
+                                     self.users['friend0'],
+                                     [self.users['friend1']])
+
+    def test_codec(self):
+        self.assertEqual(compress_text('short'), 'short')
+        compressed = compress_text(LOG)
+        self.assertTrue(compressed.startswith(MARKER))
+        self.assertTrue(len(compressed) < len(LOG) / 4)
+        self.assertEqual(decompress_text(compressed), LOG)
+
+        # text starting with the marker is escaped by compressing it
+        tricky = MARKER + 'not compressed'
+        self.assertNotEqual(compress_text(tricky), tricky)
+        self.assertEqual(decompress_text(compress_text(tricky)), tricky)
+        self.assertEqual(decompress_text(tricky), tricky)
+
+        settings.MESSAGE_COMPRESSION_THRESHOLD = None
+        self.assertEqual(compress_text(LOG), LOG)
+
+    @setup_users
+    def test_large_bodies_are_compressed(self):
+        message = self.send(LOG)
+        self.assertEqual(message.body, LOG)
+        self.assertTrue(self.stored_body(message).startswith(MARKER))
+
+        short = self.send('hello')
+        self.assertEqual(self.stored_body(short), 'hello')
+
+        # exact lookups compress the value too
+        self.assertEqual(list(Message.objects.filter(body=LOG)), [message])
+
+    @setup_users
+    def test_lazy_decompression(self):
+        message = Message.objects.get(pk=self.send(LOG).pk)
+        self.assertTrue(message.__dict__['body'].startswith(MARKER))
+        self.assertEqual(message.preview[:30], LOG[:30])
+        self.assertTrue(len(message.preview) <=
+                        settings.MESSAGE_PREVIEW_LENGTH)
+        self.assertNotIn('\n', message.preview)
+
+        self.assertEqual(message.body, LOG)
+        self.assertEqual(message.__dict__['body'], LOG)
+
+        # saving recompresses the body
+        message.save()
+        self.assertTrue(self.stored_body(message).startswith(MARKER))
+
+    @setup_users
+    def test_compress_messages_command(self):
+        settings.MESSAGE_COMPRESSION_THRESHOLD = None
+        message = self.send(LOG)
+        reply = Message.send_to_conversation('reply',
+                                             self.users['friend1'],
+                                             message.conversation)
+        Message.objects.update(preview='')
+        ArchivedMessage.objects.create(id=10 ** 6,
+                                       body=LOG,
+                                       sender=self.users['friend0'],
+                                       sent_at=message.sent_at,
+                                       conversation=message.conversation)
+        self.assertEqual(self.stored_body(message), LOG)
+
+        settings.MESSAGE_COMPRESSION_THRESHOLD = 200
+        out = StringIO()
+        call_command('compress_messages', batch_size=1, stdout=out)
+        self.assertIn("Rewrote 3 messages", out.getvalue())
+        self.assertTrue(self.stored_body(message).startswith(MARKER))
+        self.assertEqual(self.stored_body(reply), 'reply')
+        archived = ArchivedMessage(pk=10 ** 6)
+        self.assertTrue(self.stored_body(archived, ArchivedMessage)
+                            .startswith(MARKER))
+        self.assertEqual(Message.objects.get(pk=reply.pk).preview, 'reply')
+        self.assertEqual(Message.objects.get(pk=message.pk).body, LOG)
+
+        # nothing left to do
+        out = StringIO()
+        call_command('compress_messages', stdout=out)
+        self.assertIn("Rewrote 0 messages", out.getvalue())
+
+        # and it's reversible
+        settings.MESSAGE_COMPRESSION_THRESHOLD = None
+        call_command('compress_messages', stdout=StringIO())
+        self.assertEqual(self.stored_body(message), LOG)
+
+    @setup_users
+    def test_compressed_bodies_are_searchable(self):
+        message = self.send(LOG + ' needle')
+        self.assertTrue(self.stored_body(message).startswith(MARKER))
+        found = Message.objects.search(self.users['friend1'], 'needle')
+        self.assertEqual(found, [message])
+
+        # the index is rebuilt from the decompressed bodies
+        get_search_backend(Message, 'default').rebuild('default')
+        found = Message.objects.search(self.users['friend1'], 'needle')
+        self.assertEqual(found, [message])
+
+    @setup_users
+    def test_not_compressed_for_the_fallback_search(self):
+        fts5 = SQLiteSearchBackend._fts5.copy()
+        # the fallback matches the stored bodies
+        SQLiteSearchBackend._fts5['default'] = False
+        try:
+            message = self.send(LOG + ' needle')
+            self.assertEqual(self.stored_body(message), LOG + ' needle')
+            found = Message.objects.search(self.users['friend1'], 'needle')
+            self.assertEqual(found, [message])
+            # archived messages aren't searched
+            archived = ArchivedMessage.objects.create(
+                id=10 ** 6,
+                body=LOG,
+                sender=self.users['friend0'],
+                sent_at=message.sent_at,
+                conversation=message.conversation
+            )
+            self.assertTrue(self.stored_body(archived, ArchivedMessage)
+                                .startswith(MARKER))
+        finally:
+            SQLiteSearchBackend._fts5 = fts5
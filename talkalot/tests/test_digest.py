@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+from datetime import timedelta
+
+from django.core.management import call_command
+from django.utils.six import StringIO
+from django.utils.timezone import now
+
+from ..digest import iter_digests, user_ranges
+from ..models import Message, Participation
+from ..signals import unread_digest
+from .test_models import BaseMessagingTestCase, setup_users
+
+
+class DigestTestCase(BaseMessagingTestCase):
+
+    def send_messages(self):
+        users = self.users
+        first = Message.send_to_users('first', users['friend0'],
+                                      [users['friend1'], users['friend2']])
+        self.reply = Message.send_to_conversation('reply', users['friend1'],
+                                                  first.conversation)
+        self.other = Message.send_to_users('other', users['foe0'],
+                                           [users['friend1']])
+        # friend2 read the first conversation
+        Participation.objects.get(conversation=first.conversation,
+                                  user=users['friend2']).read_conversation()
+        self.first = first
+        return first.conversation, self.other.conversation
+
+    def digests(self, **kwargs):
+        since = now() - timedelta(hours=1)
+        return [(d.user.username,
+                 [c.pk for c in d.conversations],
+                 dict((pk, [m.pk for m in messages])
+                      for pk, messages in d.messages.items()))
+                for d in iter_digests(since, **kwargs)]
+
+    @setup_users
+    def test_digests(self):
+        first, other = self.send_messages()
+        expected = [
+            ('friend0', [first.pk], {first.pk: [self.reply.pk]}),
+            ('friend1', [first.pk, other.pk], {first.pk: [self.first.pk],
+                                               other.pk: [self.other.pk]}),
+        ]
+        expected.sort(key=lambda d: self.users[d[0]].pk)
+        # the participations, the users, the candidate messages, and the
+        # digested ones
+        with self.assertNumQueries(4):
+            self.assertEqual(self.digests(), expected)
+        # the chunking doesn't change the result
+        self.assertEqual(self.digests(batch_size=1), expected)
+        self.assertEqual(self.digests(batch_size=2), expected)
+
+        # messages received before the cutoff are left out
+        Message.objects.update(sent_at=now() - timedelta(days=2))
+        self.assertEqual(self.digests(), [])
+
+    @setup_users
+    def test_message_limit(self):
+        first, other = self.send_messages()
+        more = Message.send_to_conversation('more', self.users['foe0'], other)
+        (digest,) = [d for d in self.digests(message_limit=1)
+                     if d[0] == 'friend1']
+        self.assertEqual(digest[2][other.pk], [more.pk])
+
+    @setup_users
+    def test_user_ranges(self):
+        self.send_messages()
+        since = now() - timedelta(hours=1)
+        ranges = user_ranges(since, 3)
+        self.assertTrue(1 <= len(ranges) <= 3)
+
+        digests = []
+        for first_user, last_user in ranges:
+            digests.extend(self.digests(first_user=first_user,
+                                        last_user=last_user))
+        self.assertEqual(digests, self.digests())
+        self.assertEqual(user_ranges(now(), 3), [])
+
+    @setup_users
+    def test_send_unread_digests(self):
+        self.send_messages()
+        received = []
+
+        def receiver(sender, user, conversations, messages, **kwargs):
+            received.append(user.username)
+
+        unread_digest.connect(receiver)
+        try:
+            out = StringIO()
+            call_command('send_unread_digests', stdout=out)
+        finally:
+            unread_digest.disconnect(receiver)
+
+        self.assertEqual(sorted(received), ['friend0', 'friend1'])
+        self.assertIn("Digested 2 users", out.getvalue())
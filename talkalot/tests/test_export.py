@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import tempfile
+
+from datetime import timedelta
+
+from django.core.management import call_command
+from django.utils.six import StringIO
+from django.utils.timezone import now
+
+from ..export import export_user_data
+from ..models import ArchivedMessage, Message, Participation
+from .test_models import BaseMessagingTestCase, setup_users
+
+
+class ExportTestCase(BaseMessagingTestCase):
+
+    def setup_messages(self):
+        fr0, fr1, fr2 = [self.users['friend{0}'.format(i)] for i in range(3)]
+        message = Message.send_to_users('hello', fr0, [fr1])
+        Message.send_to_conversation('hi there', fr1, message.conversation)
+        Message.send_to_users('group', fr1, [fr0, fr2])
+        # friend0 has nothing to do with this one
+        Message.send_to_users('secret', fr1, [fr2])
+
+        message.conversation.messages.update(
+            sent_at=now() - timedelta(days=10)
+        )
+        list(ArchivedMessage.archive(now() - timedelta(days=1)))
+
+    def read_lines(self, output):
+        return [json.loads(line) for line in output.splitlines()]
+
+    @setup_users
+    def test_export(self):
+        self.setup_messages()
+        stream = StringIO()
+
+        rows = export_user_data(self.users['friend0'], stream, batch_size=1)
+
+        records = self.read_lines(stream.getvalue())
+        self.assertEqual(rows, len(records))
+        types = [record['type'] for record in records]
+        self.assertEqual(types, ['participation'] * 2 +
+                                ['archived_message'] +
+                                ['message'] * 2)
+        bodies = [r['body'] for r in records if 'body' in r]
+        self.assertEqual(bodies, ['hello', 'hi there', 'group'])
+        self.assertEqual(records[2]['sender__username'], 'friend0')
+
+    @setup_users
+    def test_only_visible_messages(self):
+        fr0, fr1, fr2 = [self.users['friend{0}'.format(i)] for i in range(3)]
+        message = Message.send_to_users('before', fr1, [fr0, fr2])
+        conversation = message.conversation
+        Message.send_to_conversation('deleted', fr1,
+                                     conversation).soft_delete(fr1)
+        Message.send_to_conversation('ephemeral', fr1, conversation,
+                                     ttl=60)
+        Message.objects.filter(body='ephemeral').update(
+            expires_at=now() - timedelta(seconds=1)
+        )
+        Participation.objects.leave(fr0, [conversation])
+        Message.objects.filter(conversation=conversation).update(
+            sent_at=now() - timedelta(minutes=1)
+        )
+        Message.send_to_conversation('after', fr1, conversation)
+
+        def bodies(user):
+            stream = StringIO()
+            export_user_data(user, stream)
+            return [r['body'] for r in self.read_lines(stream.getvalue())
+                    if 'body' in r]
+
+        self.assertEqual(bodies(fr0), ['before'])
+        self.assertEqual(bodies(fr2), ['before', 'after'])
+
+    @setup_users
+    def test_export_command(self):
+        self.setup_messages()
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            call_command('export_user_data', 'friend2', output=path,
+                         stderr=StringIO())
+            with open(path) as export_file:
+                records = self.read_lines(export_file.read())
+        finally:
+            os.remove(path)
+
+        bodies = [r['body'] for r in records if 'body' in r]
+        self.assertEqual(bodies, ['group', 'secret'])
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import tempfile
+
+from datetime import timedelta
+
+from django.core.management import call_command
+from django.utils.six import StringIO
+from django.utils.timezone import now
+
+from ..importer import BulkImporter
+from ..models import ArchivedMessage, Conversation, Message, Participation
+from .test_models import BaseMessagingTestCase, setup_users
+
+
+class ImporterTestCase(BaseMessagingTestCase):
+
+    def records(self):
+        fr0, fr1, fr2 = [self.users['friend{0}'.format(i)] for i in range(3)]
+        start = now() - timedelta(days=100)
+        return [
+            ([fr1], fr0, start, 'hello'),
+            ([fr0, fr1, fr2], fr0, start + timedelta(hours=1), 'group'),
+            ([fr0], fr1, start + timedelta(hours=2), 'hi'),
+            ([fr0, fr1], fr2, start + timedelta(hours=3), 'group reply'),
+            ([fr1], fr0, start + timedelta(hours=4), 'how are you?'),
+        ]
+
+    @setup_users
+    def test_import(self):
+        records = self.records()
+        # a conversation existing before the import
+        existing = Message.send_to_users('existing',
+                                         self.users['friend3'],
+                                         [self.users['friend4']])
+
+        count = BulkImporter(batch_size=2).run(records)
+        self.assertEqual(count, 5)
+
+        fr0, fr1 = self.users['friend0'], self.users['friend1']
+        (private,) = Conversation.objects.for_participants([fr0, fr1])
+        history = private.history()
+        self.assertEqual([m.body for m in history],
+                         ['how are you?', 'hi', 'hello'])
+        self.assertEqual([m.sent_at for m in history],
+                         [r[2] for r in (records[4], records[2], records[0])])
+        self.assertEqual(history[0].parent, history[1])
+        self.assertEqual(history[1].parent, history[2])
+        self.assertEqual(history[2].parent, None)
+        self.assertEqual(private.latest_message, history[0])
+        self.assertEqual(private.creator, fr0)
+
+        # everything imported counts as read, the replies are remembered
+        participation = private.participations.get(user=fr1)
+        self.assertEqual(participation.read_at, records[4][2])
+        self.assertEqual(participation.replied_at, records[2][2])
+        self.assertEqual(participation.read_watermark, records[4][2])
+        self.assertEqual(history[0].readers(), [fr1])
+        self.assertEqual(Participation.objects.unread_for(fr1).count(), 0)
+
+        self.assertEqual(Conversation.objects.count(), 3)
+        self.assertEqual(Message.objects.count(), 6)
+
+        # and talkalot keeps working on top of the imported data
+        reply = Message.send_to_conversation('reply', fr1, private)
+        self.assertEqual(reply.parent, history[0])
+        self.assertTrue(reply.pk > history[0].pk)
+        results = Message.objects.search(fr1, 'group')
+        self.assertEqual([m.body for m in results], ['group', 'group reply'])
+        Message.send_to_conversation('still works',
+                                     self.users['friend3'],
+                                     existing.conversation)
+
+    @setup_users
+    def test_records_must_be_ordered(self):
+        records = self.records()
+        records.append(([self.users['friend1']],
+                        self.users['friend0'],
+                        records[0][2],
+                        'too late'))
+        with self.assertRaises(ValueError):
+            BulkImporter(batch_size=2).run(records)
+        # refused before the first batch was written
+        self.assertEqual(Conversation.objects.count(), 0)
+        self.assertEqual(Message.objects.count(), 0)
+
+    @setup_users
+    def test_records_are_read_twice(self):
+        with self.assertRaises(TypeError):
+            BulkImporter().run(iter(self.records()))
+
+    @setup_users
+    def test_keys_after_archived_messages(self):
+        fr0, fr1 = self.users['friend0'], self.users['friend1']
+        message = Message.send_to_users('hot', fr0, [fr1])
+        archived = ArchivedMessage.objects.create(
+            id=message.pk + 10,
+            body='archived',
+            sender=fr0,
+            sent_at=message.sent_at,
+            conversation=message.conversation
+        )
+
+        records = [([self.users['friend3']], self.users['friend2'],
+                    now() - timedelta(days=1), 'imported')]
+        BulkImporter().run(records)
+        imported = Message.objects.get(body='imported')
+        self.assertTrue(imported.pk > archived.pk)
+
+    @setup_users
+    def test_existing_conversations_are_refused(self):
+        fr0, fr1 = self.users['friend0'], self.users['friend1']
+        Message.send_to_users('existing', fr0, [fr1])
+        with self.assertRaises(ValueError):
+            BulkImporter(batch_size=1).run(self.records())
+        self.assertEqual(Message.objects.count(), 1)
+        # sending between them still finds the one conversation
+        Message.send_to_users('still works', fr1, [fr0])
+
+    @setup_users
+    def test_import_command(self):
+        handle, path = tempfile.mkstemp()
+        with os.fdopen(handle, 'w') as import_file:
+            for participants, sender, sent_at, body in self.records():
+                import_file.write(json.dumps({
+                    'participants': [u.pk for u in participants],
+                    'sender': sender.pk,
+                    'sent_at': sent_at.isoformat(),
+                    'body': body
+                }) + '\n')
+
+        out = StringIO()
+        try:
+            call_command('import_messages', path, stdout=out)
+        finally:
+            os.remove(path)
+
+        self.assertIn("Imported 5 messages in 2 conversations", out.getvalue())
+        self.assertEqual(Message.objects.count(), 5)
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+import re
+import sqlite3
+
+try:
+    from unittest import skipUnless
+except ImportError:
+    # Python 2.6
+    from django.utils.unittest import skipUnless
+
+from django.core.management import call_command
+from django.db import connection
+from django.utils.six import StringIO
+
+from django.utils.timezone import now
+
+from ..indexes import existing_indexes, supports_partial_indexes
+from ..models import Message, Participation, ScheduledMessage
+from .test_models import BaseMessagingTransactionTestCase, setup_users
+
+
+def query_plan(queryset):
+    sql, params = queryset.query.sql_with_params()
+    cursor = connection.cursor()
+    cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+    return ' / '.join(row[-1] for row in cursor.fetchall())
+
+
+@skipUnless(connection.vendor == 'sqlite' and
+            sqlite3.sqlite_version_info >= (3, 8, 0),
+            "Partial indexes need SQLite 3.8+")
+class ParticipationIndexTestCase(BaseMessagingTransactionTestCase):
+    # changing the indexes is DDL, which pysqlite commits implicitly on
+    # Django < 1.6, so it can't run inside a test transaction
+
+    def assert_uses_index(self, queryset, name):
+        self.assertIn('USING INDEX {0} '.format(name), query_plan(queryset))
+
+    @setup_users
+    def test_query_plans(self):
+        fr0, fr1 = self.users['friend0'], self.users['friend1']
+        message = Message.send_to_users('hi', fr0, [fr1])
+        participations = Participation.objects
+
+        inbox = participations.inbox_for(fr1).order_by('-pinned')
+        self.assert_uses_index(inbox, 'talkalot_participation_active_inbox')
+        self.assert_uses_index(participations.unread_for(fr1),
+                               'talkalot_participation_active_unread')
+        counters = participations.inbox_for(fr1).filter(muted=False,
+                                                        unread_count__gt=0)
+        self.assert_uses_index(counters,
+                               'talkalot_participation_active_unread')
+        # the recipients of a message, through an index on the conversation
+        recipients = message.conversation.active_participations.exclude(
+            user=fr0
+        )
+        plan = query_plan(recipients)
+        self.assertIn('(conversation_id=?', plan)
+        self.assertFalse(re.search(r'SCAN (TABLE )?talkalot_participation\b',
+                                   plan))
+
+    def test_migration(self):
+        table = Participation._meta.db_table
+        cursor = connection.cursor()
+        cursor.execute("DROP INDEX talkalot_participation_active_inbox")
+        for name, columns in (('legacy_deleted_at', 'deleted_at'),
+                              ('legacy_read_at', 'read_at'),
+                              ('custom_pinned',
+                               'user_id, deleted_at, pinned')):
+            cursor.execute("CREATE INDEX {0} ON {1} ({2})".format(name, table,
+                                                                  columns))
+
+        out = StringIO()
+        call_command('migrate_participation_indexes', dry_run=True,
+                     stdout=out)
+        self.assertIn('DROP INDEX "legacy_read_at"', out.getvalue())
+        self.assertIn('legacy_deleted_at', existing_indexes('default'))
+
+        call_command('migrate_participation_indexes', stdout=StringIO())
+        indexes = existing_indexes('default')
+        for name in ('legacy_deleted_at', 'legacy_read_at'):
+            self.assertNotIn(name, indexes)
+        # not declared by any release, so left alone
+        self.assertIn('custom_pinned', indexes)
+        cursor.execute("DROP INDEX custom_pinned")
+        self.assertEqual(indexes['talkalot_participation_active_inbox'],
+                         ['user_id', 'pinned'])
+
+        # nothing left to do
+        out = StringIO()
+        call_command('migrate_participation_indexes', stdout=out)
+        self.assertIn("executed 0 statements", out.getvalue())
+
+    def test_old_sqlite(self):
+        self.assertTrue(supports_partial_indexes('default'))
+        version_info = sqlite3.sqlite_version_info
+        sqlite3.sqlite_version_info = (3, 7, 17)
+        try:
+            self.assertFalse(supports_partial_indexes('default'))
+        finally:
+            sqlite3.sqlite_version_info = version_info
+
+
+@skipUnless(connection.vendor == 'sqlite', "Query plans of SQLite")
+class ScheduledMessageIndexTestCase(BaseMessagingTransactionTestCase):
+
+    def test_due_messages_index(self):
+        indexes = existing_indexes('default', ScheduledMessage._meta.db_table)
+        self.assertEqual(indexes['talkalot_scheduledmessage_due'],
+                         ['status', 'due_at'])
+        due = ScheduledMessage.objects.filter(
+            status=ScheduledMessage.PENDING,
+            due_at__lte=now()
+        ).order_by('due_at')
+        self.assertIn('USING INDEX talkalot_scheduledmessage_due ',
+                      query_plan(due))
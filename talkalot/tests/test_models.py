@@ -1,4 +1,9 @@
 # -*- coding: utf-8 -*-
+import threading
+import time
+
+from datetime import timedelta
+
 try:
     # Django 1.5+
     from django.contrib.auth import get_user_model
@@ -9,11 +14,19 @@ except ImportError:
         return User
 
 from django.core.cache import cache
+from django.db import connection
 from django.test import TestCase, TransactionTestCase
+from django.utils.timezone import now
 
+from .. import readmarkers, settings
 from ..exceptions import MessagingPermissionDenied
-from ..models import Conversation, Participation, Message
-from ..signals import message_sent
+from ..scheduling import run_dispatcher
+from ..search import (SimpleSearchBackend, SQLiteSearchBackend,
+                      get_search_backend)
+from ..models import (ArchivedMessage, Conversation, MembershipEvent,
+                      Participation, Message,
+                      ScheduledMessage)
+from ..signals import conversations_left, conversations_read, message_sent
 
 
 def setup_users(func):
@@ -76,6 +89,25 @@ class BaseMessagingTest(object):
     def tearDown(self):
         cache.clear()
 
+    def send_daily_messages(self, count):
+        message = Message.send_to_users('message 0',
+                                        self.users['friend0'],
+                                        [self.users['friend1']])
+        messages = [message]
+        for i in range(1, count):
+            messages.append(Message.send_to_conversation(
+                'message {0}'.format(i),
+                self.users['friend0'],
+                message.conversation
+            ))
+        # spread the messages one day apart, the latest being sent just now
+        for i, message in enumerate(messages):
+            message.sent_at = now() - timedelta(days=count - i - 1)
+            Message.objects.filter(pk=message.pk).update(
+                sent_at=message.sent_at
+            )
+        return messages
+
 
 class BaseMessagingTestCase(BaseMessagingTest, TestCase):
     pass
@@ -105,6 +137,110 @@ class ConversationTestCase(BaseMessagingTestCase):
         for username in conversation.participant_names:
             self.assertIn(username, ['friend0', 'friend1'])
 
+    @setup_users
+    @setup_conversations
+    def test_with_participants(self):
+        self.conv4.remove_participants([self.users['friend3']])
+        friend0, friend3 = self.users['friend0'], self.users['friend3']
+
+        # the number of queries doesn't depend on the number of conversations
+        with self.assertNumQueries(3):
+            conversations = list(Conversation.objects.with_participants()
+                                                     .order_by('pk'))
+            participants = [c.participants for c in conversations]
+            names = [sorted(c.participant_names) for c in conversations]
+            has_friend0 = [c.has_participant(friend0) for c in conversations]
+            is_read = [c.is_read_by(friend0) for c in conversations
+                       if c.has_participant(friend0)]
+            is_private = [c.is_private for c in conversations]
+
+        self.assertEqual(participants[0], [friend0, self.users['friend1']])
+        self.assertEqual(names, [['friend0', 'friend1'],
+                                 ['foe0', 'foe1'],
+                                 ['friend1', 'friend2'],
+                                 ['friend0', 'friend1']])
+        self.assertEqual(has_friend0, [True, False, False, True])
+        self.assertEqual(is_read, [False, False])
+        self.assertEqual(is_private, [True, True, True, False])
+        self.assertFalse(conversations[3].has_participant(friend3))
+        with self.assertRaises(Participation.DoesNotExist):
+            conversations[1].is_read_by(friend0)
+
+        # changing the participants makes them fresh again
+        conversations[3].add_participants([friend3])
+        self.assertTrue(conversations[3].has_participant(friend3))
+
+    @setup_users
+    @setup_conversations
+    def test_inbox_with_participants(self):
+        inbox = Participation.objects.inbox_for(self.users['friend1'],
+                                                with_participants=True)
+        with self.assertNumQueries(3):
+            names = [sorted(p.conversation.participant_names) for p in inbox]
+
+        self.assertEqual(sorted(names), [['friend0', 'friend1'],
+                                         ['friend0', 'friend1', 'friend3'],
+                                         ['friend1', 'friend2']])
+
+    @setup_users
+    def test_members(self):
+        friends = [self.users['friend{0}'.format(i)] for i in range(5)]
+        # join in reverse alphabetical order
+        conversation = Conversation.start(friends[4], friends[::-1])
+
+        page = conversation.members(limit=2)
+        self.assertEqual([p.user for p in page], [friends[4], friends[3]])
+        page = conversation.members(after=page[-1], limit=2)
+        self.assertEqual([p.user for p in page], [friends[2], friends[1]])
+
+        page = conversation.members(order_by='username', limit=3)
+        self.assertEqual([p.user for p in page], friends[:3])
+        page = conversation.members(order_by='username', after=page[-1],
+                                    limit=3)
+        self.assertEqual([p.user for p in page], friends[3:])
+
+        conversation.remove_participants([friends[0]])
+        self.assertEqual(list(conversation.iter_members('username', 2)),
+                         friends[1:])
+        self.assertEqual(list(conversation.iter_members(batch_size=4)),
+                         friends[:0:-1])
+        with self.assertRaises(ValueError):
+            conversation.members(order_by='age')
+
+    @setup_users
+    def test_cached_membership(self):
+        friend0, friend1, friend2, friend3 = [
+            self.users['friend{0}'.format(i)] for i in range(4)
+        ]
+        conversation = Conversation.start(friend0,
+                                          [friend0, friend1, friend2])
+        # warm up the cache
+        self.assertEqual(conversation.member_count, 3)
+        self.assertTrue(conversation.has_participant(friend1))
+        self.assertFalse(conversation.has_participant(friend3))
+
+        with self.assertNumQueries(0):
+            self.assertEqual(conversation.member_count, 3)
+            self.assertTrue(conversation.has_participant(friend1))
+            self.assertFalse(conversation.has_participant(friend3))
+
+        # joining and leaving invalidate the cache
+        conversation.add_participants([friend3])
+        self.assertEqual(conversation.member_count, 4)
+        self.assertTrue(conversation.has_participant(friend3))
+
+        conversation.remove_participants([friend3])
+        self.assertEqual(conversation.member_count, 3)
+        self.assertFalse(conversation.has_participant(friend3))
+
+        Participation.objects.leave(friend1, [conversation])
+        self.assertEqual(conversation.member_count, 2)
+        self.assertFalse(conversation.has_participant(friend1))
+
+        conversation.add_participants([friend1])
+        self.assertEqual(conversation.member_count, 3)
+        self.assertTrue(conversation.has_participant(friend1))
+
     @setup_users
     @setup_conversations
     def test_containing_participant(self):
@@ -585,13 +721,14 @@ class DataIntegrityTestCase(BaseMessagingTransactionTestCase):
         self.assertEqual(message.conversation.messages.count(),
                          expected_message_count)
 
-        # create a deliberate bug during message sending
-        old_save = Conversation.save
+        # create a deliberate bug during message sending, while updating the
+        # latest message of the conversation
+        old_latest_summary = Conversation.latest_summary
 
-        def failing_save(*args, **kwargs):
+        def failing_latest_summary(message):
             raise Exception()
 
-        Conversation.save = failing_save
+        Conversation.latest_summary = staticmethod(failing_latest_summary)
 
         with self.assertRaises(Exception):
             Message.send_to_conversation(
@@ -601,7 +738,7 @@ class DataIntegrityTestCase(BaseMessagingTransactionTestCase):
                 new_participants=[self.users['friend3']]
             )
 
-        Conversation.save = old_save
+        Conversation.latest_summary = staticmethod(old_latest_summary)
 
         # make sure no side effects happened
         self.assert_participants(message.conversation, expected_participants)
@@ -751,6 +888,230 @@ class ParticipationTestCase(BaseMessagingTestCase):
         fr2_unread = Participation.objects.unread_for(self.users['friend2'])
         self.assertEqual(fr2_unread.count(), 0)
 
+    @setup_users
+    def test_get_unread_counts(self):
+        body = 'private message'
+
+        private = Message.send_to_users(body,
+                                        self.users['friend0'],
+                                        [self.users['friend1']])
+        Message.send_to_conversation(body,
+                                     self.users['friend0'],
+                                     private.conversation)
+        group = Message.send_to_users(
+            body,
+            self.users['friend0'],
+            [self.users['friend1'], self.users['friend2']]
+        )
+
+        # the sender has no unread messages
+        fr0_counts = Participation.objects.unread_counts_for(
+            self.users['friend0']
+        )
+        self.assertEqual(fr0_counts, {})
+
+        fr1_counts = Participation.objects.unread_counts_for(
+            self.users['friend1']
+        )
+        self.assertEqual(fr1_counts, {private.conversation.pk: 2,
+                                      group.conversation.pk: 1})
+
+        # friend1 reads the private conversation and replies to the group
+        (private.conversation.participations
+                             .get(user=self.users['friend1'])
+                             .read_conversation())
+        Message.send_to_conversation(body,
+                                     self.users['friend1'],
+                                     group.conversation)
+
+        fr1_counts = Participation.objects.unread_counts_for(
+            self.users['friend1']
+        )
+        # replying without reading doesn't clear the counter
+        self.assertEqual(fr1_counts, {group.conversation.pk: 1})
+
+        fr2_counts = Participation.objects.unread_counts_for(
+            self.users['friend2']
+        )
+        self.assertEqual(fr2_counts, {group.conversation.pk: 2})
+
+        # the whole inbox is counted with a single query
+        with self.assertNumQueries(1):
+            Participation.objects.unread_counts_for(self.users['friend2'])
+
+    @setup_users
+    def test_inbox_page(self):
+        fr0, fr1, fr2, fr3 = [self.users['friend{0}'.format(i)]
+                              for i in range(4)]
+        private = Message.send_to_users('private', fr0, [fr1])
+        group = Message.send_to_users('group', fr0, [fr1, fr2])
+        group = group.conversation
+        other = Message.send_to_users('other', fr2, [fr3]).conversation
+
+        def inbox(user, page=0):
+            return [p.conversation_id
+                    for p in Participation.objects.inbox_page(user, page, 1)]
+
+        self.assertEqual(inbox(fr1), [group.pk])
+        self.assertEqual(inbox(fr1, 1), [private.conversation.pk])
+        self.assertEqual(inbox(fr1, 2), [])
+        # unchanged inboxes are served from the cache
+        with self.assertNumQueries(0):
+            self.assertEqual(inbox(fr1), [group.pk])
+            self.assertEqual(inbox(fr1, 1), [private.conversation.pk])
+
+        # sending bumps the generation of all the participants' inboxes
+        Message.send_to_conversation('reply', fr0, private.conversation)
+        self.assertEqual(inbox(fr1), [private.conversation.pk])
+        self.assertEqual(inbox(fr0), [private.conversation.pk])
+        # but not of the others
+        inbox(fr3)
+        with self.assertNumQueries(0):
+            inbox(fr3)
+
+        Participation.objects.get(user=fr1, conversation=group).revoke()
+        self.assertEqual(inbox(fr1, 1), [])
+
+        group.add_participants([fr1, fr3])
+        self.assertEqual(inbox(fr1, 1), [group.pk])
+        self.assertEqual(inbox(fr3), [other.pk])
+        self.assertEqual(inbox(fr3, 1), [group.pk])
+
+        Participation.objects.leave(fr3, [group])
+        self.assertEqual(inbox(fr3, 1), [])
+
+    @setup_users
+    def test_mute_and_pin(self):
+        fr0, fr1, fr2 = [self.users['friend{0}'.format(i)] for i in range(3)]
+        private = Message.send_to_users('private', fr0, [fr1]).conversation
+        group = Message.send_to_users('group', fr0, [fr1, fr2]).conversation
+
+        def inbox():
+            return [p.conversation_id
+                    for p in Participation.objects.inbox_page(fr1)]
+
+        self.assertEqual(inbox(), [group.pk, private.pk])
+        participation = Participation.objects.get(user=fr1,
+                                                  conversation=private)
+        participation.pin()
+        self.assertEqual(inbox(), [private.pk, group.pk])
+        participation.pin(False)
+        self.assertEqual(inbox(), [group.pk, private.pk])
+
+        participation = Participation.objects.get(user=fr1,
+                                                  conversation=group)
+        participation.mute()
+        unread = Participation.objects.unread_for(fr1)
+        self.assertEqual([p.conversation_id for p in unread], [private.pk])
+        self.assertEqual(Participation.objects.unread_counts_for(fr1),
+                         {private.pk: 1})
+        # the counter of the muted conversation is still maintained
+        Message.send_to_conversation('more', fr0, group)
+        self.assertEqual(Participation.objects.get(pk=participation.pk)
+                                              .unread_count, 2)
+        unread = Participation.objects.unread_for(fr1, include_muted=True)
+        self.assertEqual(len(unread), 2)
+
+        # marking the whole inbox as read includes the muted ones
+        self.assertEqual(sorted(Participation.objects.mark_read(fr1)),
+                         sorted([private.pk, group.pk]))
+        participation.mute(False)
+        self.assertEqual(Participation.objects.unread_counts_for(fr1), {})
+
+    @setup_users
+    def test_revoke_keeps_concurrent_changes(self):
+        fr0, fr1, fr2 = [self.users['friend{0}'.format(i)] for i in range(3)]
+        group = Message.send_to_users('group', fr0, [fr1, fr2]).conversation
+        stale = Participation.objects.get(user=fr1, conversation=group)
+        # changed since the instance was loaded
+        Participation.objects.get(pk=stale.pk).pin()
+        Message.send_to_conversation('more', fr0, group)
+
+        stale.revoke()
+        stale.reinstate()
+        stored = Participation.objects.get(pk=stale.pk)
+        self.assertEqual((stored.pinned, stored.unread_count), (True, 2))
+        self.assertFalse(stored.is_deleted)
+
+    def _conversations_handler(self, user, conversations, **kwargs):
+        self._signalled.append((user, sorted(conversations)))
+
+    @setup_users
+    def test_bulk_mark_read(self):
+        body = 'private message'
+        messages = [Message.send_to_users(body,
+                                          self.users['friend0'],
+                                          [recipient])
+                    for recipient in (self.users['friend1'],
+                                      self.users['friend2'])]
+        group = Message.send_to_users(
+            body,
+            self.users['friend0'],
+            [self.users['friend1'], self.users['friend2']]
+        )
+        fr1 = self.users['friend1']
+
+        self._signalled = []
+        conversations_read.connect(self._conversations_handler)
+
+        read = Participation.objects.mark_read(fr1, [group.conversation])
+        self.assertEqual(read, [group.conversation.pk])
+        self.assertEqual(Participation.objects.unread_for(fr1).count(), 1)
+
+        # mark the rest of the inbox as read
+        read = Participation.objects.mark_read(fr1)
+        self.assertEqual(read, [messages[0].conversation.pk])
+        self.assertEqual(Participation.objects.unread_for(fr1).count(), 0)
+        self.assertEqual(Participation.objects.unread_counts_for(fr1), {})
+
+        # nothing left to read, nothing gets written or signalled
+        self.assertEqual(Participation.objects.mark_read(fr1), [])
+        self.assertEqual(self._signalled,
+                         [(fr1, [group.conversation.pk]),
+                          (fr1, [messages[0].conversation.pk])])
+        conversations_read.disconnect(self._conversations_handler)
+
+        # friend2 was not affected
+        fr2_unread = Participation.objects.unread_for(self.users['friend2'])
+        self.assertEqual(fr2_unread.count(), 2)
+
+    @setup_users
+    def test_bulk_leave(self):
+        body = 'group message'
+        private = Message.send_to_users(body,
+                                        self.users['friend0'],
+                                        [self.users['friend1']])
+        groups = [Message.send_to_users(body,
+                                        self.users['friend0'],
+                                        [self.users['friend1'], recipient])
+                  for recipient in (self.users['friend2'],
+                                    self.users['friend3'])]
+        conversations = [private.conversation] + [m.conversation
+                                                  for m in groups]
+        fr1 = self.users['friend1']
+
+        self._signalled = []
+        conversations_left.connect(self._conversations_handler)
+
+        left = Participation.objects.leave(fr1, conversations)
+        expected = sorted(m.conversation.pk for m in groups)
+        self.assertEqual(sorted(left), expected)
+
+        # the private conversation can't be left
+        inbox = Participation.objects.inbox_for(fr1)
+        self.assertEqual(list(inbox.values_list('conversation', flat=True)),
+                         [private.conversation.pk])
+
+        # leaving again is a no-op
+        self.assertEqual(Participation.objects.leave(fr1, conversations), [])
+        self.assertEqual(self._signalled, [(fr1, expected)])
+        conversations_left.disconnect(self._conversations_handler)
+
+        for message, username in zip(groups, ('friend2', 'friend3')):
+            self.assert_participants(message.conversation,
+                                     [self.users['friend0'],
+                                      self.users[username]])
+
     def verify_is_read(self, message, by_user, should_have_read):
         is_read = message.conversation.is_read_by(by_user)
         if should_have_read:
@@ -957,3 +1318,945 @@ class ParticipationTestCase(BaseMessagingTestCase):
                                    ('friend2', True),
                                    ('friend3', False)))]
         self.verify_is_read_block(expectations)
+
+
+class ArchiveTestCase(BaseMessagingTestCase):
+
+    @setup_users
+    def test_archive(self):
+        messages = self.send_daily_messages(6)
+        conversation = messages[0].conversation
+
+        cutoff = now() - timedelta(days=2, hours=12)
+        batches = list(ArchivedMessage.archive(cutoff, batch_size=2))
+        self.assertEqual(batches, [2, 1])
+
+        # three oldest messages were moved to the archive
+        self.assertEqual(conversation.messages.count(), 3)
+        self.assertEqual(conversation.archived_messages.count(), 3)
+
+        # and their parent chain is intact
+        archived = [ArchivedMessage.objects.get(pk=m.pk)
+                    for m in messages[:3]]
+        self.assertEqual(archived[0].parent, None)
+        self.assertEqual(archived[1].parent, archived[0])
+        self.assertEqual(archived[2].parent, archived[1])
+        self.assertEqual(archived[2].body, messages[2].body)
+        self.assertEqual(archived[2].sent_at, messages[2].sent_at)
+
+        # the oldest hot message points to it's archived parent
+        oldest_hot = Message.objects.get(pk=messages[3].pk)
+        self.assertEqual(oldest_hot.parent, None)
+        self.assertEqual(oldest_hot.archived_parent, archived[2])
+
+        conversation = Conversation.objects.get(pk=conversation.pk)
+        self.assertEqual(conversation.latest_message, messages[-1])
+
+    @setup_users
+    def test_latest_message_is_not_archived(self):
+        messages = self.send_daily_messages(3)
+        conversation = messages[0].conversation
+
+        list(ArchivedMessage.archive(now() + timedelta(days=1)))
+
+        self.assertEqual(list(conversation.messages.all()), [messages[-1]])
+        self.assertEqual(conversation.archived_messages.count(), 2)
+        self.assertEqual(Message.objects.get(pk=messages[-1].pk).parent_id,
+                         None)
+
+        # the conversation can still be continued
+        reply = Message.send_to_conversation('reply',
+                                             self.users['friend1'],
+                                             conversation)
+        self.assertEqual(reply.parent, messages[-1])
+
+    @setup_users
+    def test_history_falls_through_to_archive(self):
+        messages = self.send_daily_messages(7)
+        conversation = messages[0].conversation
+        cutoff = now() - timedelta(days=3, hours=12)
+        list(ArchivedMessage.archive(cutoff))
+
+        newest_first = [m.pk for m in reversed(messages)]
+
+        first_page = conversation.history(limit=3)
+        self.assertEqual([m.pk for m in first_page], newest_first[:3])
+        self.assertTrue(all(isinstance(m, Message) for m in first_page))
+
+        # the second page is spread over both tables
+        second_page = conversation.history(before=first_page[-1], limit=3)
+        self.assertEqual([m.pk for m in second_page], newest_first[3:6])
+        self.assertTrue(isinstance(second_page[0], Message))
+        self.assertTrue(isinstance(second_page[1], ArchivedMessage))
+
+        third_page = conversation.history(before=second_page[-1], limit=3)
+        self.assertEqual([m.pk for m in third_page], newest_first[6:])
+
+        last_page = conversation.history(before=third_page[-1], limit=3)
+        self.assertEqual(last_page, [])
+
+    @setup_users
+    def test_history_merges_interleaved_archive(self):
+        messages = self.send_daily_messages(5)
+        conversation = messages[0].conversation
+        list(ArchivedMessage.archive(now() - timedelta(days=2, hours=12)))
+        # e.g. imported after the archiving, between the archived messages
+        Message.objects.filter(pk=messages[3].pk).update(
+            sent_at=now() - timedelta(days=3, hours=12)
+        )
+
+        first_page = conversation.history(limit=2)
+        self.assertEqual([m.pk for m in first_page],
+                         [messages[4].pk, messages[2].pk])
+        second_page = conversation.history(before=first_page[-1], limit=2)
+        self.assertEqual([m.pk for m in second_page],
+                         [messages[1].pk, messages[3].pk])
+        self.assertTrue(isinstance(second_page[0], ArchivedMessage))
+        third_page = conversation.history(before=second_page[-1], limit=2)
+        self.assertEqual([m.pk for m in third_page], [messages[0].pk])
+
+
+class PurgeTestCase(BaseMessagingTestCase):
+
+    @setup_users
+    def test_purge_messages(self):
+        messages = self.send_daily_messages(5)
+        conversation = messages[0].conversation
+
+        expired = Message.objects.filter(
+            sent_at__lt=now() - timedelta(days=1, hours=12)
+        )
+        batches = list(Message.purge(expired, batch_size=2))
+        self.assertEqual(batches, [2, 1])
+
+        remaining = [m.pk for m in messages[-2:]]
+        self.assertEqual(sorted(conversation.messages.values_list('pk',
+                                                                  flat=True)),
+                         remaining)
+        # the chain of the remaining messages starts with the oldest one
+        self.assertEqual(Message.objects.get(pk=remaining[0]).parent, None)
+        self.assertEqual(Message.objects.get(pk=remaining[1]).parent_id,
+                         remaining[0])
+
+        # once the latest message expires, the conversation has none
+        (cached,) = Participation.objects.inbox_page(self.users['friend1'])
+        self.assertEqual(cached.conversation.latest_message_id,
+                         remaining[1])
+        list(Message.purge(Message.objects.all()))
+        conversation = Conversation.objects.get(pk=conversation.pk)
+        self.assertEqual(conversation.latest_message, None)
+        # and the inboxes don't show it anymore
+        (page,) = Participation.objects.inbox_page(self.users['friend1'])
+        self.assertEqual(page.conversation.latest_message_id, None)
+
+    @setup_users
+    def test_purge_archived_messages(self):
+        messages = self.send_daily_messages(4)
+        list(ArchivedMessage.archive(now()))
+
+        oldest = ArchivedMessage.objects.filter(pk=messages[0].pk)
+        self.assertEqual(list(ArchivedMessage.purge(oldest)), [1])
+        self.assertEqual(ArchivedMessage.objects.get(pk=messages[1].pk).parent,
+                         None)
+
+        list(ArchivedMessage.purge(ArchivedMessage.objects.all()))
+        self.assertEqual(Message.objects.get(pk=messages[-1].pk)
+                                        .archived_parent,
+                         None)
+
+    @setup_users
+    def test_purge_abandoned_conversations(self):
+        users = [self.users['friend1'], self.users['friend2']]
+        abandoned = Message.send_to_users('msg', self.users['friend0'], users)
+        Message.send_to_conversation('msg2',
+                                     self.users['friend1'],
+                                     abandoned.conversation)
+        kept = Message.send_to_users('msg',
+                                     self.users['friend1'],
+                                     [self.users['friend2'],
+                                      self.users['friend3']])
+
+        for user in [self.users['friend0']] + users:
+            Participation.objects.leave(user, [abandoned.conversation])
+        # one member is still left in the other conversation
+        Participation.objects.leave(self.users['friend1'],
+                                    [kept.conversation])
+
+        batches = list(Conversation.purge_abandoned(batch_size=1))
+        self.assertEqual(batches, [1])
+
+        self.assertEqual(list(Conversation.objects.all()),
+                         [kept.conversation])
+        self.assertFalse(Message.objects.filter(
+            conversation=abandoned.conversation.pk
+        ).exists())
+        self.assertFalse(Participation.objects.filter(
+            conversation=abandoned.conversation.pk
+        ).exists())
+
+
+class SearchTestCase(BaseMessagingTestCase):
+
+    def setup_messages(self):
+        fr0, fr1, fr2 = [self.users['friend{0}'.format(i)] for i in range(3)]
+        bodies = ['the quick brown fox',
+                  'a lazy dog',
+                  'the fox, the fox and the fox',
+                  'brown bread']
+        for body in bodies:
+            Message.send_to_users(body, fr0, [fr1])
+        # a conversation friend1 doesn't participate in
+        Message.send_to_users('the fox again', fr0, [fr2])
+
+    @setup_users
+    def test_search(self):
+        self.setup_messages()
+        fr1 = self.users['friend1']
+
+        results = Message.objects.search(fr1, 'fox')
+        bodies = [m.body for m in results]
+        # the best match comes first
+        self.assertEqual(bodies, ['the fox, the fox and the fox',
+                                  'the quick brown fox'])
+        self.assertTrue(results[0].rank > results[1].rank)
+
+        bodies = [m.body for m in Message.objects.search(fr1, 'Brown FOX')]
+        self.assertEqual(bodies, ['the quick brown fox'])
+
+        self.assertEqual(Message.objects.search(fr1, 'cat'), [])
+        # query syntax is not interpreted
+        self.assertEqual(Message.objects.search(fr1, '"fox* OR (dog'),
+                         [])
+
+        # friend2 only sees it's own conversation
+        bodies = [m.body
+                  for m in Message.objects.search(self.users['friend2'],
+                                                  'fox')]
+        self.assertEqual(bodies, ['the fox again'])
+
+    @setup_users
+    def test_search_pagination(self):
+        self.setup_messages()
+        fr0 = self.users['friend0']
+
+        expected = [m.pk for m in Message.objects.search(fr0, 'the')]
+        self.assertEqual(len(expected), 3)
+
+        first_page = Message.objects.search(fr0, 'the', limit=2)
+        second_page = Message.objects.search(fr0, 'the', limit=2,
+                                             after=first_page[-1])
+        self.assertEqual([m.pk for m in first_page + second_page], expected)
+
+    @setup_users
+    def test_deleted_messages_are_unindexed(self):
+        backend = get_search_backend(Message, 'default')
+        if not isinstance(backend, SQLiteSearchBackend):
+            # the fallback has no index
+            return
+
+        def indexed(word):
+            cursor = connection.cursor()
+            cursor.execute("SELECT rowid FROM {0} WHERE {0} MATCH %s".format(
+                backend.fts_table
+            ), [word])
+            return [row[0] for row in cursor.fetchall()]
+
+        fr0, fr1 = self.users['friend0'], self.users['friend1']
+        archived = Message.send_to_users('a sheep', fr0, [fr1])
+        purged = Message.send_to_users('a wolf', fr0, [fr1])
+        latest = Message.send_to_users('the end', fr0, [fr1])
+        self.assertEqual(indexed('wolf'), [purged.pk])
+
+        # the ids of deleted messages may be reused by new ones, so their
+        # text must not be left in the index
+        self.assertEqual(sum(Message.purge(Message.objects.filter(
+            pk=purged.pk
+        ))), 1)
+        self.assertEqual(indexed('wolf'), [])
+        self.assertEqual(sum(ArchivedMessage.archive(now())), 1)
+        self.assertEqual(indexed('sheep'), [])
+        self.assertEqual(indexed('end'), [latest.pk])
+
+    @setup_users
+    def test_fallback_without_fts5(self):
+        self.setup_messages()
+        fts5 = SQLiteSearchBackend._fts5.copy()
+        SQLiteSearchBackend._fts5['default'] = False
+        try:
+            self.assertTrue(isinstance(get_search_backend(Message, 'default'),
+                                       SimpleSearchBackend))
+            bodies = [m.body for m in Message.objects.search(
+                self.users['friend1'],
+                'brown fox'
+            )]
+        finally:
+            SQLiteSearchBackend._fts5 = fts5
+        self.assertEqual(bodies, ['the quick brown fox'])
+
+
+class ScheduledMessageTestCase(BaseMessagingTestCase):
+
+    def setup_group(self):
+        message = Message.send_to_users('group message',
+                                        self.users['friend0'],
+                                        [self.users['friend1'],
+                                         self.users['friend2']])
+        return message.conversation
+
+    @setup_users
+    def test_dispatch_due(self):
+        conversation = self.setup_group()
+        fr0, fr1 = self.users['friend0'], self.users['friend1']
+        for i in range(3):
+            ScheduledMessage.schedule('due {0}'.format(i), fr1, conversation,
+                                      now() - timedelta(minutes=i))
+        ScheduledMessage.schedule('later', fr0, conversation,
+                                  now() + timedelta(hours=1))
+
+        with self.assertRaises(MessagingPermissionDenied):
+            ScheduledMessage.schedule('intruder', self.users['foe0'],
+                                      conversation, now())
+
+        self.assertEqual(list(ScheduledMessage.dispatch_due(batch_size=2)),
+                         [2, 1])
+        # delivered through the normal send path, the longest overdue first
+        history = conversation.history()
+        self.assertEqual([m.body for m in history[:3]],
+                         ['due 0', 'due 1', 'due 2'])
+        self.assertEqual(history[0].sender, fr1)
+        self.assertEqual(Participation.objects.get(
+            user=fr0,
+            conversation=conversation
+        ).unread_count, 3)
+
+        statuses = dict(ScheduledMessage.objects.values_list('body',
+                                                             'status'))
+        self.assertEqual(statuses, {'due 0': ScheduledMessage.SENT,
+                                    'due 1': ScheduledMessage.SENT,
+                                    'due 2': ScheduledMessage.SENT,
+                                    'later': ScheduledMessage.PENDING})
+        self.assertEqual(list(ScheduledMessage.dispatch_due()), [])
+
+    @setup_users
+    def test_run_dispatcher(self):
+        conversation = self.setup_group()
+        ScheduledMessage.schedule('due', self.users['friend1'], conversation,
+                                  now())
+        stop = threading.Event()
+
+        def delivered(count):
+            stop.set()
+
+        self.assertEqual(run_dispatcher(stop=stop, callback=delivered), 1)
+        conversation = Conversation.objects.get(pk=conversation.pk)
+        self.assertEqual(conversation.latest_message.body, 'due')
+
+    @setup_users
+    def test_dispatcher_survives_errors(self):
+        conversation = self.setup_group()
+        fr1 = self.users['friend1']
+        broken = ScheduledMessage.schedule('broken', fr1, conversation,
+                                           now() - timedelta(minutes=1))
+        ScheduledMessage.schedule('fine', fr1, conversation, now())
+
+        def receiver(instance, **kwargs):
+            if instance.body == 'broken':
+                raise RuntimeError("receiver failed")
+
+        stop = threading.Event()
+
+        def delivered(count):
+            # the batch of the broken message delivers nothing
+            if count:
+                stop.set()
+
+        message_sent.connect(receiver)
+        try:
+            self.assertEqual(run_dispatcher(batch_size=1, stop=stop,
+                                            callback=delivered), 1)
+        finally:
+            message_sent.disconnect(receiver)
+
+        broken = ScheduledMessage.objects.get(pk=broken.pk)
+        self.assertEqual(broken.status, ScheduledMessage.FAILED)
+        self.assertEqual(broken.error, 'RuntimeError: receiver failed')
+        self.assertEqual(ScheduledMessage.objects.get(body='fine').status,
+                         ScheduledMessage.SENT)
+
+    @setup_users
+    def test_no_double_delivery(self):
+        conversation = self.setup_group()
+        ScheduledMessage.schedule('once', self.users['friend1'],
+                                  conversation, now())
+
+        # two dispatchers racing for the same message
+        (claimed,) = ScheduledMessage.claim_due()
+        self.assertEqual(ScheduledMessage.claim_due(), [])
+
+        # the first one stalls past the claim timeout, so it's claim is
+        # released and taken over by the second one
+        ScheduledMessage.objects.update(
+            claimed_at=now() - timedelta(days=1)
+        )
+        (taken_over,) = ScheduledMessage.claim_due()
+        self.assertNotEqual(claimed.claim_token, taken_over.claim_token)
+
+        self.assertEqual(claimed.deliver(), None)
+        self.assertEqual(taken_over.deliver().body, 'once')
+        self.assertEqual(taken_over.deliver(), None)
+        self.assertEqual(conversation.messages.filter(body='once').count(),
+                         1)
+
+    @setup_users
+    def test_sender_left(self):
+        conversation = self.setup_group()
+        fr1 = self.users['friend1']
+        scheduled = ScheduledMessage.schedule('too late', fr1, conversation,
+                                              now())
+        conversation.remove_participants([fr1])
+
+        self.assertEqual(list(ScheduledMessage.dispatch_due()), [0])
+        scheduled = ScheduledMessage.objects.get(pk=scheduled.pk)
+        self.assertEqual(scheduled.status, ScheduledMessage.FAILED)
+        self.assertIn('not participating', scheduled.error)
+        self.assertFalse(conversation.messages.filter(
+            body='too late'
+        ).exists())
+
+
+class EphemeralMessageTestCase(BaseMessagingTestCase):
+
+    def send_messages(self, count):
+        message = Message.send_to_users('message 0',
+                                        self.users['friend0'],
+                                        [self.users['friend1'],
+                                         self.users['friend2']])
+        messages = [message]
+        for i in range(1, count):
+            messages.append(Message.send_to_conversation(
+                'message {0}'.format(i),
+                self.users['friend1'],
+                message.conversation
+            ))
+        return messages
+
+    def expire(self, *messages):
+        Message.objects.filter(pk__in=[m.pk for m in messages]).update(
+            expires_at=now() - timedelta(seconds=1)
+        )
+
+    @setup_users
+    def test_ttl(self):
+        (message,) = self.send_messages(1)
+        self.assertEqual(message.expires_at, None)
+        conversation = message.conversation
+
+        message = Message.send_to_conversation('ephemeral',
+                                               self.users['friend0'],
+                                               conversation,
+                                               ttl=60)
+        expires_in = message.expires_at - now()
+        self.assertTrue(timedelta(seconds=50) < expires_in)
+        self.assertTrue(expires_in <= timedelta(seconds=60))
+        self.assertFalse(message.is_expired)
+
+        # the conversation's ttl is the default
+        conversation.message_ttl = 3600
+        conversation.save()
+        message = Message.send_to_conversation('ephemeral',
+                                               self.users['friend0'],
+                                               conversation)
+        self.assertTrue(message.expires_at - now() > timedelta(minutes=59))
+        message = Message.send_to_conversation('ephemeral',
+                                               self.users['friend0'],
+                                               conversation,
+                                               ttl=60)
+        self.assertTrue(message.expires_at - now() <= timedelta(minutes=1))
+
+    @setup_users
+    def test_expired_messages_are_hidden(self):
+        fr0 = self.users['friend0']
+        (first,) = self.send_messages(1)
+        conversation = first.conversation
+        ephemeral = Message.send_to_conversation('message 1', fr0,
+                                                 conversation, ttl=1)
+        last = Message.send_to_conversation('message 2', fr0, conversation)
+        self.assertEqual(conversation.history(), [last, ephemeral, first])
+
+        time.sleep(1.1)
+        # both from the cached and from the uncached history
+        self.assertEqual(conversation.history(), [last, first])
+        self.assertEqual(conversation.history(limit=5), [last, first])
+
+        results = Message.objects.search(fr0, 'message')
+        self.assertEqual(sorted(m.pk for m in results), [first.pk, last.pk])
+
+    @setup_users
+    def test_sweep_expired(self):
+        messages = self.send_messages(5)
+        conversation = messages[0].conversation
+        self.expire(messages[1], messages[2], messages[4])
+        # not yet expired
+        Message.objects.filter(pk=messages[3].pk).update(
+            expires_at=now() + timedelta(hours=1)
+        )
+
+        self.assertEqual(list(Message.sweep_expired(batch_size=2)), [2, 1])
+
+        remaining = list(Message.objects.order_by('sent_at', 'pk'))
+        self.assertEqual(remaining, [messages[0], messages[3]])
+        # the chain skips the deleted messages
+        self.assertEqual(remaining[1].parent, messages[0])
+        conversation = Conversation.objects.get(pk=conversation.pk)
+        self.assertEqual(conversation.latest_message, messages[3])
+        self.assertEqual(conversation.history(), [messages[3], messages[0]])
+
+        self.assertEqual(list(Message.sweep_expired()), [])
+
+
+class ReadMarkerTestCase(BaseMessagingTestCase):
+
+    def setUp(self):
+        self._settings = (settings.READ_MARKER_WRITE_BEHIND,
+                          settings.READ_MARKER_MAX_LAG)
+        settings.READ_MARKER_WRITE_BEHIND = True
+        settings.READ_MARKER_MAX_LAG = 3600
+
+    def tearDown(self):
+        readmarkers.flush()
+        (settings.READ_MARKER_WRITE_BEHIND,
+         settings.READ_MARKER_MAX_LAG) = self._settings
+        super(ReadMarkerTestCase, self).tearDown()
+
+    def get_participation(self, username, conversation):
+        return Participation.objects.get(user=self.users[username],
+                                         conversation=conversation)
+
+    @setup_users
+    def test_write_behind(self):
+        fr1 = self.users['friend1']
+        message = Message.send_to_users('hello',
+                                        self.users['friend0'],
+                                        [fr1, self.users['friend2']])
+        conversation = message.conversation
+        participation = self.get_participation('friend1', conversation)
+
+        with self.assertNumQueries(0):
+            participation.read_conversation()
+
+        # not yet in the database, but visible already
+        self.assertEqual(self.get_participation('friend1',
+                                                conversation).read_at, None)
+        self.assertTrue(conversation.is_read_by(fr1))
+        self.assertFalse(Participation.objects.unread_for(fr1).exists())
+        self.assertEqual(Participation.objects.unread_counts_for(fr1), {})
+
+        self.assertEqual(readmarkers.flush(), 1)
+        stored = self.get_participation('friend1', conversation)
+        self.assertEqual(stored.read_at, participation.read_at)
+        self.assertEqual(stored.read_watermark, participation.read_at)
+        self.assertEqual(stored.unread_count, 0)
+
+    @setup_users
+    def test_written_to_primary(self):
+        fr1 = self.users['friend1']
+        message = Message.send_to_users('hello', self.users['friend0'], [fr1])
+        participation = self.get_participation('friend1',
+                                               message.conversation)
+        # as if it was loaded from a read replica
+        participation._state.db = 'replica'
+        participation.read_conversation()
+
+        # cached while the marker is still pending
+        (cached,) = Participation.objects.inbox_page(fr1)
+        self.assertEqual(cached.read_at, None)
+
+        self.assertEqual(readmarkers.flush(), 1)
+        self.assertEqual(self.get_participation('friend1',
+                                                message.conversation).read_at,
+                         participation.read_at)
+        # the flush refreshed the inbox
+        (page,) = Participation.objects.inbox_page(fr1)
+        self.assertEqual(page.read_at, participation.read_at)
+
+    @setup_users
+    def test_messages_received_before_flush(self):
+        fr1 = self.users['friend1']
+        message = Message.send_to_users('hello',
+                                        self.users['friend0'],
+                                        [fr1, self.users['friend2']])
+        conversation = message.conversation
+        self.get_participation('friend1', conversation).read_conversation()
+        Message.send_to_conversation('unread', self.users['friend0'],
+                                     conversation)
+
+        self.assertFalse(conversation.is_read_by(fr1))
+        self.assertEqual(Participation.objects.unread_counts_for(fr1),
+                         {conversation.pk: 2})
+
+        readmarkers.flush()
+        stored = self.get_participation('friend1', conversation)
+        self.assertTrue(stored.read_at < conversation.latest_message.sent_at)
+        self.assertEqual(stored.unread_count, 1)
+
+    @setup_users
+    def test_reply_before_flush(self):
+        fr0, fr1 = self.users['friend0'], self.users['friend1']
+        message = Message.send_to_users('hello', fr0,
+                                        [fr1, self.users['friend2']])
+        conversation = message.conversation
+        self.get_participation('friend1', conversation).read_conversation()
+        reply = Message.send_to_conversation('reply', fr1, conversation)
+
+        readmarkers.flush()
+        stored = self.get_participation('friend1', conversation)
+        self.assertEqual(stored.unread_count, 0)
+        self.assertFalse(stored.read_at < reply.sent_at)
+        self.assertFalse(Participation.objects.unread_for(fr1).exists())
+
+        # the sender's own messages aren't counted when the marker is
+        # flushed later, e.g. by another process
+        participation = self.get_participation('friend1', conversation)
+        participation.read_conversation()
+        Message.send_to_conversation('more', fr1, conversation)
+        Message.send_to_conversation('unread', fr0, conversation)
+        readmarkers.record(participation)
+        self.assertEqual(readmarkers.flush(), 1)
+        self.assertEqual(self.get_participation('friend1',
+                                                conversation).unread_count, 1)
+
+    @setup_users
+    def test_only_moves_forward(self):
+        message = Message.send_to_users('hello',
+                                        self.users['friend0'],
+                                        [self.users['friend1']])
+        conversation = message.conversation
+        stale = self.get_participation('friend1', conversation)
+        stale.read_conversation()
+        readmarkers.flush()
+
+        # a newer read was written directly
+        later = now() + timedelta(minutes=1)
+        Participation.objects.filter(pk=stale.pk).update(read_at=later)
+        stale.read_conversation()
+        readmarkers.flush()
+        self.assertEqual(self.get_participation('friend1',
+                                                conversation).read_at, later)
+
+    @setup_users
+    def test_lag_bound(self):
+        message = Message.send_to_users('hello',
+                                        self.users['friend0'],
+                                        [self.users['friend1']])
+        settings.READ_MARKER_MAX_LAG = 0
+        participation = self.get_participation('friend1',
+                                               message.conversation)
+        participation.read_conversation()
+        self.assertEqual(readmarkers.flush(), 0)
+        self.assertEqual(self.get_participation('friend1',
+                                                message.conversation).read_at,
+                         participation.read_at)
+
+
+class ReadReceiptTestCase(BaseMessagingTestCase):
+
+    def read(self, username, conversation):
+        Participation.objects.get(
+            user=self.users[username],
+            conversation=conversation
+        ).read_conversation()
+
+    @setup_users
+    def test_read_receipts(self):
+        fr0 = self.users['friend0']
+        recipients = [self.users['friend{0}'.format(i)] for i in (1, 2, 3)]
+        first = Message.send_to_users('first', fr0, recipients)
+        conversation = first.conversation
+        self.read('friend1', conversation)
+        self.read('friend2', conversation)
+        second = Message.send_to_conversation('second', fr0, conversation)
+        self.read('friend1', conversation)
+        # friend1 replies, having read everything
+        third = Message.send_to_conversation('third', recipients[0],
+                                             conversation)
+
+        self.assertEqual(sorted(u.username for u in first.readers()),
+                         ['friend1', 'friend2'])
+        self.assertEqual([u.username for u in second.readers()],
+                         ['friend1'])
+        self.assertEqual(third.readers(), [])
+
+        with self.assertNumQueries(1):
+            counts = conversation.seen_counts()
+        self.assertEqual(counts, [(third.pk, 0),
+                                  (second.pk, 1),
+                                  (first.pk, 2)])
+        self.assertEqual(conversation.seen_counts(limit=1), [(third.pk, 0)])
+
+        # friend2's read_at was cleared by the new messages, but it's
+        # watermark still counts for the first one
+        Participation.objects.mark_read(recipients[2])
+        self.assertEqual(conversation.seen_counts(), [(third.pk, 1),
+                                                      (second.pk, 2),
+                                                      (first.pk, 3)])
+
+        # members who left don't count
+        conversation.remove_participants([self.users['friend2']])
+        self.assertEqual(conversation.seen_counts()[-1], (first.pk, 2))
+
+
+class MembershipEventTestCase(BaseMessagingTestCase):
+
+    def events(self, after=None, limit=100):
+        return [(e.conversation_id, e.user.username, e.kind)
+                for e in MembershipEvent.read(after, limit, settle_seconds=0)]
+
+    @setup_users
+    def test_membership_events(self):
+        fr0, fr1, fr2, fr3 = [self.users['friend{0}'.format(i)]
+                              for i in range(4)]
+        conversation = Conversation.start(fr0, [fr0, fr1, fr2])
+        pk = conversation.pk
+        joined = self.events()
+        self.assertEqual(sorted(joined), [(pk, 'friend0', 'joined'),
+                                          (pk, 'friend1', 'joined'),
+                                          (pk, 'friend2', 'joined')])
+
+        cursor = MembershipEvent.objects.order_by('-pk')[0].pk
+        conversation.remove_participants([fr1, fr2, fr3])
+        participation = Participation.objects.get(conversation=conversation,
+                                                  user=fr1)
+        participation.reinstate()
+        # revoking twice is logged once
+        participation.revoke()
+        participation.revoke()
+        conversation.add_participants([fr2, fr3])
+        Participation.objects.leave(fr3, [conversation])
+        self.assertEqual(self.events(cursor), [
+            (pk, 'friend1', 'left'),
+            (pk, 'friend2', 'left'),
+            (pk, 'friend1', 'rejoined'),
+            (pk, 'friend1', 'left'),
+            (pk, 'friend3', 'joined'),
+            (pk, 'friend2', 'rejoined'),
+            (pk, 'friend3', 'left'),
+        ])
+
+        # consumed in batches from the cursor
+        batches = list(MembershipEvent.iter_batches(batch_size=4,
+                                                    settle_seconds=0))
+        self.assertEqual([len(batch) for batch in batches], [4, 4, 2])
+        self.assertEqual(list(MembershipEvent.iter_batches(
+            batches[-1][-1].pk, settle_seconds=0
+        )), [])
+
+        # fresh events are held back until they settle
+        self.assertEqual(MembershipEvent.read(), [])
+
+    @setup_users
+    def test_private_conversations_are_not_left(self):
+        message = Message.send_to_users('hi', self.users['friend0'],
+                                        [self.users['friend1']])
+        count = MembershipEvent.objects.count()
+        message.conversation.remove_participants([self.users['friend1']])
+        self.assertEqual(MembershipEvent.objects.count(), count)
+
+
+class MessageEditTestCase(BaseMessagingTestCase):
+
+    def send_messages(self):
+        fr0, fr1 = self.users['friend0'], self.users['friend1']
+        first = Message.send_to_users('first draft', fr0, [fr1])
+        conversation = first.conversation
+        second = Message.send_to_conversation('second', fr1, conversation)
+        third = Message.send_to_conversation('third', fr0, conversation)
+        return conversation, first, second, third
+
+    def inbox(self, user):
+        return [p.conversation.summary_preview
+                for p in Participation.objects.inbox_page(user)]
+
+    @setup_users
+    def test_edit(self):
+        conversation, first, second, third = self.send_messages()
+        first.edit(self.users['friend0'], 'first edition')
+
+        edited = Message.objects.get(pk=first.pk)
+        self.assertEqual(edited.body, 'first edition')
+        self.assertEqual(edited.preview, 'first edition')
+        self.assertTrue(edited.edited_at is not None)
+        self.assertEqual([m.body for m in conversation.history()],
+                         ['third', 'second', 'first edition'])
+        self.assertEqual(Message.objects.get(pk=second.pk).parent_id,
+                         first.pk)
+
+        # only the sender can edit it
+        self.assertRaises(MessagingPermissionDenied, second.edit,
+                          self.users['friend0'], 'hijacked')
+
+        # the search index follows the edit
+        search = Message.objects.search
+        self.assertEqual(search(self.users['friend1'], 'edition'), [edited])
+        self.assertEqual(search(self.users['friend1'], 'draft'), [])
+
+    @setup_users
+    def test_soft_delete(self):
+        conversation, first, second, third = self.send_messages()
+        second.soft_delete(self.users['friend1'])
+
+        tombstone = Message.objects.get(pk=second.pk)
+        self.assertTrue(tombstone.is_deleted)
+        self.assertEqual((tombstone.body, tombstone.preview), ('', ''))
+        # the chain is intact
+        self.assertEqual(Message.objects.get(pk=third.pk).parent_id,
+                         second.pk)
+        self.assertEqual(tombstone.parent_id, first.pk)
+        self.assertEqual([m.pk for m in conversation.history()],
+                         [third.pk, second.pk, first.pk])
+
+        self.assertRaises(MessagingPermissionDenied, second.edit,
+                          self.users['friend1'], 'undead')
+        # deleting twice does nothing
+        with self.assertNumQueries(0):
+            second.soft_delete(self.users['friend1'])
+
+    @setup_users
+    def test_caches(self):
+        conversation, first, second, third = self.send_messages()
+        fr0 = self.users['friend0']
+        for i in range(settings.CONVERSATION_HISTORY_PAGE_SIZE - 1):
+            latest = Message.send_to_conversation('more', fr0, conversation)
+        self.assertEqual(self.inbox(fr0), ['more'])
+        conversation.history()
+
+        # the first message isn't on the cached history page, and it's not
+        # the latest message, so nothing is invalidated
+        first.edit(fr0, 'edited')
+        with self.assertNumQueries(0):
+            self.assertEqual(self.inbox(fr0), ['more'])
+            conversation.history()
+
+        # third is on the history page, but not in the inboxes
+        third.edit(fr0, 'edited')
+        self.assertEqual(conversation.history()[-1].body, 'edited')
+        with self.assertNumQueries(0):
+            self.assertEqual(self.inbox(fr0), ['more'])
+
+        # the latest message shows in the inboxes
+        latest.soft_delete(fr0)
+        self.assertEqual(self.inbox(fr0), [''])
+        self.assertEqual(self.inbox(self.users['friend1']), [''])
+        self.assertEqual(conversation.history()[0].body, '')
+
+
+class ConversationSummaryTestCase(BaseMessagingTestCase):
+
+    def summary(self, conversation):
+        conversation = Conversation.objects.get(pk=conversation.pk)
+        return (conversation.summary_participant_names,
+                conversation.summary_member_count,
+                conversation.summary_preview,
+                conversation.summary_sender)
+
+    @setup_users
+    def test_send(self):
+        fr0, fr1 = self.users['friend0'], self.users['friend1']
+        message = Message.send_to_users('hello', fr0, [fr1])
+        conversation = message.conversation
+        # the names are in the order the participants joined, and the sender
+        # joins after the recipients
+        self.assertEqual(self.summary(conversation),
+                         (['friend1', 'friend0'], 2, 'hello', 'friend0'))
+        self.assertEqual(conversation.summary_preview, 'hello')
+        self.assertEqual(
+            Conversation.objects.get(pk=conversation.pk).last_activity,
+            message.sent_at
+        )
+
+        Message.send_to_conversation('hi', fr1, conversation)
+        self.assertEqual(self.summary(conversation),
+                         (['friend1', 'friend0'], 2, 'hi', 'friend1'))
+
+    @setup_users
+    def test_membership(self):
+        fr0, fr1, fr2, fr3 = [self.users['friend{0}'.format(i)]
+                              for i in range(4)]
+        message = Message.send_to_users('hello', fr0, [fr1, fr2])
+        conversation = message.conversation
+
+        Message.send_to_conversation('welcome', fr0, conversation, [fr3])
+        self.assertEqual(self.summary(conversation),
+                         (['friend1', 'friend2', 'friend0'], 4, 'welcome',
+                          'friend0'))
+        self.assertEqual(conversation.summary_member_count, 4)
+
+        conversation.participations.get(user=fr1).revoke()
+        self.assertEqual(self.summary(conversation)[:2],
+                         (['friend2', 'friend0', 'friend3'], 3))
+
+        Participation.objects.leave(fr0, [conversation])
+        self.assertEqual(self.summary(conversation)[:2],
+                         (['friend2', 'friend3'], 2))
+
+        conversation.remove_participants([fr2])
+        conversation.participations.get(user=fr1).reinstate()
+        self.assertEqual(self.summary(conversation)[:2],
+                         (['friend1', 'friend3'], 2))
+
+    @setup_users
+    def test_membership_refreshes_the_inboxes(self):
+        fr0, fr1, fr2, fr3 = [self.users['friend{0}'.format(i)]
+                              for i in range(4)]
+        conversation = Message.send_to_users('hello', fr0,
+                                             [fr1, fr2]).conversation
+
+        def member_count(user):
+            (participation,) = Participation.objects.inbox_page(user)
+            return participation.conversation.summary_member_count
+
+        # the cached inbox pages of the members who stay show the new counts
+        self.assertEqual(member_count(fr1), 3)
+        conversation.add_participants([fr3])
+        self.assertEqual(member_count(fr1), 4)
+        conversation.participations.get(user=fr2).revoke()
+        self.assertEqual(member_count(fr1), 3)
+        conversation.participations.get(user=fr2).reinstate()
+        self.assertEqual(member_count(fr1), 4)
+        Participation.objects.leave(fr0, [conversation])
+        self.assertEqual(member_count(fr1), 3)
+        conversation.remove_participants([fr3])
+        self.assertEqual(member_count(fr1), 2)
+
+    @setup_users
+    def test_edit_and_delete(self):
+        fr0, fr1 = self.users['friend0'], self.users['friend1']
+        first = Message.send_to_users('first', fr0, [fr1])
+        conversation = first.conversation
+        second = Message.send_to_conversation('second', fr0, conversation)
+
+        first.edit(fr0, 'edited')
+        self.assertEqual(self.summary(conversation)[2], 'second')
+        second.edit(fr0, 'edited')
+        self.assertEqual(self.summary(conversation)[2], 'edited')
+        second.soft_delete(fr0)
+        self.assertEqual(self.summary(conversation)[2:], ('', 'friend0'))
+
+    @setup_users
+    def test_inbox_page_reads_the_summary(self):
+        fr0 = self.users['friend0']
+        for i in range(3):
+            Message.send_to_users('hello', fr0,
+                                  [self.users['friend{0}'.format(i + 1)]])
+        # the inbox page itself, and nothing for rendering it
+        with self.assertNumQueries(1):
+            page = Participation.objects.inbox_page(fr0)
+            rendered = [(p.conversation.summary_participant_names,
+                         p.conversation.summary_member_count,
+                         p.conversation.summary_preview,
+                         p.conversation.summary_sender,
+                         p.conversation.last_activity)
+                        for p in page]
+        self.assertEqual([names for names, _, _, _, _ in rendered],
+                         [['friend3', 'friend0'],
+                          ['friend2', 'friend0'],
+                          ['friend1', 'friend0']])
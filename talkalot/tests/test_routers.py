@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+from django.core.cache import cache
+from django.utils.timezone import now
+
+from .. import settings
+from ..models import (Conversation, Message, Participation,
+                      ScheduledMessage)
+from ..routers import ReplicaRouter, use_primary
+from .test_models import BaseMessagingTestCase, get_user_model, setup_users
+
+
+class ReplicaRoutingTestCase(BaseMessagingTestCase):
+    multi_db = True
+
+    def setUp(self):
+        self._replicas = settings.READ_REPLICA_DATABASES
+        # the replica database of the tests never receives any data, so every
+        # query routed to it comes back empty
+        settings.READ_REPLICA_DATABASES = ('replica',)
+
+    def tearDown(self):
+        settings.READ_REPLICA_DATABASES = self._replicas
+        super(ReplicaRoutingTestCase, self).tearDown()
+
+    def test_router(self):
+        router = ReplicaRouter()
+        User = get_user_model()
+
+        self.assertEqual(router.db_for_read(Message), 'replica')
+        self.assertEqual(router.db_for_write(Message), 'default')
+        self.assertEqual(router.db_for_read(User), None)
+
+        with use_primary():
+            self.assertEqual(router.db_for_read(Participation), 'default')
+        self.assertEqual(router.db_for_read(Participation), 'replica')
+
+    @setup_users
+    def test_reads_go_to_replica(self):
+        fr0, fr1 = self.users['friend0'], self.users['friend1']
+        # sending reads from the primary, or the permission checks would fail
+        message = Message.send_to_users('msg', fr0, [fr1])
+        Message.send_to_conversation('reply', fr0, message.conversation)
+
+        self.assertEqual(Participation.objects.inbox_for(fr1).count(), 0)
+        self.assertEqual(Participation.objects.unread_counts_for(fr1), {})
+        self.assertEqual(
+            Conversation.objects.containing_participant(fr1).count(),
+            0
+        )
+
+        # unless the primary is explicitly requested
+        inbox = Participation.objects.inbox_for(fr1, using='default')
+        self.assertEqual(inbox.count(), 1)
+        counts = Participation.objects.unread_counts_for(fr1,
+                                                         using='default')
+        self.assertEqual(counts, {message.conversation.pk: 2})
+
+    @setup_users
+    def test_read_your_writes(self):
+        fr0, fr1 = self.users['friend0'], self.users['friend1']
+        Message.send_to_users('msg', fr0, [fr1])
+
+        # the sender reads from the primary right after sending
+        self.assertEqual(Participation.objects.inbox_for(fr0).count(), 1)
+
+        # and so does a user who marked conversations as read
+        Participation.objects.mark_read(fr1)
+        self.assertEqual(Participation.objects.inbox_for(fr1).count(), 1)
+
+        # until the stickiness expires
+        cache.clear()
+        self.assertEqual(Participation.objects.inbox_for(fr0).count(), 0)
+
+    @setup_users
+    def test_writes_go_to_primary(self):
+        fr0, fr1 = self.users['friend0'], self.users['friend1']
+        Message.send_to_users('msg', fr0, [fr1])
+        participation = Participation.objects.using('default').get(user=fr1)
+        # as if it was loaded from the replica
+        participation._state.db = 'replica'
+        participation.mute()
+        participation.pin()
+
+        stored = Participation.objects.using('default').get(
+            pk=participation.pk
+        )
+        self.assertEqual((stored.muted, stored.pinned), (True, True))
+
+    @setup_users
+    def test_checks_read_from_primary(self):
+        fr0, fr1, fr2 = [self.users['friend{0}'.format(i)] for i in range(3)]
+        private = Message.send_to_users('msg', fr0, [fr1]).conversation
+        group = Message.send_to_users('msg', fr0, [fr1, fr2]).conversation
+
+        # one-on-one conversations can't be left, even though the replica
+        # doesn't know about their participants
+        participation = Participation.objects.using('default').get(
+            user=fr1,
+            conversation=private
+        )
+        participation.revoke()
+        self.assertFalse(Participation.objects.using('default')
+                                              .get(pk=participation.pk)
+                                              .is_deleted)
+
+        group.remove_participants([fr2])
+        with use_primary():
+            self.assertFalse(group.has_participant(fr2, cached=False))
+        group.add_participants([fr2])
+        with use_primary():
+            self.assertTrue(group.has_participant(fr2, cached=False))
+
+        scheduled = ScheduledMessage.schedule('later', fr0, group, now())
+        self.assertEqual(scheduled.sender, fr0)
@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+import json
+
+from datetime import timedelta
+
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.six import StringIO
+from django.utils.timezone import now
+
+from .. import settings, sharding
+from ..digest import iter_all_digests
+from ..export import export_user_data
+from ..importer import BulkImporter
+from ..models import (ArchivedMessage, Conversation, Message, ParticipantSet,
+                      Participation, ScheduledMessage)
+from .test_models import BaseMessagingTransactionTestCase, setup_users
+
+
+class ShardingTestCase(BaseMessagingTransactionTestCase):
+    multi_db = True
+
+    def setUp(self):
+        self._shards = settings.CONVERSATION_SHARDS
+        settings.CONVERSATION_SHARDS = ('shard0', 'shard1')
+
+    def tearDown(self):
+        settings.CONVERSATION_SHARDS = self._shards
+        super(ShardingTestCase, self).tearDown()
+
+    def assert_on_shard(self, conversation):
+        shard = sharding.shard_for(conversation.pk)
+        for alias in settings.CONVERSATION_SHARDS:
+            exists = (Conversation.objects.using(alias)
+                                          .filter(pk=conversation.pk)
+                                          .exists())
+            self.assertEqual(exists, alias == shard)
+        return shard
+
+    @setup_users
+    def test_conversations_are_spread_across_shards(self):
+        fr0 = self.users['friend0']
+        messages = [Message.send_to_users('msg', fr0, [self.users[username]])
+                    for username in ('friend1', 'friend2', 'friend3')]
+
+        shards = set()
+        for message in messages:
+            shard = self.assert_on_shard(message.conversation)
+            shards.add(shard)
+            # the messages and participations are stored along with it
+            self.assertEqual(message._state.db, shard)
+            participations = Participation.objects.using(shard).filter(
+                conversation=message.conversation.pk
+            )
+            self.assertEqual(participations.count(), 2)
+
+        self.assertEqual(shards, set(settings.CONVERSATION_SHARDS))
+        # nothing was written to the default database
+        self.assertFalse(Conversation.objects.using('default').exists())
+        self.assertEqual(ParticipantSet.objects.count(), 3)
+
+    @setup_users
+    def test_send_through_directory(self):
+        fr0, fr1 = self.users['friend0'], self.users['friend1']
+        message1 = Message.send_to_users('msg', fr0, [fr1])
+        message2 = Message.send_to_users('reply', fr1, [fr0])
+
+        # the conversation was found through the participant set directory
+        self.assertEqual(message2.conversation.pk, message1.conversation.pk)
+        self.assertEqual(message2.parent, message1)
+        self.assertEqual(message2.conversation.latest_message, message2)
+
+        # the directory follows the participants of group conversations
+        group = Message.send_to_users('group', fr0, [fr1,
+                                                     self.users['friend2']])
+        Message.send_to_conversation('more', fr0, group.conversation,
+                                     new_participants=[self.users['friend3']])
+        users = [self.users[u] for u in ('friend0', 'friend1', 'friend2',
+                                         'friend3')]
+        (conversation,) = Conversation.objects.for_participants(users)
+        self.assertEqual(conversation.pk, group.conversation.pk)
+        self.assert_participants(conversation, users)
+
+    @setup_users
+    def test_inbox_fan_out(self):
+        fr0 = self.users['friend0']
+        for username in ('friend1', 'friend2', 'friend3', 'friend4'):
+            Message.send_to_users('msg', fr0, [self.users[username]])
+        # the first conversation becomes the most recently active one
+        first = Conversation.objects.for_participants([fr0,
+                                                       self.users['friend1']])
+        Message.send_to_conversation('bump', fr0, first[0])
+
+        for parallel in (True, False):
+            inbox = sharding.inbox_for(fr0, parallel=parallel)
+            usernames = [
+                [u.username for u in p.conversation.participants if u != fr0]
+                for p in inbox
+            ]
+            self.assertEqual(usernames, [['friend1'], ['friend4'],
+                                         ['friend3'], ['friend2']])
+
+        # pinned conversations come first, whichever shard they're on
+        inbox[2].pin()
+        pinned = sharding.inbox_for(fr0, limit=2)
+        self.assertEqual([p.conversation_id for p in pinned],
+                         [inbox[2].conversation_id, inbox[0].conversation_id])
+
+        inbox = sharding.inbox_for(self.users['friend2'], limit=1)
+        self.assertEqual(len(inbox), 1)
+        self.assertEqual(sharding.inbox_for(self.users['foe0']), [])
+
+    @setup_users
+    def test_scheduled_messages(self):
+        fr0 = self.users['friend0']
+        conversations = [
+            Message.send_to_users('msg', fr0, [self.users[username]])
+                   .conversation
+            for username in ('friend1', 'friend2')
+        ]
+        for conversation in conversations:
+            scheduled = ScheduledMessage.schedule('scheduled', fr0,
+                                                  conversation, now())
+            self.assertEqual(scheduled._state.db,
+                             sharding.shard_for(conversation.pk))
+
+        # every shard is dispatched
+        self.assertEqual(sum(ScheduledMessage.dispatch_due()), 2)
+        for conversation in conversations:
+            self.assertEqual(conversation.history()[0].body, 'scheduled')
+
+    @setup_users
+    def test_participants_from_directory(self):
+        fr0, fr1, fr2 = [self.users['friend{0}'.format(i)] for i in range(3)]
+        message = Message.send_to_users('msg', fr2, [fr1, fr0])
+        conversation = message.conversation
+        self.assertEqual(sorted(conversation.participant_names),
+                         ['friend0', 'friend1', 'friend2'])
+
+        joined = conversation.members(limit=2)
+        self.assertEqual([p.user for p in joined], [fr1, fr0])
+        rest = conversation.members(after=joined[1])
+        self.assertEqual([p.user for p in rest], [fr2])
+        by_name = conversation.members(order_by='username', limit=2)
+        self.assertEqual([p.user for p in by_name], [fr0, fr1])
+        self.assertEqual(list(conversation.iter_members('username',
+                                                        batch_size=2)),
+                         [fr0, fr1, fr2])
+
+    @setup_users
+    def test_summaries_from_directory(self):
+        fr0, fr1, fr2 = [self.users['friend{0}'.format(i)] for i in range(3)]
+        conversation = Message.send_to_users('msg', fr0, [fr1]).conversation
+        conversation.add_participants([fr2])
+        conversation.participations.get(user=fr1).revoke()
+
+        using = sharding.shard_for(conversation.pk)
+        Conversation.objects.using(using).update(summary_names='',
+                                                 summary_sender='')
+        self.assertEqual(list(Conversation.rebuild_summaries(
+            Conversation.objects.using(using).filter(pk=conversation.pk)
+        )), [1])
+        conversation = Conversation.objects.using(using).get(
+            pk=conversation.pk
+        )
+        self.assertEqual(conversation.summary_participant_names,
+                         ['friend0', 'friend2'])
+        self.assertEqual(conversation.summary_member_count, 2)
+        self.assertEqual(conversation.summary_sender, 'friend0')
+
+    @setup_users
+    def test_bulk_operations(self):
+        fr0 = self.users['friend0']
+        conversations = [
+            Message.send_to_users('old', fr0, [self.users[username]])
+                   .conversation
+            for username in ('friend1', 'friend2')
+        ]
+        for conversation in conversations:
+            Message.send_to_conversation('new', fr0, conversation)
+            conversation.messages.update(sent_at=now() - timedelta(days=10))
+
+        # the old messages of both shards are archived, then purged
+        self.assertEqual(sum(ArchivedMessage.archive(now())), 2)
+        stream = StringIO()
+        self.assertEqual(export_user_data(fr0, stream), 6)
+        rows = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual(set(row['sender__username'] for row in rows
+                             if row['type'] != 'participation'),
+                         set(['friend0']))
+        for conversation in conversations:
+            shard = sharding.shard_for(conversation.pk)
+            archived = ArchivedMessage.objects.using(shard)
+            self.assertEqual(sum(ArchivedMessage.purge(archived.all(),
+                                                       using=shard)), 1)
+
+        # everybody leaves, so both conversations are abandoned
+        fr3 = self.users['friend3']
+        for conversation in conversations:
+            conversation.add_participants([fr3])
+        ids = sorted(c.pk for c in conversations)
+        self.assertEqual(sorted(Participation.objects.leave(fr0,
+                                                            conversations)),
+                         ids)
+        self.assertEqual(Participation.objects.leave(self.users['friend1'],
+                                                     conversations),
+                         [conversations[0].pk])
+        self.assertEqual(Participation.objects.leave(self.users['friend2'],
+                                                     conversations),
+                         [conversations[1].pk])
+        self.assertEqual(sorted(Participation.objects.leave(fr3,
+                                                            conversations)),
+                         ids)
+        self.assertEqual(sum(Conversation.purge_abandoned()), 2)
+        for shard in settings.CONVERSATION_SHARDS:
+            self.assertFalse(Message.objects.using(shard).exists())
+
+    @setup_users
+    def test_per_user_calls(self):
+        fr0, fr3 = self.users['friend0'], self.users['friend3']
+        conversations = [
+            Message.send_to_users('hello', self.users[username],
+                                  [fr0, fr3]).conversation
+            for username in ('friend1', 'friend2')
+        ]
+        self.assertEqual(set(sharding.shard_for(c.pk) for c in conversations),
+                         set(settings.CONVERSATION_SHARDS))
+        ids = sorted(c.pk for c in conversations)
+
+        unread = Participation.objects.unread_for(fr0)
+        self.assertEqual(sorted(p.conversation_id for p in unread), ids)
+        self.assertEqual(Participation.objects.unread_counts_for(fr0),
+                         dict((pk, 1) for pk in ids))
+
+        found = Message.objects.search(fr0, 'hello')
+        self.assertEqual(sorted(m.conversation_id for m in found), ids)
+        # the pages continue on the other shard
+        (first,) = Message.objects.search(fr0, 'hello', limit=1)
+        rest = Message.objects.search(fr0, 'hello', after=first)
+        self.assertEqual(sorted([first.conversation_id] +
+                                [m.conversation_id for m in rest]), ids)
+
+        self.assertEqual(Participation.objects.mark_read(fr0,
+                                                         conversations[:1]),
+                         [conversations[0].pk])
+        self.assertEqual([p.conversation_id
+                          for p in Participation.objects.unread_for(fr0)],
+                         [conversations[1].pk])
+        self.assertEqual(Participation.objects.mark_read(fr0),
+                         [conversations[1].pk])
+        self.assertEqual(Participation.objects.unread_for(fr0), [])
+        self.assertEqual(Participation.objects.unread_counts_for(fr0), {})
+
+        self.assertEqual(sorted(Participation.objects.leave(fr0,
+                                                            conversations)),
+                         ids)
+        self.assertEqual(sharding.inbox_for(fr0), [])
+        self.assertEqual(Message.objects.search(fr0, 'hello'), [])
+        self.assertEqual(len(Message.objects.search(fr3, 'hello')), 2)
+        for conversation in conversations:
+            using = sharding.shard_for(conversation.pk)
+            self.assertEqual(Conversation.objects.using(using)
+                                                 .get(pk=conversation.pk)
+                                                 .summary_member_count, 2)
+
+    @setup_users
+    def test_digests(self):
+        fr0 = self.users['friend0']
+        messages = [Message.send_to_users('hello', self.users[username],
+                                          [fr0, self.users['friend3']])
+                    for username in ('friend1', 'friend2')]
+        self.assertEqual(set(sharding.shard_for(m.conversation_id)
+                             for m in messages),
+                         set(settings.CONVERSATION_SHARDS))
+
+        # a single digest of the conversations on both shards
+        digests = list(iter_all_digests(now() - timedelta(hours=1)))
+        self.assertEqual([d.user.username for d in digests],
+                         sorted(['friend0', 'friend3'],
+                                key=lambda name: self.users[name].pk))
+        (digest,) = [d for d in digests if d.user == fr0]
+        self.assertEqual(sorted(c.pk for c in digest.conversations),
+                         sorted(m.conversation_id for m in messages))
+        self.assertEqual(digest.messages,
+                         dict((m.conversation_id, [m]) for m in messages))
+
+    def test_importer_refuses_sharding(self):
+        self.assertRaises(ImproperlyConfigured, BulkImporter)
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.utils.six import StringIO
+
+from .. import settings
+from ..models import Conversation, Message, Participation
+from ..tracing import (TraceReplayer, percentile, read_trace,
+                       start_recording, stop_recording)
+from .test_models import BaseMessagingTestCase, setup_users
+
+
+class TracingTestCase(BaseMessagingTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'trace.jsonl')
+        self._replay_databases = settings.TRACE_REPLAY_DATABASES
+
+    def tearDown(self):
+        settings.TRACE_REPLAY_DATABASES = self._replay_databases
+        stop_recording()
+        shutil.rmtree(self.directory)
+        super(TracingTestCase, self).tearDown()
+
+    def record_traffic(self):
+        fr0, fr1, fr2 = [self.users['friend{0}'.format(i)] for i in range(3)]
+        start_recording(self.path)
+        message = Message.send_to_users('hello', fr0, [fr1, fr2])
+        conversation = message.conversation
+        Message.send_to_conversation('hi there', fr1, conversation)
+        # the lazy querysets aren't traced, only the calls running queries
+        list(Participation.objects.inbox_for(fr2))
+        Participation.objects.inbox_page(fr2, page=1)
+        Participation.objects.unread_counts_for(fr2)
+        conversation.remove_participants([fr2])
+        Participation.objects.get(conversation=conversation,
+                                  user=fr2).reinstate()
+        Participation.objects.leave(fr2, [conversation])
+        stop_recording()
+        return conversation
+
+    @setup_users
+    def test_recording(self):
+        self.record_traffic()
+        records = list(read_trace(self.path))
+        # calls made by traced calls aren't recorded
+        self.assertEqual([r['op'] for r in records], [
+            'send_to_users', 'send_to_conversation', 'inbox_page',
+            'unread_counts_for', 'remove_participants', 'reinstate', 'leave'
+        ])
+        send = records[0]
+        self.assertEqual((send['u'], send['r'], send['c'], send['b']),
+                         (1, [2, 3], 1, 5))
+        self.assertEqual(records[1]['u'], 2)
+        self.assertEqual((records[2]['u'], records[2]['p']), (3, 1))
+        self.assertEqual(records[-1]['cs'], [1])
+        self.assertTrue(all(r['d'] >= 0 for r in records))
+        self.assertNotIn('hello', open(self.path).read())
+
+        # nothing is recorded once it's stopped
+        Message.send_to_users('more', self.users['friend0'],
+                              [self.users['friend3']])
+        self.assertEqual(len(list(read_trace(self.path))), 7)
+
+    @setup_users
+    def test_replay(self):
+        self.record_traffic()
+        replayer = TraceReplayer(read_trace(self.path))
+        report = replayer.run()
+        self.assertEqual(sorted(report), sorted(set(
+            r['op'] for r in read_trace(self.path)
+        )))
+        for stats in report.values():
+            self.assertEqual((stats['count'], stats['errors']), (1, 0))
+            self.assertTrue(stats['p50'] <= stats['max'])
+
+        users = [replayer.users[i] for i in (1, 2, 3)]
+        self.assertEqual([u.username for u in users],
+                         ['trace_user1', 'trace_user2', 'trace_user3'])
+        (conversation,) = Conversation.objects.for_participants(users)
+        self.assertEqual(conversation.messages.count(), 2)
+        self.assertEqual(sorted(u.pk for u in conversation.participants),
+                         sorted(u.pk for u in users[:2]))
+
+    @setup_users
+    def test_replay_trace_command(self):
+        self.record_traffic()
+        settings.TRACE_REPLAY_DATABASES = ('default',)
+        out = StringIO()
+        call_command('replay_trace', self.path, database='default',
+                     stdout=out)
+        self.assertIn("Replayed 7 calls", out.getvalue())
+        self.assertIn("send_to_conversation", out.getvalue())
+
+    @setup_users
+    def test_replay_trace_command_checks_the_database(self):
+        self.record_traffic()
+        calls = Message.objects.count()
+        # Django < 1.5 turns the CommandError into a SystemExit
+        refused = (CommandError, SystemExit)
+        for options in ({}, {'database': 'default'}):
+            with self.assertRaises(refused):
+                call_command('replay_trace', self.path, stdout=StringIO(),
+                             **options)
+        # only the primary is written to
+        settings.TRACE_REPLAY_DATABASES = ('default', 'other')
+        with self.assertRaises(refused):
+            call_command('replay_trace', self.path, database='other',
+                         stdout=StringIO())
+        self.assertEqual(Message.objects.count(), calls)
+
+        out = StringIO()
+        call_command('replay_trace', self.path, i_know=True, stdout=out)
+        self.assertIn("Replayed 7 calls", out.getvalue())
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 0.5), 50)
+        self.assertEqual(percentile(values, 0.99), 99)
+        self.assertEqual(percentile(values, 1.0), 100)
+        self.assertEqual(percentile([], 0.5), None)
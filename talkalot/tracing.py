@@ -0,0 +1,396 @@
+# -*- coding: utf-8 -*-
+"""Recording of talkalot API calls, and replaying them as a load test.
+
+With TRACE_FILE set (or after `start_recording`), the sends, inbox loads and
+membership changes going through the public API are appended to the trace
+file, one compact JSON object per line, with the time since the recording
+started and the duration of the call in milliseconds. Users and
+conversations are replaced by sequential numbers and message bodies by
+their length, so the trace doesn't contain personal data. Calls made by
+other traced calls aren't recorded. Only calls which run their queries are
+traced, so the reads are recorded through `inbox_page` and
+`unread_counts_for`, not the lazy querysets. A `{pid}` in TRACE_FILE
+is replaced by the process id, as every process needs a trace of it's own.
+
+`TraceReplayer` (or the replay_trace management command) drives the same
+calls against the configured database, creating the users and the
+conversations it needs on the way, and reports the throughput and latency
+percentiles of every operation. As the replay writes, the command only runs
+against a database listed in TRACE_REPLAY_DATABASES.
+"""
+from __future__ import unicode_literals
+
+import json
+import math
+import os
+import threading
+import time
+
+from collections import deque
+from functools import wraps
+
+from django.db import connections
+
+from . import settings
+
+
+TRACE_VERSION = 1
+
+_recorder = None
+_recorder_lock = threading.Lock()
+_local = threading.local()
+
+
+class TraceRecorder(object):
+    """Appends the traced calls of the process to a file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.users = {}
+        self.conversations = {}
+        self.stream = open(path, 'a')
+        self.write({'version': TRACE_VERSION, 'started_at': self.started})
+
+    def write(self, record):
+        line = json.dumps(record, separators=(',', ':'), sort_keys=True)
+        with self.lock:
+            self.stream.write(line + '\n')
+            self.stream.flush()
+
+    def anonymize(self, mapping, pk):
+        with self.lock:
+            return mapping.setdefault(pk, len(mapping) + 1)
+
+    def user(self, user):
+        return self.anonymize(self.users, getattr(user, 'pk', user))
+
+    def conversation(self, conversation):
+        return self.anonymize(self.conversations,
+                              getattr(conversation, 'pk', conversation))
+
+    def record(self, operation, started, duration, fields, error=None):
+        record = dict(fields, op=operation,
+                      t=round((started - self.started) * 1000, 1),
+                      d=round(duration * 1000, 3))
+        if error is not None:
+            record['e'] = error
+        self.write(record)
+
+    def close(self):
+        with self.lock:
+            self.stream.close()
+
+
+def start_recording(path=None):
+    """Start recording the traced calls of the process into the file at
+    path, TRACE_FILE by default. Returns the recorder."""
+    global _recorder
+    with _recorder_lock:
+        if _recorder is None:
+            path = path or settings.TRACE_FILE
+            _recorder = TraceRecorder(path.format(pid=os.getpid()))
+        return _recorder
+
+
+def stop_recording():
+    global _recorder
+    with _recorder_lock:
+        recorder, _recorder = _recorder, None
+    if recorder is not None:
+        recorder.close()
+
+
+def get_recorder():
+    if _recorder is None and settings.TRACE_FILE:
+        return start_recording()
+    return _recorder
+
+
+def traced(operation, describe):
+    """Decorator recording the calls of the function as operation, when
+    recording is enabled. describe is called with the recorder, the result
+    (None if the call failed) and the arguments of the call, and returns the
+    anonymized fields of the record."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            recorder = get_recorder()
+            if recorder is None or getattr(_local, 'active', False):
+                return func(*args, **kwargs)
+
+            _local.active = True
+            started = time.time()
+            result = error = None
+            try:
+                result = func(*args, **kwargs)
+                return result
+            except Exception as exc:
+                error = type(exc).__name__
+                raise
+            finally:
+                duration = time.time() - started
+                _local.active = False
+                try:
+                    fields = describe(recorder, result, *args, **kwargs)
+                except Exception:
+                    # tracing must never break the call itself
+                    fields = None
+                if fields is not None:
+                    recorder.record(operation, started, duration, fields,
+                                    error)
+        return wrapper
+    return decorator
+
+
+def body_length(body):
+    return len(body) if body is not None else 0
+
+
+def describe_send_to_users(recorder, message, cls, body, sender, recipients,
+                           ttl=None):
+    fields = {'u': recorder.user(sender),
+              'r': [recorder.user(user) for user in recipients],
+              'b': body_length(body)}
+    if message is not None:
+        fields['c'] = recorder.conversation(message.conversation_id)
+    return fields
+
+
+def describe_send_to_conversation(recorder, message, cls, body, sender,
+                                  conversation, new_participants=None,
+                                  ttl=None):
+    return {'u': recorder.user(sender),
+            'c': recorder.conversation(conversation),
+            'r': [recorder.user(user) for user in new_participants or []],
+            'b': body_length(body)}
+
+
+def describe_user(recorder, result, manager, user, *args, **kwargs):
+    return {'u': recorder.user(user)}
+
+
+def describe_inbox_page(recorder, result, manager, user, page=0,
+                        page_size=None, using=None):
+    fields = {'u': recorder.user(user), 'p': page}
+    if page_size is not None:
+        fields['s'] = page_size
+    return fields
+
+
+def describe_participants(recorder, result, conversation, participants):
+    return {'c': recorder.conversation(conversation),
+            'r': [recorder.user(user) for user in participants]}
+
+
+def describe_participation(recorder, result, participation):
+    return {'c': recorder.conversation(participation.conversation_id),
+            'u': recorder.user(participation.user_id)}
+
+
+def describe_leave(recorder, result, manager, user, conversations):
+    return {'u': recorder.user(user),
+            'cs': [recorder.conversation(c) for c in conversations]}
+
+
+def read_trace(path):
+    """Yield the records of a trace file, skipping it's header lines."""
+    with open(path) as stream:
+        for line in stream:
+            record = json.loads(line)
+            if 'op' in record:
+                yield record
+
+
+def percentile(sorted_values, fraction):
+    """Return the nearest-rank percentile of a sorted list."""
+    if not sorted_values:
+        return None
+    index = int(math.ceil(fraction * len(sorted_values))) - 1
+    return sorted_values[min(max(index, 0), len(sorted_values) - 1)]
+
+
+class TraceReplayer(object):
+    """Replays a trace against the database, with the specified number of
+    threads executing the calls in the order they were recorded. The users
+    of the trace are created as trace_user<N>, and conversations which were
+    started before the recording are created when first referenced, so the
+    replay is only an approximation of the original traffic, which may fail
+    now and then, e.g. when someone sends into a conversation they joined
+    before the recording started.
+
+    :param concurrency: Number of threads, with 1 the calls are made in the
+                        calling thread
+    :param speed: Optional, replay with the recorded pacing, sped up this
+                  many times, instead of as fast as possible"""
+
+    def __init__(self, records, concurrency=1, speed=None):
+        self.records = list(records)
+        self.concurrency = max(concurrency, 1)
+        self.speed = speed
+        self.lock = threading.Lock()
+        self.users = {}
+        self.conversations = {}
+        self.latencies = {}
+        self.errors = {}
+        self.elapsed = None
+
+    def run(self):
+        """Replay the trace, and return the report, see `report`."""
+        self.create_users()
+        queue = deque(self.records)
+        self.started = time.time()
+        if self.concurrency == 1:
+            self.work(queue)
+        else:
+            threads = [threading.Thread(target=self.work_in_thread,
+                                        args=(queue,))
+                       for _ in range(self.concurrency)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.elapsed = time.time() - self.started
+        return self.report()
+
+    def create_users(self):
+        try:
+            # Django 1.5+
+            from django.contrib.auth import get_user_model
+        except ImportError:
+            # Django < 1.5
+            from django.contrib.auth.models import User
+        else:
+            User = get_user_model()
+
+        ids = set()
+        for record in self.records:
+            ids.update(record.get('r', []))
+            if 'u' in record:
+                ids.add(record['u'])
+        for anonymous_id in ids:
+            username = 'trace_user{0}'.format(anonymous_id)
+            users = list(User.objects.filter(username=username)[:1])
+            if users:
+                self.users[anonymous_id] = users[0]
+            else:
+                self.users[anonymous_id] = User.objects.create_user(username)
+
+    def work_in_thread(self, queue):
+        try:
+            self.work(queue)
+        finally:
+            # threads get their own connections, which won't be reused
+            for connection in connections.all():
+                connection.close()
+
+    def work(self, queue):
+        while True:
+            try:
+                record = queue.popleft()
+            except IndexError:
+                return
+
+            if self.speed:
+                delay = (self.started + record['t'] / 1000.0 / self.speed -
+                         time.time())
+                if delay > 0:
+                    time.sleep(delay)
+
+            operation = record['op']
+            started = time.time()
+            try:
+                getattr(self, 'replay_' + operation)(record)
+            except Exception:
+                with self.lock:
+                    self.errors[operation] = self.errors.get(operation, 0) + 1
+            else:
+                duration = time.time() - started
+                with self.lock:
+                    self.latencies.setdefault(operation, []).append(duration)
+
+    def conversation(self, anonymous_id, creator):
+        """Return the conversation of the trace, started by creator if it's
+        not known yet."""
+        from .models import Conversation
+        with self.lock:
+            conversation = self.conversations.get(anonymous_id)
+            if conversation is None:
+                conversation = Conversation.start(creator, [creator])
+                self.conversations[anonymous_id] = conversation
+            return conversation
+
+    def replay_send_to_users(self, record):
+        from .models import Message
+        message = Message.send_to_users('x' * record['b'],
+                                        self.users[record['u']],
+                                        [self.users[r] for r in record['r']])
+        if 'c' in record:
+            with self.lock:
+                self.conversations.setdefault(record['c'],
+                                              message.conversation)
+
+    def replay_send_to_conversation(self, record):
+        from .models import Message
+        sender = self.users[record['u']]
+        Message.send_to_conversation('x' * record['b'],
+                                     sender,
+                                     self.conversation(record['c'], sender),
+                                     [self.users[r] for r in record['r']])
+
+    def replay_inbox_page(self, record):
+        from .models import Participation
+        kwargs = {'page': record.get('p', 0)}
+        if 's' in record:
+            kwargs['page_size'] = record['s']
+        Participation.objects.inbox_page(self.users[record['u']], **kwargs)
+
+    def replay_unread_counts_for(self, record):
+        from .models import Participation
+        Participation.objects.unread_counts_for(self.users[record['u']])
+
+    def replay_add_participants(self, record):
+        users = [self.users[r] for r in record['r']]
+        conversation = self.conversation(record['c'], users[0])
+        conversation.add_participants(users)
+
+    def replay_remove_participants(self, record):
+        users = [self.users[r] for r in record['r']]
+        conversation = self.conversation(record['c'], users[0])
+        conversation.remove_participants(users)
+
+    def participation(self, record):
+        user = self.users[record['u']]
+        conversation = self.conversation(record['c'], user)
+        return conversation.participations.get(user=user)
+
+    def replay_revoke(self, record):
+        self.participation(record).revoke()
+
+    def replay_reinstate(self, record):
+        self.participation(record).reinstate()
+
+    def replay_leave(self, record):
+        from .models import Participation
+        user = self.users[record['u']]
+        conversations = [self.conversation(c, user) for c in record['cs']]
+        Participation.objects.leave(user, conversations)
+
+    def report(self):
+        """Return a dict mapping the operations to dicts of their count,
+        errors, throughput (calls per second of the whole replay) and
+        p50/p90/p99/max latencies in milliseconds."""
+        elapsed = max(self.elapsed, 1e-6)
+        report = {}
+        for operation in set(self.latencies) | set(self.errors):
+            latencies = sorted(self.latencies.get(operation, []))
+            stats = dict(count=len(latencies),
+                         errors=self.errors.get(operation, 0),
+                         throughput=len(latencies) / elapsed)
+            for name, fraction in (('p50', 0.5), ('p90', 0.9),
+                                   ('p99', 0.99), ('max', 1.0)):
+                value = percentile(latencies, fraction)
+                stats[name] = value * 1000 if value is not None else None
+            report[operation] = stats
+        return report
@@ -1,6 +1,11 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+try:
+    from django.db.transaction import atomic
+except ImportError:
+    from django.db.transaction import commit_on_success as atomic
+
 
 def is_date_greater(date_a, date_b):
     """Return whether date_a is greater than date_b. In case any of them is
@@ -16,3 +21,60 @@ def is_date_greater(date_a, date_b):
         return True
 
     return date_a > date_b
+
+
+def delete_queryset(queryset):
+    """Delete the rows matched by the queryset with a single DELETE statement,
+    bypassing the deletion collector, which would load every row and cascade
+    through all of it's relations. Anything referencing the rows has to be
+    cleared beforehand."""
+    if not hasattr(queryset, '_raw_delete'):
+        # Django < 1.5
+        return queryset.delete()
+    return queryset._raw_delete(queryset.db)
+
+
+def delete_in_batches(queryset, batch_size, clear_references=None,
+                      using=None):
+    """Delete the rows matched by the queryset in batches of batch_size, each
+    batch in it's own transaction, following the ordering of the queryset.
+    Before a batch is deleted, clear_references is called with the list of
+    it's primary keys, to update the rows referencing the doomed ones. Yields
+    the number of rows deleted in each batch.
+
+    :param using: Optional, alias of the database the rows are deleted from
+    """
+    while True:
+        with atomic(using=using):
+            pks = list(queryset.values_list('pk', flat=True)[:batch_size])
+            if pks:
+                if clear_references is not None:
+                    clear_references(pks)
+                rows = queryset.model.objects.using(using).filter(pk__in=pks)
+                delete_queryset(rows)
+
+        if not pks:
+            return
+        yield len(pks)
+
+
+def iterate_in_batches(queryset, batch_size):
+    """Iterate over a values() queryset in primary key order, fetching it in
+    batches of batch_size with keyset pagination, so neither the database nor
+    the memory has to hold more than one batch at a time. The values must
+    include the primary key as `pk`."""
+    queryset = queryset.order_by('pk')
+    last_pk = None
+    while True:
+        batch = queryset
+        if last_pk is not None:
+            batch = batch.filter(pk__gt=last_pk)
+
+        count = 0
+        for row in batch[:batch_size].iterator():
+            count += 1
+            last_pk = row['pk']
+            yield row
+
+        if count < batch_size:
+            return